@@ -9,7 +9,20 @@ import json
 import getpass
 import itertools
 import errno
+import argparse
+import csv
+import hmac
+import hashlib
+import socket
+import select
+import struct
+import stat
+import signal
+import termios
 import concurrent.futures
+import contextlib
+import ipaddress
+import statistics
 from shutil import which
 from datetime import datetime
 
@@ -45,16 +58,88 @@ RECONNECTION_LOG_FILE = "reconnections.log"
 LOCK_FILE = "convpn.lock"
 IPT_V4_BACKUP = "iptables_v4.bak"
 IPT_V6_BACKUP = "iptables_v6.bak"
+HISTORY_FILE = "latency_history.json"
+KNOWN_GOOD_FILE = "known_good_servers.json"
+RACE_FILE_PREFIX = "openvpn_race_"
+MGMT_SOCKET_FILE = "openvpn_mgmt.sock"
+STANDBY_FILE_PREFIX = "openvpn_standby"
+STANDBY_RETRY_BASE = 30 # Segundos entre reintentos de la reserva; se duplica en cada fallo seguido
+STANDBY_RETRY_MAX = 600
+TIMELINE_FILE = "connection_timeline.log"
+TIMELINE_HISTORY_FILE = "connection_timeline_history.json"
+DOH_BLOCKLIST_FILE = "doh_blocklist.txt"
 
 CONNECTION_TIMEOUT = 20
 MONITOR_INTERVAL = 45
 CONNECTION_ATTEMPTS = 3
 IP_VERIFY_ATTEMPTS = 3
 RETRY_DELAY = 10
-CURL_TIMEOUT = 4
+IP_ORACLE_TIMEOUT = 4
 IP_RETRY_DELAY = 5
 PING_TIMEOUT = 4
 API_TIMEOUT = 5
+ICMP_SCAN_TIMEOUT = 1.5
+RESOLVE_WORKERS = 20
+RESOLVER_CACHE_TTL = 300
+RESOLVER_NEGATIVE_TTL = 30
+ICMP_PAYLOAD = b"convpn-scan".ljust(32, b".")
+SCAN_SAMPLES = 5
+SCAN_SAMPLE_INTERVAL = 0.2
+SCORE_JITTER_WEIGHT = 2
+SCORE_LOSS_PENALTY = 1000
+LOSS_WARN_PERCENT = 10
+HISTORY_EWMA_ALPHA = 0.3
+HISTORY_DOWN_SCORE = 9999
+HISTORY_DEFAULT_TTL = 3600
+HANDSHAKE_TIMEOUT = 2.0
+OVPN_DEFAULT_PORT = "1194"
+OVPN_DEFAULT_PROTO = "udp"
+P_CONTROL_HARD_RESET_CLIENT_V2 = 7
+P_CONTROL_HARD_RESET_SERVER_V2 = 8
+SCAN_METHOD_HANDSHAKE = "handshake"
+SCAN_METHOD_ICMP = "icmp"
+LIVE_REDRAW_INTERVAL = 0.5
+LIVE_SCAN_CANCEL_TIMEOUT = 3.0 # Espera máxima a las sondas ya lanzadas al cancelar un escaneo
+RACE_MAX_PROFILES = 5
+FAILOVER_MAX_SERVERS = 4
+FAILOVER_ATTEMPTS_PER_SERVER = 1
+MGMT_CONNECT_TIMEOUT = 5
+MGMT_BYTECOUNT_INTERVAL = 5
+READY_POLL_INTERVAL = 0.2
+NM_SETTLE_TIMEOUT = 2
+TUNNEL_READY_TIMEOUT = 3
+RESOLVER_READY_TIMEOUT = 7
+DNS_PROBE_DOMAIN = "ifconfig.me" # Se consulta un subdominio aleatorio: ninguna caché lo tiene
+DNS_PROBE_TIMEOUT = 1.0
+NETWORK_RESTORE_TIMEOUT = 3
+NM_RESTART_TIMEOUT = 5
+BANNER_PAUSE = 5
+PRERESOLVED_MAX_REMOTES = 3
+PRERESOLVED_POLL_TIMEOUT = 8
+FIREWALL_AUTO = "auto"
+FIREWALL_NFTABLES = "nftables"
+FIREWALL_IPTABLES = "iptables"
+NFT_TABLE = "convpn"
+IPT_CHAIN_IN = "CONVPN_IN"
+IPT_CHAIN_OUT = "CONVPN_OUT"
+IPT_CHAIN_DOH = "CONVPN_DOH"
+IPSET_DOH_V4 = "convpn_doh4"
+IPSET_DOH_V6 = "convpn_doh6"
+DOH_PORTS = ["443", "853"] # DoH (también HTTP/3) y DoT/DoQ
+DOH_IPS_V4 = ["1.1.1.1", "1.0.0.1", "8.8.8.8", "8.8.4.4", "9.9.9.9", "149.112.112.112"]
+DOH_IPS_V6 = [
+    "2606:4700:4700::1111", "2606:4700:4700::1001", # Cloudflare
+    "2001:4860:4860::8888", "2001:4860:4860::8844", # Google
+    "2620:fe::fe", "2620:fe::9"                     # Quad9
+]
+# Solo servicios sin AAAA: en una red con IPv6, requests saldría por IPv6 y la respuesta no serviría
+IP_PROVIDERS = ["https://api.ipify.org", "https://ipv4.icanhazip.com", "https://checkip.amazonaws.com", "https://v4.ident.me"]
+IP_ORACLE_FANOUT = 3
+IP_ORACLE_QUORUM = 2
+IP_ORACLE_MAX_FAILURES = 3
+IP_ORACLE_EWMA_ALPHA = 0.3
+TIMELINE_HISTORY_MAX = 200
+TIMELINE_SUMMARY_SPANS = 4
 ANALYSIS_INTERVAL = 600
 ANALYSIS_MIN_DURATION = 1800
 MAX_LOCATION_NAME_LENGTH = 15
@@ -64,6 +149,15 @@ ORIGINAL_DEFAULT_ROUTE_DETAILS = None
 ROUTE_CORRECTION_COUNT = 0
 GUARDIAN_STOP_EVENT = threading.Event()
 CONNECTION_START_TIME = None
+CONNECTED_PROFILE = None
+MGMT_CLIENT = None
+STANDBY = None
+STANDBY_RETRY_DELAY = 0
+STANDBY_NEXT_RETRY = 0.0
+TIMELINE = None
+IP_ORACLE = None
+PRIV_HELPER = None
+DOH_BLOCKLIST_MTIME = None
 LAST_RECONNECTION_TIME = None
 CURRENT_LANG = "es" 
 
@@ -85,6 +179,7 @@ TRANSLATIONS = {
         "dns_abort": "Error Crítico: No se detectaron DNS en el log. Abortando conexión por seguridad.",
         "sudo_simple": "Se solicitará acceso de administrador (sudo) para ejecutar\nOpenVPN, firewall y gestionar la red.",
         "ks_active": "Activando Kill Switch (Bloqueo estricto)...",
+        "ks_apply_fail": "  > Error aplicando las reglas del Kill Switch.",
         "ks_lan": "  > Excepción LAN: {}",
         "ks_vpn": "  > Excepción VPN: {}:{} ({})",
         "ks_tun": "  > Tráfico permitido en túnel: {}",
@@ -156,6 +251,7 @@ TRANSLATIONS = {
         "lbl_ip": "IP Esperada (VPN):".ljust(L_WIDTH),
         "lbl_port": "Puerto Asignado:".ljust(L_WIDTH),
         "lbl_reconn": "Reconexiones:".ljust(L_WIDTH),
+        "lbl_traffic": "Tráfico (↓/↑):".ljust(L_WIDTH),
         "lbl_guardian_freq": "Frecuencia Guardián:".ljust(L_WIDTH),
         "lbl_route_corr": "Correcciones Ruta:".ljust(L_WIDTH),
         "lbl_corr_rate": "Tasa Corrección:".ljust(L_WIDTH),
@@ -168,6 +264,8 @@ TRANSLATIONS = {
         "ana_pattern_no": "No se detecta patrón en las correcciones.",
         "status_ok": "ESTADO: Conectado y verificado.",
         "reconn_fail_kill": "Reconexión fallida. Corte de emergencia activado.",
+        "fast_reconn": "Reconexión rápida: reiniciando solo OpenVPN (el Kill Switch sigue activo)...",
+        "fast_reconn_fail": "La reconexión rápida no ha funcionado. Pasando a la reconexión completa...",
         "reconn_success": "Reconexión exitosa. Monitorizando...",
         "exit_mon": "Saliendo del monitor. Menú en 5 segundos...",
         "fail_title": "❌ FALLO DE CONEXIÓN",
@@ -265,13 +363,44 @@ TRANSLATIONS = {
         "cfg_doh_off": "DESACTIVADO",
         "cfg_lan_on": "ACTIVADO (Aislamiento Total)",
         "cfg_lan_off": "DESACTIVADO (Permitir LAN)",
-        "ks_doh": "  > Bloqueando DoH (Anti-Fugas): {}",
+        "ks_doh": "  > Bloqueando DoH/DoT (Anti-Fugas): {}",
+        "ks_doh_count": "{} resolvers (lista actualizable)",
         "clean_doh": "  > Eliminando reglas de bloqueo DoH...",
         "ks_lan_block": "  > LAN BLOQUEADA (Modo Paranoia activo).",
         "ufw_restore": "Restaurando UFW (Firewall del sistema)...",
         "ipt_backup": "Guardando reglas iptables existentes...",
         "ipt_restore": "Restaurando reglas iptables originales...",
-        "exec_post": "Ejecutando script post-conexión (Usuario: {})..."
+        "exec_post": "Ejecutando script post-conexión (Usuario: {})...",
+        "scan_no_reply": "Sin respuesta",
+        "scan_progress": "Analizando latencias... {}/{} (puedes elegir ya)",
+        "menu_opt_advanced": "Opciones Avanzadas (Escaneo / Conexión)",
+        "adv_prompt": "Elige opción para cambiar o Intro para volver: ",
+        "adv_history_ttl": "Caducidad del historial de latencias:",
+        "adv_history_ttl_q": "Minutos antes de volver a medir un servidor: ",
+        "adv_scan_method": "Método de escaneo:",
+        "adv_method_handshake": "Handshake OpenVPN (ICMP de respaldo)",
+        "adv_method_icmp": "Solo ICMP (ping)",
+        "adv_race": "Modo carrera (perfiles a la vez):",
+        "adv_race_off": "Desactivado",
+        "adv_race_q": "¿Cuántos perfiles lanzar a la vez? (1 = desactivado, máx. {}): ",
+        "race_start": "Modo carrera: lanzando {} perfiles a la vez...",
+        "race_won": "Primer túnel listo: {}. Cerrando el resto...",
+        "race_route": "  > Ruta al servidor {} por la puerta de enlace original...",
+        "adv_failover": "Servidores de reserva al reconectar:",
+        "adv_failover_country": "Solo del mismo país",
+        "adv_failover_any": "Cualquier país",
+        "failover_next": "Probando el siguiente servidor ({}/{}): {}...",
+        "adv_on": "Activado",
+        "adv_off": "Desactivado",
+        "adv_standby": "Túnel de reserva (conmutación inmediata):",
+        "lbl_standby": "Túnel de reserva:".ljust(L_WIDTH),
+        "standby_start": "Preparando túnel de reserva: {}...",
+        "standby_switch": "Conmutando al túnel de reserva: {}...",
+        "adv_timeline": "Tiempos de conexión en el resumen:",
+        "lbl_timeline": "Tiempos:",
+        "resume_adopted": "El túnel anterior ({}) sigue conectado y sano: retomándolo sin reconectar.",
+        "adv_fw_backend": "Cortafuegos del Kill Switch:",
+        "adv_fw_auto": "Automático"
     },
     "en": {
         "closing": "Script will close in 10 seconds...",
@@ -282,6 +411,7 @@ TRANSLATIONS = {
         "term_run": "Run: python3 '{}' --run-in-terminal",
         "ctrl_c_exit": "Ctrl+C -> Exit",
         "ks_active": "Activating Kill Switch (Strict Block)...",
+        "ks_apply_fail": "  > Error applying the Kill Switch rules.",
         "ks_lan": "  > LAN Exception: {}",
         "ks_vpn": "  > VPN Exception: {}:{} ({})",
         "ks_tun": "  > Tunnel traffic allowed: {}",
@@ -349,6 +479,7 @@ TRANSLATIONS = {
         "lbl_ip": "Expected IP (VPN):".ljust(L_WIDTH),
         "lbl_port": "Assigned Port:".ljust(L_WIDTH),
         "lbl_reconn": "Reconnections:".ljust(L_WIDTH),
+        "lbl_traffic": "Traffic (↓/↑):".ljust(L_WIDTH),
         "lbl_guardian_freq": "Guardian Frequency:".ljust(L_WIDTH),
         "lbl_route_corr": "Route Corrections:".ljust(L_WIDTH),
         "lbl_corr_rate": "Correction Rate:".ljust(L_WIDTH),
@@ -361,6 +492,8 @@ TRANSLATIONS = {
         "ana_pattern_no": "No pattern detected in corrections.",
         "status_ok": "STATUS: Connected and verified.",
         "reconn_fail_kill": "Reconnection failed. Emergency cut activated.",
+        "fast_reconn": "Fast reconnect: restarting OpenVPN only (Kill Switch stays on)...",
+        "fast_reconn_fail": "Fast reconnect did not work. Falling back to a full reconnect...",
         "reconn_success": "Reconnection successful. Monitoring...",
         "exit_mon": "Exiting monitor. Menu in 5 seconds...",
         "fail_title": "❌ CONNECTION FAILURE",
@@ -458,13 +591,44 @@ TRANSLATIONS = {
         "cfg_doh_off": "DISABLED",
         "cfg_lan_on": "ENABLED (Total Isolation)",
         "cfg_lan_off": "DISABLED (Allow LAN)",
-        "ks_doh": "  > Blocking DoH (Anti-Leak): {}",
+        "ks_doh": "  > Blocking DoH/DoT (Anti-Leak): {}",
+        "ks_doh_count": "{} resolvers (updatable list)",
         "clean_doh": "  > Removing DoH rules...",
         "ks_lan_block": "  > LAN BLOCKED (Paranoia Mode active).",
         "ufw_restore": "Restoring UFW (System Firewall)...",
         "ipt_backup": "Backing up existing iptables rules...",
         "ipt_restore": "Restoring original iptables rules...",
-        "exec_post": "Executing post-connection script (User: {})..."
+        "exec_post": "Executing post-connection script (User: {})...",
+        "scan_no_reply": "No reply",
+        "scan_progress": "Analyzing latencies... {}/{} (you can pick now)",
+        "menu_opt_advanced": "Advanced Options (Scan / Connection)",
+        "adv_prompt": "Choose option to change or Enter to back: ",
+        "adv_history_ttl": "Latency history expiry:",
+        "adv_history_ttl_q": "Minutes before re-measuring a server: ",
+        "adv_scan_method": "Scan method:",
+        "adv_method_handshake": "OpenVPN handshake (ICMP fallback)",
+        "adv_method_icmp": "ICMP only (ping)",
+        "adv_race": "Race mode (profiles at once):",
+        "adv_race_off": "Disabled",
+        "adv_race_q": "How many profiles to launch at once? (1 = disabled, max {}): ",
+        "race_start": "Race mode: launching {} profiles at once...",
+        "race_won": "First tunnel up: {}. Closing the rest...",
+        "race_route": "  > Route to server {} via the original gateway...",
+        "adv_failover": "Fallback servers on reconnect:",
+        "adv_failover_country": "Same country only",
+        "adv_failover_any": "Any country",
+        "failover_next": "Trying the next server ({}/{}): {}...",
+        "adv_on": "Enabled",
+        "adv_off": "Disabled",
+        "adv_standby": "Standby tunnel (instant switchover):",
+        "lbl_standby": "Standby tunnel:".ljust(L_WIDTH),
+        "standby_start": "Preparing standby tunnel: {}...",
+        "standby_switch": "Switching to the standby tunnel: {}...",
+        "adv_timeline": "Connection timings on the summary:",
+        "lbl_timeline": "Timings:",
+        "resume_adopted": "The previous tunnel ({}) is still up and healthy: resuming it without reconnecting.",
+        "adv_fw_backend": "Kill Switch firewall:",
+        "adv_fw_auto": "Automatic"
     }
 }
 # --- GESTIÓN DE CONFIGURACIÓN E IDIOMA ---
@@ -590,6 +754,55 @@ class ConfigManager:
     def get_lan_blocking(self):
         return self.config.get("block_lan", False)     
 
+    def set_history_ttl(self, seconds):
+        self.config["history_ttl"] = seconds
+        self.save_config()
+
+    def get_history_ttl(self):
+        return self.config.get("history_ttl", HISTORY_DEFAULT_TTL)
+
+    def set_scan_method(self, method):
+        self.config["scan_method"] = method
+        self.save_config()
+
+    def get_scan_method(self):
+        return self.config.get("scan_method", SCAN_METHOD_HANDSHAKE)
+
+    def set_race_count(self, count):
+        self.config["race_count"] = count
+        self.save_config()
+
+    def get_race_count(self):
+        return self.config.get("race_count", 1)
+
+    def set_failover_same_country(self, enabled):
+        self.config["failover_same_country"] = enabled
+        self.save_config()
+
+    def get_failover_same_country(self):
+        return self.config.get("failover_same_country", False)
+
+    def set_standby_enabled(self, enabled):
+        self.config["standby_enabled"] = enabled
+        self.save_config()
+
+    def get_standby_enabled(self):
+        return self.config.get("standby_enabled", False)
+
+    def set_timeline_summary(self, enabled):
+        self.config["timeline_summary"] = enabled
+        self.save_config()
+
+    def get_timeline_summary(self):
+        return self.config.get("timeline_summary", False)
+
+    def set_firewall_backend(self, backend):
+        self.config["firewall_backend"] = backend
+        self.save_config()
+
+    def get_firewall_backend(self):
+        return self.config.get("firewall_backend", FIREWALL_AUTO)
+
 def T(key, *args):
     lang_dict = TRANSLATIONS.get(CURRENT_LANG, TRANSLATIONS["es"])
     text = lang_dict.get(key, key)
@@ -642,6 +855,410 @@ def update_lock_state(key, value):
     except Exception:
         pass
 
+# --- AYUDANTE PRIVILEGIADO (UN SOLO SUDO) ---
+# Este mismo script, lanzado una vez con 'sudo ... --priv-helper', hace como root las operaciones que le
+# pide la interfaz por un socketpair: una petición JSON por línea y una respuesta por petición.
+# Así no se paga un sudo (PAM incluido) por cada iptables/ip/nmcli. No es un intérprete de órdenes:
+# solo conoce las operaciones de PRIV_OPS, y cada una valida sus argumentos antes de montar comandos fijos.
+# Sin ayudante, las mismas operaciones (con las mismas comprobaciones) se hacen con sudo.
+RESOLV_CONF = "/etc/resolv.conf"
+RESOLV_CONF_BAK = "/etc/resolv.conf.bak"
+RESOLV_CONF_TMP = "/etc/resolv.conf.convpn"
+PRIV_IFACE_RE = re.compile(r"^[\w.:@-]{1,15}$")
+PRIV_WORD_RE = re.compile(r"^\w[\w.-]*$")
+NFT_SETS = ("servers", "tuns", "doh4", "doh6")
+# Documentos nft: fuera de llaves solo se habla de la tabla de ConVPN
+NFT_TOP_LEVEL_RE = re.compile(rf"^((add|delete) table inet {NFT_TABLE}|table inet {NFT_TABLE} \{{"
+                              rf"|(add|delete) element inet {NFT_TABLE} ({'|'.join(NFT_SETS)}) \{{[^{{}};]*\}}"
+                              rf"|flush set inet {NFT_TABLE} ({'|'.join(NFT_SETS)}))$")
+# Reglas iptables: solo la tabla filter, sus cadenas base y las de ConVPN
+IPT_RULE_RE = re.compile(r"^(:(INPUT|FORWARD|OUTPUT) (ACCEPT|DROP) \[0:0\]|-[FX]( CONVPN_\w+)?|-N CONVPN_\w+"
+                         r"|-[AD] (INPUT|FORWARD|OUTPUT|CONVPN_\w+) [^\n]+)$")
+
+def invoking_uid():
+    # Dentro del ayudante (root) el usuario de verdad es el que lanzó sudo
+    return int(os.environ.get("SUDO_UID", os.getuid()))
+
+def _priv_ip(value):
+    return str(ipaddress.ip_address(value))
+
+def _priv_iface(value):
+    if not isinstance(value, str) or not PRIV_IFACE_RE.match(value): raise ValueError(f"iface: {value!r}")
+    return value
+
+def _priv_word(value):
+    if not isinstance(value, str) or not PRIV_WORD_RE.match(value): raise ValueError(f"value: {value!r}")
+    return value
+
+def _priv_choice(value, choices):
+    if value not in choices: raise ValueError(f"value: {value!r}")
+    return value
+
+def _priv_port(port):
+    port = int(port)
+    if not 0 < port < 65536: raise ValueError(f"port: {port}")
+    return str(port)
+
+def _priv_tun(dev):
+    if not isinstance(dev, str) or not re.match(r"^tun\d+$", dev): raise ValueError(f"dev: {dev!r}")
+    return dev
+
+def _priv_family(family):
+    return {4: "iptables", 6: "ip6tables"}[_priv_choice(family, (4, 6))]
+
+def _priv_path(path, suffix=""):
+    """Solo archivos que estén directamente en la carpeta del script (logs, sockets, pidfiles y perfiles)."""
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    if not isinstance(path, str) or not path.endswith(suffix): raise ValueError(f"path: {path!r}")
+    name = os.path.basename(path)
+    if name in ("", ".", "..") or os.path.realpath(os.path.dirname(path) or ".") != script_dir:
+        raise ValueError(f"path: {path!r}")
+    return os.path.join(script_dir, name)
+
+def _priv_nm_connection(name):
+    if not isinstance(name, str) or not name or name.startswith("-") or "\n" in name: raise ValueError(f"connection: {name!r}")
+    return name
+
+def _priv_nft_document(document):
+    depth = 0
+    for line in document.splitlines():
+        line = line.strip()
+        if not line: continue
+        if re.search(r"\b(include|define)\b", line): raise ValueError(f"nft: {line!r}")
+        if depth == 0 and not NFT_TOP_LEVEL_RE.match(line): raise ValueError(f"nft: {line!r}")
+        for index, char in enumerate(line):
+            depth += {"{": 1, "}": -1}.get(char, 0)
+            # Cerrar la tabla y seguir en la misma línea sería colar otra orden
+            if depth < 0 or (depth == 0 and char == "}" and line[index + 1:].strip()): raise ValueError(f"nft: {line!r}")
+    if depth != 0: raise ValueError("nft: unbalanced braces")
+    return document
+
+def _step(argv, data=None, required=True):
+    return (argv, data, required)
+
+def _op_route(action, spec):
+    """spec: destino ('default' o red) seguido de pares clave/valor de ROUTE_KEYS (ver route_selector)."""
+    spec = list(spec)
+    if not spec or len(spec) % 2 != 1: raise ValueError(f"route: {spec!r}")
+    argv = ["ip", "route", _priv_choice(action, ("add", "del", "replace")),
+            "default" if spec[0] == "default" else str(ipaddress.ip_network(spec[0], strict=False))]
+    for key, value in zip(spec[1::2], spec[2::2]):
+        argv += [key, ROUTE_KEYS[key](value)]
+    return [_step(argv)]
+
+ROUTE_KEYS = {"via": _priv_ip, "src": _priv_ip, "dev": _priv_iface, "metric": lambda v: str(int(v)),
+              "proto": _priv_word, "scope": _priv_word, "table": _priv_word}
+
+def _op_ipt_apply(family, rules):
+    for rule in rules:
+        if not isinstance(rule, str) or not IPT_RULE_RE.match(rule): raise ValueError(f"rule: {rule!r}")
+    return [_step([f"{_priv_family(family)}-restore", "--noflush"], "\n".join(["*filter"] + list(rules) + ["COMMIT", ""]))]
+
+def _op_ipt_restore_backup(family):
+    # El backup lo leemos nosotros y del sitio fijo: nada de rutas que vengan en la petición
+    name = IPT_V4_BACKUP if _priv_family(family) == "iptables" else IPT_V6_BACKUP
+    fd = os.open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), os.O_RDONLY | os.O_NOFOLLOW)
+    with os.fdopen(fd, "r") as f:
+        return [_step([f"{_priv_family(family)}-restore"], f.read())]
+
+def _op_ipset_load(v4, v6):
+    """Rellena una copia de cada set y la intercambia con 'swap': las reglas nunca ven un set a medias."""
+    lines = []
+    for name, family, entries in ((IPSET_DOH_V4, "inet", v4), (IPSET_DOH_V6, "inet6", v6)):
+        lines += [f"create {name} hash:net family {family} -exist", f"create {name}_new hash:net family {family} -exist", f"flush {name}_new"]
+        lines += [f"add {name}_new {ipaddress.ip_network(entry, strict=False)} -exist" for entry in entries]
+        lines += [f"swap {name}_new {name}", f"destroy {name}_new"]
+    return [_step(["ipset", "restore"], "\n".join(lines) + "\n")]
+
+def _op_mgmt_chown(path):
+    # OpenVPN (root) crea el socket de gestión: solo se cede eso, un socket nuestro
+    path = _priv_path(path, ".sock")
+    if not stat.S_ISSOCK(os.lstat(path).st_mode): raise ValueError(f"not a socket: {path!r}")
+    return [_step(["chown", "-h", str(invoking_uid()), path])]
+
+def _op_openvpn_kill(pid):
+    pid = int(pid)
+    with open(f"/proc/{pid}/comm", "r") as f:
+        if f.read().strip() != "openvpn": raise ValueError(f"not openvpn: {pid}")
+    return [_step(["kill", str(pid)])]
+
+def _op_openvpn_kill_instance(marker):
+    """Las instancias de OpenVPN cuya línea de comandos lleva este pidfile o socket (únicos por instancia)."""
+    marker = _priv_path(marker)
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                argv = f.read().decode(errors="replace").split("\0")
+        except OSError: continue
+        if os.path.basename(argv[0]) == "openvpn" and marker in argv: pids.append(entry)
+    return [_step(["kill"] + pids)] if pids else []
+
+def _op_resolv_write(servers, backup=False):
+    """/etc/resolv.conf con las DNS de la VPN y bloqueado (chattr +i). Con backup, el original se guarda en .bak."""
+    content = "# Generated by ConVPN (Kill Switch Active)\n" + "".join(f"nameserver {_priv_ip(s)}\n" for s in servers)
+    steps = [_step(["chattr", "-i", RESOLV_CONF], required=False)]
+    if backup: steps.append(_step(["mv", RESOLV_CONF, RESOLV_CONF_BAK], required=False))
+    # Se escribe aparte y se mueve encima: si resolv.conf es un enlace (systemd-resolved) se sustituye el enlace
+    return steps + [_step(["tee", RESOLV_CONF_TMP], content), _step(["mv", "-f", RESOLV_CONF_TMP, RESOLV_CONF]),
+                    _step(["chattr", "+i", RESOLV_CONF])]
+
+def _op_nm_connection_routes(name, never_default, ignore_auto_routes, ipv6_method, strict=False):
+    name = _priv_nm_connection(name)
+    return [_step(["nmcli", "connection", "modify", name, "ipv4.never-default", _priv_choice(never_default, ("yes", "no"))]),
+            _step(["nmcli", "connection", "modify", name, "ipv4.ignore-auto-routes", _priv_choice(ignore_auto_routes, ("yes", "no"))]),
+            _step(["nmcli", "connection", "modify", name, "ipv6.method",
+                   _priv_choice(ipv6_method, ("auto", "dhcp", "manual", "ignore", "disabled", "link-local", "shared"))], required=strict)]
+
+PRIV_OPS = {
+    "route": _op_route,
+    "ufw": lambda action: [_step(["ufw"] + {"status": ["status"], "disable": ["disable"], "enable": ["--force", "enable"]}[action])],
+    "ipset_load": _op_ipset_load,
+    "ipset_destroy": lambda: [_step(["ipset", "-!", "destroy", name], required=False) for name in (IPSET_DOH_V4, IPSET_DOH_V6)],
+    "nft_apply": lambda document: [_step(["nft", "-f", "-"], _priv_nft_document(document))],
+    "nft_delete_table": lambda: [_step(["nft", "delete", "table", "inet", NFT_TABLE])],
+    "nft_list": lambda as_json=False: [_step(["nft"] + (["-j"] if as_json else []) + ["list", "table", "inet", NFT_TABLE])],
+    "ipt_list": lambda family=4: [_step([_priv_family(family), "-S"])],
+    "ipt_apply": _op_ipt_apply,
+    "ipt_save": lambda family: [_step([f"{_priv_family(family)}-save"])],
+    "ipt_restore_backup": _op_ipt_restore_backup,
+    "resolved_apply": lambda iface, servers: [_step(["resolvectl", "dns", _priv_iface(iface)] + [_priv_ip(s) for s in servers]),
+                                              _step(["resolvectl", "domain", iface, "~."]),
+                                              _step(["resolvectl", "default-route", iface, "yes"])],
+    "resolved_revert": lambda iface: [_step(["resolvectl", "revert", _priv_iface(iface)])],
+    "resolved_flush": lambda: [_step(["resolvectl", "flush-caches"])],
+    "resolv_write": _op_resolv_write,
+    "resolv_restore": lambda: [_step(["chattr", "-i", RESOLV_CONF], required=False), _step(["mv", RESOLV_CONF_BAK, RESOLV_CONF])],
+    "nm_device_dns": lambda iface, servers: [_step(["nmcli", "device", "modify", _priv_iface(iface), "ipv4.dns",
+                                                    " ".join(_priv_ip(s) for s in servers), "ipv4.ignore-auto-dns", "yes"])],
+    "nm_connection_routes": _op_nm_connection_routes,
+    "nm_connection_up": lambda name: [_step(["nmcli", "connection", "up", _priv_nm_connection(name)])],
+    "nm_networking": lambda state: [_step(["nmcli", "networking", _priv_choice(state, ("on", "off"))])],
+    "nm_restart": lambda: [_step(["service", "NetworkManager", "restart"])],
+    "mgmt_chown": _op_mgmt_chown,
+    "remove_file": lambda path: [_step(["rm", "-f", _priv_path(path)])],
+    "openvpn_kill_all": lambda: [_step(["killall", "-q", "openvpn"])],
+    "openvpn_kill": _op_openvpn_kill,
+    "openvpn_kill_instance": _op_openvpn_kill_instance,
+}
+
+def run_priv_op(name, args, runner):
+    """
+    Valida la operación y ejecuta sus pasos con runner(argv, input). El resultado es el del último paso
+    obligatorio (se para en el primero que falle); una petición rechazada da rc 126 sin ejecutar nada.
+    """
+    try:
+        steps = PRIV_OPS[name](**(args or {}))
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        return subprocess.CompletedProcess([name], 126, "", f"rejected {name}: {e}")
+    result = subprocess.CompletedProcess([name], 0, "", "")
+    for argv, data, required in steps:
+        res = runner(argv, data)
+        if required:
+            result = res
+            if res.returncode != 0: break
+    return result
+
+# Opciones de OpenVPN que se pueden añadir al perfil, con el validador de cada uno de sus valores
+OVPN_OPTIONS = {
+    "--remote": (_priv_ip, _priv_port, lambda proto: _priv_choice(proto, ("udp", "tcp"))),
+    "--server-poll-timeout": (lambda seconds: str(int(seconds)),),
+    "--dev": (_priv_tun,),
+    "--route-noexec": (),
+    "--writepid": (lambda path: _priv_path(path, ".pid"),),
+    "--management": (lambda path: _priv_path(path, ".sock"), lambda kind: _priv_choice(kind, ("unix",))),
+}
+
+def openvpn_command(config_file, options=(), nobind=False):
+    """Línea de comandos de OpenVPN para un perfil de la carpeta del script y opciones de OVPN_OPTIONS."""
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    options, remotes, overrides = list(options), [], []
+    while options:
+        validators = OVPN_OPTIONS[options[0]]
+        if len(options) <= len(validators): raise ValueError(f"option: {options!r}")
+        option = [options[0]] + [check(value) for check, value in zip(validators, options[1:])]
+        (remotes if options[0] == "--remote" else overrides).extend(option)
+        options = options[1 + len(validators):]
+    # OpenVPN lee las opciones en orden: los '--remote' se acumulan en la lista de conexiones (los nuestros,
+    # antes que los del perfil, se prueban primero) y en el resto gana la última, así que van detrás de '--config'.
+    # Ahí también '--script-security' (un 'up'/'down' del perfil no ejecuta nada como root) y '--nobind'
+    # (el perfil puede traer 'lport'/'bind').
+    cmd = ["openvpn", "--block-ipv6", "--cd", script_dir] + remotes + ["--config", _priv_path(config_file, ".ovpn"),
+           "--auth-user-pass", "/dev/stdin", "--mssfix", "1450", "--mute-replay-warnings"] + overrides + ["--script-security", "1"]
+    if nobind: cmd.append("--nobind")
+    return cmd
+
+def _default_signals(): signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def _run_as_root(argv, data):
+    try: return subprocess.run(argv, input=data, capture_output=True, text=True, preexec_fn=_default_signals)
+    except OSError as e: return subprocess.CompletedProcess(argv, 127, "", str(e))
+
+def _run_with_sudo(argv, data):
+    try: return subprocess.run(["sudo"] + argv, input=data, capture_output=True, text=True)
+    except OSError as e: return subprocess.CompletedProcess(argv, 127, "", str(e))
+
+def _start_openvpn_as_root(args, input_data):
+    cmd = openvpn_command(args.get("config"), args.get("options") or [], bool(args.get("nobind")))
+    log_path = _priv_path(args.get("log"), ".log")
+    # Sin seguir enlaces y sin truncar hasta ver que no es un enlace duro a otro archivo
+    fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+    with os.fdopen(fd, "wb") as log:
+        if os.fstat(fd).st_nlink != 1: raise ValueError(f"log: {log_path!r}")
+        os.ftruncate(fd, 0)
+        os.fchown(fd, invoking_uid(), -1) # El log lo sigue leyendo (y borrando) la interfaz
+        child = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log, stderr=log, preexec_fn=_default_signals)
+    try:
+        child.stdin.write((input_data or "").encode())
+        child.stdin.close()
+    except OSError: pass
+    return child
+
+def _reply(res):
+    return {"rc": res.returncode, "stdout": res.stdout, "stderr": res.stderr}
+
+def run_priv_helper():
+    """
+    Bucle del ayudante (ya como root). Peticiones {"id", "op", "args"}:
+      ping                         -> {"uid"}
+      <op de PRIV_OPS>             -> {"rc", "stdout", "stderr"}
+      openvpn_start {config, log, options, nobind} + "input"  -> {"pid"}
+    Termina cuando la interfaz cierra su extremo.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C es para la interfaz: la limpieza todavía nos necesita
+    requests_in, replies_out = os.fdopen(0, "rb"), os.fdopen(1, "wb")
+    children = []
+
+    for line in requests_in:
+        children = [child for child in children if child.poll() is None] # Sin zombis
+        try: request = json.loads(line)
+        except ValueError: continue
+        if not isinstance(request, dict): continue
+        op, args = request.get("op"), request.get("args") or {}
+        if op == "ping":
+            reply = {"uid": os.geteuid()}
+        elif op == "openvpn_start":
+            try:
+                children.append(_start_openvpn_as_root(args, request.get("input")))
+                reply = {"pid": children[-1].pid}
+            except (OSError, KeyError, TypeError, ValueError, AttributeError) as e:
+                reply = {"pid": None, "error": str(e)}
+        else:
+            reply = _reply(run_priv_op(op, args, _run_as_root))
+        reply["id"] = request.get("id")
+        replies_out.write((json.dumps(reply) + "\n").encode())
+        replies_out.flush()
+    return 0
+
+class PrivilegedHelper:
+    """Extremo de la interfaz: arranca el ayudante con un único sudo y le pasa las peticiones en orden."""
+    def __init__(self):
+        self.proc = None
+        self.sock = None
+        self.stream = None
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def start(self):
+        parent, child = socket.socketpair()
+        try:
+            # -n: nunca pedir contraseña aquí; el 'sudo -v' del arranque ya la ha pedido
+            self.proc = subprocess.Popen(["sudo", "-n", sys.executable, os.path.realpath(__file__), "--priv-helper"],
+                                         stdin=child, stdout=child, stderr=subprocess.DEVNULL)
+        except OSError:
+            parent.close()
+            return False
+        finally:
+            child.close()
+        self.sock, self.stream = parent, parent.makefile("rwb")
+        reply = self.request({"op": "ping"})
+        if not reply or reply.get("uid") != 0:
+            self.close()
+            return False
+        return True
+
+    def request(self, payload):
+        """Una petición y su respuesta. None si el ayudante ya no está (a partir de ahí se usa sudo directo)."""
+        with self.lock:
+            if not self.stream: return None
+            self.next_id += 1
+            try:
+                self.stream.write((json.dumps(dict(payload, id=self.next_id)) + "\n").encode())
+                self.stream.flush()
+                line = self.stream.readline()
+                reply = json.loads(line) if line else None
+            except (OSError, ValueError):
+                reply = None
+            if not reply or reply.get("id") != self.next_id:
+                self._drop()
+                return None
+            return reply
+
+    def _drop(self):
+        # Cerrar el socket le llega al ayudante como EOF y termina
+        for conn in (self.stream, self.sock):
+            try: conn.close()
+            except Exception: pass
+        self.stream = self.sock = None
+
+    def close(self):
+        with self.lock:
+            if self.stream: self._drop()
+        if self.proc:
+            try: self.proc.wait(timeout=2)
+            except subprocess.TimeoutExpired: pass
+
+def start_priv_helper():
+    global PRIV_HELPER
+    helper = PrivilegedHelper()
+    PRIV_HELPER = helper if helper.start() else None
+    return PRIV_HELPER is not None
+
+def _completed(name, reply, check):
+    res = subprocess.CompletedProcess([name], reply["rc"], reply.get("stdout", ""), reply.get("stderr", ""))
+    if check: res.check_returncode()
+    return res
+
+def priv_op(op, check=False, **args):
+    """
+    Operación root de PRIV_OPS; retorna un CompletedProcess (salida capturada, como texto).
+    Va por el ayudante si está vivo; si no, con un sudo de los de siempre por cada paso.
+    """
+    reply = PRIV_HELPER.request({"op": op, "args": args}) if PRIV_HELPER else None
+    if reply is None:
+        res = run_priv_op(op, args, _run_with_sudo)
+        if check: res.check_returncode()
+        return res
+    return _completed(op, reply, check)
+
+def priv_start_openvpn(config_file, log_path, input_data, options=(), nobind=False):
+    """Arranca OpenVPN como root (ver openvpn_command) con su salida en log_path e input_data por stdin. Retorna el PID."""
+    if isinstance(input_data, bytes): input_data = input_data.decode()
+    args = {"config": config_file, "log": log_path, "options": list(options), "nobind": nobind}
+    reply = PRIV_HELPER.request({"op": "openvpn_start", "args": args, "input": input_data}) if PRIV_HELPER else None
+    if reply and reply.get("pid"): return reply["pid"]
+    cmd = openvpn_command(config_file, options, nobind)
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(["sudo"] + cmd, stdin=subprocess.PIPE, stdout=log, stderr=log)
+    try:
+        proc.stdin.write(input_data.encode())
+        proc.stdin.close()
+    except Exception: pass
+    return proc.pid
+
+def route_selector(route):
+    """'default via 192.168.1.1 dev wlan0 proto dhcp metric 600 linkdown' -> lo que identifica la ruta para la op 'route'."""
+    tokens = route.split()
+    spec, index = tokens[:1], 1
+    while index < len(tokens) - 1:
+        if tokens[index] in ROUTE_KEYS:
+            spec += tokens[index:index + 2]
+            index += 2
+        else:
+            index += 1
+    return spec
+
 # --- FUNCIONES DE RED, DNS Y FIREWALL ---
 
 def log_dns_action(script_dir, action, data):
@@ -694,39 +1311,429 @@ def get_local_subnet(interface):
     except Exception: pass
     return None
     
+# --- SEGUIMIENTO INCREMENTAL DEL LOG DE OPENVPN ---
+class ConnectionInfo:
+    """Lo que sabemos del túnel según el log: se rellena línea a línea, una sola vez."""
+    def __init__(self):
+        self.state = "CONNECTING"
+        self.tun = None
+        self.dns = []
+        self.remote_ip = None
+        self.remote_port = None
+        self.remote_proto = None
+        # IP interna según el patrón donde aparezca; internal_ip() elige por prioridad
+        self.internal_ips = {}
+
+    def internal_ip(self):
+        # 1. Patrón moderno (Linux/DCO)  2. PUSH_REPLY (ifconfig IP MASCARA)  3. Legacy (ip addr add)
+        for source in ("net_addr", "ifconfig", "ip_addr"):
+            if source in self.internal_ips: return self.internal_ips[source]
+        return None
+
+class LogFollower:
+    """
+    Lee solo los bytes añadidos al log desde la última vez (guarda el offset),
+    así el coste de cada consulta no crece con el tamaño del log.
+    Si el archivo se trunca o se sustituye (nuevo intento, ganador del modo carrera) empieza de cero.
+    """
+    # Busca: UDPv4 link remote: [AF_INET]217.138.222.67:1194 (Ignorando texto intermedio)
+    REMOTE_RE = re.compile(r"(UDP|TCP).*?remote:.*?(?:\[.*?\])?\s*([0-9.]+):([0-9]+)", re.IGNORECASE)
+    TUN_RE = re.compile(r"TUN/TAP device (tun\d+) opened")
+    DNS_RE = re.compile(r"(?:dhcp-option DNS |net_dns_v4_add:\s+)([\d\.]+)")
+    INTERNAL_IP_RES = (("net_addr", re.compile(r"net_addr_v4_add:\s+([0-9.]+)")),
+                       ("ifconfig", re.compile(r"ifconfig\s+([0-9.]+)\s+[0-9.]+")),
+                       ("ip_addr", re.compile(r"ip\s+addr\s+add\s+([0-9.]+)")))
+    STATE_MARKERS = (("Initialization Sequence Completed", "CONNECTED"),
+                     ("AUTH_FAILED", "AUTH_FAILED"),
+                     ("Restart pause", "RECONNECTING"),
+                     ("SIGUSR1", "RECONNECTING"),
+                     ("process exiting", "EXITED"))
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.inode = inode
+        self.offset = 0
+        self.partial = b""
+        self.info = ConnectionInfo()
+
+    def poll(self):
+        try:
+            st = os.stat(self.log_path)
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self._reset(st.st_ino)
+            if st.st_size == self.offset: return self.info
+            with open(self.log_path, "rb") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+        except OSError:
+            return self.info
+        self.offset += len(chunk)
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop() # Línea a medio escribir: se completa en la próxima lectura
+        for line in lines:
+            self._parse_line(line.decode("utf-8", errors="ignore"))
+        return self.info
+
+    def _parse_line(self, line):
+        info = self.info
+        for marker, state in self.STATE_MARKERS:
+            if marker in line:
+                info.state = state
+                break
+        if info.remote_ip is None:
+            match = self.REMOTE_RE.search(line)
+            if match:
+                info.remote_proto = "udp" if "udp" in match.group(1).lower() else "tcp"
+                info.remote_ip, info.remote_port = match.group(2), match.group(3)
+        if info.tun is None:
+            match = self.TUN_RE.search(line)
+            if match: info.tun = match.group(1)
+        for dns in self.DNS_RE.findall(line):
+            if dns not in info.dns: info.dns.append(dns)
+        for source, regex in self.INTERNAL_IP_RES:
+            if source not in info.internal_ips:
+                match = regex.search(line)
+                if match: info.internal_ips[source] = match.group(1)
+
+LOG_FOLLOWERS = {}
+
+def follow_openvpn_log(log_path):
+    """ConnectionInfo al día del log indicado (un seguidor por archivo, reutilizado entre llamadas)."""
+    if log_path not in LOG_FOLLOWERS: LOG_FOLLOWERS[log_path] = LogFollower(log_path)
+    return LOG_FOLLOWERS[log_path].poll()
+
+# --- INTERFAZ DE GESTIÓN DE OPENVPN (--management) ---
+class ManagementClient:
+    """
+    Cliente del socket Unix de gestión de OpenVPN. Se suscribe a >STATE, >BYTECOUNT y >LOG,
+    así los cambios de estado (conectado, caída, fallo de autenticación) llegan solos en vez de sondearlos.
+    'changed' se activa con cada notificación; puede compartirse entre varios clientes (modo carrera).
+    """
+    def __init__(self, sock_path, changed=None):
+        self.sock_path = sock_path
+        self.changed = changed or threading.Event()
+        self.sock = None
+        self.connected = False
+        self.closed = False
+        self.state = None # CONNECTING, WAIT, AUTH, GET_CONFIG, ASSIGN_IP, ADD_ROUTES, CONNECTED, RECONNECTING, EXITING
+        self.state_detail = None
+        self.local_ip = None
+        self.remote_ip = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.auth_failed = False
+        self.pid = None
+
+    def connect(self, timeout=MGMT_CONNECT_TIMEOUT):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.path.exists(self.sock_path):
+                # OpenVPN (root) crea el socket: nos lo cedemos para hablar con él sin sudo
+                priv_op("mgmt_chown", path=self.sock_path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.sock_path)
+                    self.sock, self.connected = sock, True
+                    threading.Thread(target=self._reader, daemon=True).start()
+                    self.send("state on all")
+                    self.send(f"bytecount {MGMT_BYTECOUNT_INTERVAL}")
+                    self.send("log on")
+                    self.send("pid")
+                    return True
+                except OSError:
+                    sock.close()
+            time.sleep(0.2)
+        return False
+
+    def send(self, command):
+        try:
+            self.sock.sendall(f"{command}\n".encode("utf-8"))
+            return True
+        except (OSError, AttributeError):
+            return False
+
+    def close(self):
+        if self.sock:
+            try: self.sock.close()
+            except OSError: pass
+
+    def _reader(self):
+        buffer = b""
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if not data: break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    self._handle_line(line.decode("utf-8", errors="ignore").rstrip("\r"))
+                self.changed.set()
+        except OSError: pass
+        # Socket cerrado: OpenVPN ha terminado (o lo hemos matado)
+        self.closed = True
+        self.changed.set()
+
+    def _handle_line(self, line):
+        if line.startswith(">STATE:"): line = line[len(">STATE:"):]
+        if re.match(r"^\d+,[A-Z_]+,", line):
+            # Tanto el historial de 'state on all' como las notificaciones >STATE
+            fields = line.split(",")
+            self.state = fields[1]
+            self.state_detail = fields[2] if len(fields) > 2 else None
+            if len(fields) > 4:
+                self.local_ip, self.remote_ip = fields[3] or self.local_ip, fields[4] or self.remote_ip
+            if self.state == "EXITING" and self.state_detail == "auth-failure": self.auth_failed = True
+        elif line.startswith(">BYTECOUNT:"):
+            try:
+                bytes_in, bytes_out = line[len(">BYTECOUNT:"):].split(",")[:2]
+                self.bytes_in, self.bytes_out = int(bytes_in), int(bytes_out)
+            except ValueError: pass
+        elif line.startswith(">LOG:"):
+            if "AUTH_FAILED" in line: self.auth_failed = True
+        elif line.startswith(">PASSWORD:Verification Failed"):
+            self.auth_failed = True
+        elif line.startswith("SUCCESS: pid="):
+            try: self.pid = int(line[len("SUCCESS: pid="):])
+            except ValueError: pass
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024: return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+def wait_for_tunnel_drop(timeout):
+    """Espera hasta 'timeout' segundos, pero vuelve en cuanto OpenVPN notifica que el túnel ya no está CONNECTED."""
+    client = MGMT_CLIENT
+    # Solo despertamos ante una caída nueva; si ya no estaba CONNECTED, espera normal
+    if not client or not client.connected or client.closed or client.state != "CONNECTED":
+        time.sleep(timeout)
+        return
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if client.closed or client.state != "CONNECTED": return
+        client.changed.wait(max(0, min(1, deadline - time.time())))
+        client.changed.clear()
+
 def is_ufw_active():
     # Comprueba si UFW está instalado y activo
     if not which("ufw"): return False
     try:
-        res = subprocess.run(["sudo", "ufw", "status"], capture_output=True, text=True)
+        res = priv_op("ufw", action="status")
         return "Status: active" in res.stdout or "Estado: activo" in res.stdout
     except Exception: return False    
 
 def extract_connection_details(script_dir):
-    # Extrae IP, Puerto y Protocolo REALES del log de OpenVPN (Flexible)
-    log_path = os.path.join(script_dir, LOG_FILE)
-    if os.path.exists(log_path):
-        try:
-            with open(log_path, 'r', errors='ignore') as f:
-                content = f.read()
-                # Busca: UDPv4 link remote: [AF_INET]217.138.222.67:1194 (Ignorando texto intermedio)
-                match = re.search(r"(UDP|TCP).*?remote:.*?(?:\[.*?\])?\s*([0-9.]+):([0-9]+)", content, re.IGNORECASE)
-                if match:
-                    proto = "udp" if "udp" in match.group(1).lower() else "tcp"
-                    return match.group(2), match.group(3), proto
-        except Exception: pass
-    return None, None, None
+    # IP, Puerto y Protocolo REALES del servidor, según el log de OpenVPN
+    info = follow_openvpn_log(os.path.join(script_dir, LOG_FILE))
+    return info.remote_ip, info.remote_port, info.remote_proto
 #######
   
-def manage_kill_switch(phys_iface, tun_iface, action="add", vpn_ip=None, vpn_port=None, proto="udp", script_dir=None, restore_ufw=False, block_doh=False, block_lan=False):
-    if not phys_iface and action != "del": return
-    ipt, ip6t = ["sudo", "iptables"], ["sudo", "ip6tables"]
+def resolve_firewall_backend(config_mgr):
+    """Backend del Kill Switch a usar: el configurado o, en automático, nftables si 'nft' está instalado."""
+    backend = config_mgr.get_firewall_backend()
+    if backend == FIREWALL_AUTO: return FIREWALL_NFTABLES if which("nft") else FIREWALL_IPTABLES
+    return backend
+
+def journaled_firewall_backend():
+    """Backend con el que se montó el Kill Switch activo (los journal antiguos solo conocían iptables)."""
+    return (get_lock_state() or {}).get("actions", {}).get("firewall_backend", FIREWALL_IPTABLES)
+
+def load_doh_blocklist(script_dir):
+    """
+    Resolvers DoH/DoT a bloquear: una IP o red CIDR por línea ('#' para comentarios). Si el archivo
+    no existe se crea con la lista de serie, para poder ampliarla o sustituirla por una lista pública.
+    Retorna (redes IPv4, redes IPv6).
+    """
+    global DOH_BLOCKLIST_MTIME
+    path = os.path.join(script_dir, DOH_BLOCKLIST_FILE)
+    if not os.path.exists(path):
+        try:
+            with open(path, "w") as f:
+                f.write("# ConVPN: resolvers DoH/DoT bloqueados por el Kill Switch (una IP o red CIDR por línea)\n")
+                f.write("\n".join(DOH_IPS_V4 + DOH_IPS_V6) + "\n")
+        except OSError:
+            return list(DOH_IPS_V4), list(DOH_IPS_V6)
+    doh_v4, doh_v6 = [], []
+    try:
+        DOH_BLOCKLIST_MTIME = os.path.getmtime(path)
+        with open(path, "r") as f:
+            for line in f:
+                entry = line.split("#", 1)[0].strip()
+                if not entry: continue
+                try: network = ipaddress.ip_network(entry, strict=False)
+                except ValueError: continue
+                (doh_v4 if network.version == 4 else doh_v6).append(str(network))
+    except OSError:
+        return list(DOH_IPS_V4), list(DOH_IPS_V6)
+    return list(dict.fromkeys(doh_v4)), list(dict.fromkeys(doh_v6))
+
+def load_doh_ipsets(doh_v4, doh_v6):
+    """Carga la lista en los ipset de ConVPN con un solo 'ipset restore' (ver la op 'ipset_load')."""
+    return priv_op("ipset_load", v4=doh_v4, v6=doh_v6).returncode == 0
+
+def doh_drop_rules(match):
+    """Reglas iptables de bloqueo DoH/DoT para un destino ('-m set ...' o '-d ip'), en su propia cadena."""
+    return [f"-A {IPT_CHAIN_DOH} {match} -p {proto} -m multiport --dports {','.join(DOH_PORTS)} -j DROP" for proto in ("tcp", "udp")]
+
+def doh_address_rules(doh_v4, doh_v6):
+    """Sin ipset: una regla por dirección. Retorna (reglas IPv4, reglas IPv6)."""
+    return ([rule for ip in doh_v4 for rule in doh_drop_rules(f"-d {ip}")],
+            [rule for ip in doh_v6 for rule in doh_drop_rules(f"-d {ip}")])
+
+def refresh_doh_blocklist(script_dir):
+    """Si el archivo de la lista cambia con el Kill Switch puesto, se recarga en caliente: cambio atómico del set o, sin ipset, de la cadena DoH."""
+    actions = (get_lock_state() or {}).get("actions", {})
+    if not actions.get("doh_blocked"): return
+    try: mtime = os.path.getmtime(os.path.join(script_dir, DOH_BLOCKLIST_FILE))
+    except OSError: return
+    if mtime == DOH_BLOCKLIST_MTIME: return
+    doh_v4, doh_v6 = load_doh_blocklist(script_dir)
+    if actions.get("firewall_backend") == FIREWALL_NFTABLES:
+        # Vaciar y rellenar en la misma transacción de nft es igual de atómico que un swap
+        commands = []
+        for set_name, entries in (("doh4", doh_v4), ("doh6", doh_v6)):
+            commands.append(f"flush set inet {NFT_TABLE} {set_name}")
+            if entries: commands.append(f"add element inet {NFT_TABLE} {set_name} {{ {', '.join(entries)} }}")
+        nft_run("\n".join(commands) + "\n")
+    elif actions.get("doh_ipset"):
+        load_doh_ipsets(doh_v4, doh_v6)
+    else:
+        # Sin ipset: vaciar y rellenar la cadena DoH, una transacción por familia
+        rules_v4, rules_v6 = doh_address_rules(doh_v4, doh_v6)
+        apply_ruleset("iptables-restore", [f"-F {IPT_CHAIN_DOH}"] + rules_v4)
+        apply_ruleset("ip6tables-restore", [f"-F {IPT_CHAIN_DOH}"] + rules_v6)
+
+def build_nft_ruleset(phys_iface, server_ips, tun_iface, local_subnet, doh_lists, block_lan):
+    """
+    Kill Switch como tabla 'inet convpn' propia: políticas DROP en sus cadenas base y el resto del
+    firewall del usuario intacto (en nftables un paquete tiene que pasar todas las tablas).
+    Servidores, túneles y la lista DoH/DoT (doh_lists, None si no se bloquea) van en sets:
+    se cambian sin recargar la tabla y una lista de cualquier tamaño cuesta lo mismo por paquete.
+    """
+    server_elements = f" elements = {{ {', '.join(server_ips)} }};" if server_ips else ""
+    tun_elements = f' elements = {{ "{tun_iface}" }};' if tun_iface else ""
+    lan_in = [f"ip saddr {local_subnet} accept"] if local_subnet and not block_lan else []
+    lan_out = [f"ip daddr {local_subnet} accept"] if local_subnet and not block_lan else []
+    doh_sets, doh_out = [], []
+    if doh_lists:
+        ports = ", ".join(DOH_PORTS)
+        for set_name, set_type, family, entries in (("doh4", "ipv4_addr", "ip", doh_lists[0]), ("doh6", "ipv6_addr", "ip6", doh_lists[1])):
+            elements = f" elements = {{ {', '.join(entries)} }};" if entries else ""
+            doh_sets.append(f"  set {set_name} {{ type {set_type}; flags interval; auto-merge;{elements} }}")
+            doh_out.append(f"{family} daddr @{set_name} meta l4proto {{ tcp, udp }} th dport {{ {ports} }} drop")
+    chain = lambda name, rules: [f"  chain {name} {{", f"    type filter hook {name} priority 0; policy drop;"] + [f"    {r}" for r in rules] + ["  }"]
+    # 'add' + 'delete' al principio: si la tabla ya existía se reemplaza entera en la misma transacción
+    return "\n".join([f"add table inet {NFT_TABLE}", f"delete table inet {NFT_TABLE}", f"table inet {NFT_TABLE} {{",
+                      f"  set servers {{ type ipv4_addr;{server_elements} }}",
+                      f"  set tuns {{ type ifname;{tun_elements} }}"] + doh_sets
+                     + chain("input", ['iifname "lo" accept'] + lan_in + [f'iifname "{phys_iface}" ip saddr @servers accept', "iifname @tuns accept"])
+                     + chain("forward", [])
+                     + chain("output", doh_out + ['oifname "lo" accept'] + lan_out + [f'oifname "{phys_iface}" ip daddr @servers accept', "oifname @tuns accept"])
+                     + ["}", ""])
+
+def nft_run(document):
+    return priv_op("nft_apply", document=document).returncode == 0
+
+def desired_vpn_entries(actions):
+    """Servidores y túneles que el journal dice que deben estar permitidos (principal, preparados y reserva)."""
+    servers = [actions.get("ks_vpn_ip")] + list(actions.get("ks_staged_ips") or []) + [actions.get("standby_vpn_ip")]
+    tuns = [actions.get("ks_tun"), actions.get("standby_tun")]
+    return [ip for ip in dict.fromkeys(servers) if ip], [tun for tun in dict.fromkeys(tuns) if tun]
+
+def vpn_rule_specs(phys_iface, servers, tuns):
+    """Reglas de las cadenas propias de ConVPN, escritas tal y como las lista 'iptables -S' para poder compararlas."""
+    rules = []
+    for ip in servers:
+        rules += [f"-A {IPT_CHAIN_IN} -s {ip}/32 -i {phys_iface} -j ACCEPT", f"-A {IPT_CHAIN_OUT} -d {ip}/32 -o {phys_iface} -j ACCEPT"]
+    for tun in tuns:
+        rules += [f"-A {IPT_CHAIN_IN} -i {tun} -j ACCEPT", f"-A {IPT_CHAIN_OUT} -o {tun} -j ACCEPT"]
+    return rules
+
+def installed_nft_elements():
+    """Elementos actuales de los sets 'servers' y 'tuns' de la tabla convpn (None si no se puede leer)."""
+    res = priv_op("nft_list", as_json=True)
+    if res.returncode != 0: return None
+    try:
+        items = json.loads(res.stdout).get("nftables", [])
+    except ValueError: return None
+    return {item["set"]["name"]: {elem for elem in item["set"].get("elem", []) if isinstance(elem, str)}
+            for item in items if "set" in item}
+
+def sync_kill_switch():
+    """
+    Modelo de estado deseado: el journal dice qué servidores y túneles deben estar permitidos,
+    se compara con lo instalado y se aplica solo la diferencia en una transacción.
+    Cambiar de servidor toca dos reglas (o dos elementos de set), no el Kill Switch entero.
+    """
+    actions = (get_lock_state() or {}).get("actions", {})
+    phys_iface = actions.get("firewall_iface")
+    if not actions.get("kill_switch_active") or not phys_iface: return True
+    servers, tuns = desired_vpn_entries(actions)
+
+    if actions.get("firewall_backend") == FIREWALL_NFTABLES:
+        installed = installed_nft_elements()
+        if installed is None: return False
+        commands = []
+        for set_name, wanted, quote in (("servers", servers, ""), ("tuns", tuns, '"')):
+            current = installed.get(set_name, set())
+            commands += [f"add element inet {NFT_TABLE} {set_name} {{ {quote}{v}{quote} }}" for v in wanted if v not in current]
+            commands += [f"delete element inet {NFT_TABLE} {set_name} {{ {quote}{v}{quote} }}" for v in current if v not in wanted]
+        return not commands or nft_run("\n".join(commands) + "\n")
+
+    listing = priv_op("ipt_list").stdout
+    installed = [line for line in listing.splitlines() if line.startswith((f"-A {IPT_CHAIN_IN} ", f"-A {IPT_CHAIN_OUT} "))]
+    desired = vpn_rule_specs(phys_iface, servers, tuns)
+    changes = [rule for rule in desired if rule not in installed] + ["-D" + rule[2:] for rule in installed if rule not in desired]
+    return not changes or apply_ruleset("iptables-restore", changes)
+
+def apply_ruleset(restore_cmd, rules):
+    """Aplica reglas de la tabla filter en una sola transacción de iptables-restore (todo o nada)."""
+    return priv_op("ipt_apply", family=6 if restore_cmd.startswith("ip6") else 4, rules=rules).returncode == 0
+
+def manage_kill_switch(phys_iface, tun_iface, action="add", vpn_ip=None, vpn_port=None, proto="udp", script_dir=None, restore_ufw=False, block_doh=False, block_lan=False, staged_ips=None, backend=None):
+    """
+    Pone (add) o quita (del) el Kill Switch. Con 'add' retorna True solo si las reglas quedaron aplicadas:
+    la transacción es todo o nada, y sin ella no hay que seguir conectando.
+    """
+    if not phys_iface and action != "del": return False
     
-    if action == "add":
+    if action == "add" and backend == FIREWALL_NFTABLES:
+        # Tabla propia: ni backup de iptables ni desactivar UFW, el resto del firewall no se toca
+        safe_print(f"{YELLOW}{T('ks_active')}{NC}")
+        local_subnet = get_local_subnet(phys_iface)
+        if local_subnet:
+            safe_print(f"{RED}{T('ks_lan_block')}{NC}" if block_lan else f"{BLUE}{T('ks_lan', local_subnet)}{NC}")
+        server_ips = [ip for ip in dict.fromkeys([vpn_ip] + list(staged_ips or [])) if ip]
+        for server_ip in server_ips: safe_print(f"{BLUE}{T('ks_vpn', server_ip, 'ANY', 'ALL')}{NC}")
+        if tun_iface: safe_print(f"{BLUE}{T('ks_tun', tun_iface)}{NC}")
+        doh_lists = load_doh_blocklist(script_dir or os.path.dirname(os.path.realpath(__file__))) if block_doh else None
+        if doh_lists: safe_print(f"{BLUE}{T('ks_doh', T('ks_doh_count', len(doh_lists[0]) + len(doh_lists[1])))}{NC}")
+
+        if script_dir:
+            # Antes de aplicar: si algo queda a medias, cleanup() sabe qué quitar
+            update_lock_state("firewall_backend", FIREWALL_NFTABLES)
+            update_lock_state("firewall_iface", phys_iface)
+        if not nft_run(build_nft_ruleset(phys_iface, server_ips, tun_iface, local_subnet, doh_lists, block_lan)):
+            safe_print(f"{RED}{T('ks_apply_fail')}{NC}")
+            return False
+
+        if script_dir:
+            if block_doh: update_lock_state("doh_blocked", True)
+            update_lock_state("kill_switch_active", True)
+            update_lock_state("ks_vpn_ip", vpn_ip)
+            update_lock_state("ks_tun", tun_iface)
+            update_lock_state("ks_staged_ips", server_ips if staged_ips else None)
+        return True
+
+    elif action == "add":
         # 1. Gestión de UFW o Backup de IPTables
         if is_ufw_active():
             safe_print(f"{YELLOW}UFW activo detectado. Desactivando temporalmente para Kill Switch...{NC}")
-            subprocess.run(["sudo", "ufw", "disable"], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            priv_op("ufw", action="disable")
             if script_dir: update_lock_state("ufw_was_active", True)
         else:
             # Si UFW no está activo, guardamos las reglas raw de iptables por si el usuario tenía configuración propia
@@ -735,27 +1742,39 @@ def manage_kill_switch(phys_iface, tun_iface, action="add", vpn_ip=None, vpn_por
                 # Es vital usar script_dir para no dejar basura por el sistema
                 if script_dir:
                     with open(os.path.join(script_dir, IPT_V4_BACKUP), "w") as f:
-                        subprocess.run(["sudo", "iptables-save"], stdout=f, check=False)
+                        f.write(priv_op("ipt_save", family=4).stdout)
                     with open(os.path.join(script_dir, IPT_V6_BACKUP), "w") as f:
-                        subprocess.run(["sudo", "ip6tables-save"], stdout=f, check=False)
+                        f.write(priv_op("ipt_save", family=6).stdout)
                     update_lock_state("iptables_backed_up", True)
             except Exception: pass
 
         safe_print(f"{YELLOW}{T('ks_active')}{NC}")
         local_subnet = get_local_subnet(phys_iface)
-        
-        
-        # 2. Limpieza y Políticas DROP
-        for cmd in [ipt, ip6t]:
-            subprocess.run(cmd + ["-F"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-X"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-P", "INPUT", "DROP"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-P", "FORWARD", "DROP"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-P", "OUTPUT", "DROP"], check=False, stderr=subprocess.DEVNULL)
+        # Todo el Kill Switch va en un único documento por familia (iptables-restore): se aplica de golpe,
+        # sin un firewall a medio montar entre regla y regla
+        policies = [":INPUT DROP [0:0]", ":FORWARD DROP [0:0]", ":OUTPUT DROP [0:0]", "-F", "-X"]
+        rules_v4 = []
+
+        # 2. Bloqueo DoH/DoT (Anti-Fugas), lo primero de OUTPUT: una regla contra un ipset por familia
+        doh_ipset = False
+        doh_v4, doh_v6 = [], []
+        if block_doh:
+            doh_v4, doh_v6 = load_doh_blocklist(script_dir or os.path.dirname(os.path.realpath(__file__)))
+            safe_print(f"{BLUE}{T('ks_doh', T('ks_doh_count', len(doh_v4) + len(doh_v6)))}{NC}")
+            doh_ipset = bool(which("ipset")) and load_doh_ipsets(doh_v4, doh_v6)
+
+        def doh_rules(use_ipset):
+            if not block_doh: return [], []
+            # Cadena propia, la primera de OUTPUT: recargar la lista solo toca esta cadena
+            chain = [f"-N {IPT_CHAIN_DOH}", f"-A OUTPUT -j {IPT_CHAIN_DOH}"]
+            if use_ipset:
+                return (chain + doh_drop_rules(f"-m set --match-set {IPSET_DOH_V4} dst"),
+                        chain + doh_drop_rules(f"-m set --match-set {IPSET_DOH_V6} dst"))
+            rules_v4, rules_v6 = doh_address_rules(doh_v4, doh_v6)
+            return chain + rules_v4, chain + rules_v6
 
         # 3. Loopback
-        subprocess.run(ipt + ["-A", "INPUT", "-i", "lo", "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-        subprocess.run(ipt + ["-A", "OUTPUT", "-o", "lo", "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
+        rules_v4 += ["-A INPUT -i lo -j ACCEPT", "-A OUTPUT -o lo -j ACCEPT"]
 
         # 4. LAN
         if local_subnet:
@@ -764,60 +1783,63 @@ def manage_kill_switch(phys_iface, tun_iface, action="add", vpn_ip=None, vpn_por
                 # No añadimos reglas ACCEPT, por lo que la política por defecto (DROP) bloqueará la LAN.
             else:
                 safe_print(f"{BLUE}{T('ks_lan', local_subnet)}{NC}")
-                subprocess.run(ipt + ["-A", "INPUT", "-s", local_subnet, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-                subprocess.run(ipt + ["-A", "OUTPUT", "-d", local_subnet, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-
-        # 5. VPN
-        if vpn_ip: #and vpn_port:
-            safe_print(f"{BLUE}{T('ks_vpn', vpn_ip, 'ANY', 'ALL')}{NC}")
-            # Salida permitida
-            subprocess.run(ipt + ["-A", "OUTPUT", "-o", phys_iface, "-d", vpn_ip, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-            # Entrada permitida
-            subprocess.run(ipt + ["-A", "INPUT", "-i", phys_iface, "-s", vpn_ip, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-
-        # 6. Túnel
+                rules_v4 += [f"-A INPUT -s {local_subnet} -j ACCEPT", f"-A OUTPUT -d {local_subnet} -j ACCEPT"]
+
+        # 5. VPN y túnel en cadenas propias: al cambiar de servidor solo se tocan estas (ver sync_kill_switch)
+        # En la fase de preparación van todas las IPs de servidor con las que puede negociar OpenVPN
+        server_ips = [ip for ip in dict.fromkeys([vpn_ip] + list(staged_ips or [])) if ip]
+        for server_ip in server_ips:
+            safe_print(f"{BLUE}{T('ks_vpn', server_ip, 'ANY', 'ALL')}{NC}")
         if tun_iface:
             safe_print(f"{BLUE}{T('ks_tun', tun_iface)}{NC}")
-            subprocess.run(ipt + ["-A", "OUTPUT", "-o", tun_iface, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(ipt + ["-A", "INPUT", "-i", tun_iface, "-j", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-        # 7. Bloqueo DoH (Anti-Fugas)
-        if block_doh:
-            # --- IPv4 ---
-            doh_ips_v4 = ["1.1.1.1", "1.0.0.1", "8.8.8.8", "8.8.4.4", "9.9.9.9", "149.112.112.112"]
-            safe_print(f"{BLUE}{T('ks_doh', 'Cloudflare/Google/Quad9 (IPv4/IPv6)')}{NC}")
-            for ip in doh_ips_v4:
-                subprocess.run(ipt + ["-I", "OUTPUT", "1", "-d", ip, "-p", "tcp", "--dport", "443", "-j", "DROP"], check=False, stderr=subprocess.DEVNULL)
-            
-            # --- IPv6 ---
-            doh_ips_v6 = [
-                "2606:4700:4700::1111", "2606:4700:4700::1001", # Cloudflare
-                "2001:4860:4860::8888", "2001:4860:4860::8844", # Google
-                "2620:fe::fe", "2620:fe::9"                     # Quad9
-            ]
-            for ip in doh_ips_v6:
-                subprocess.run(ip6t + ["-I", "OUTPUT", "1", "-d", ip, "-p", "tcp", "--dport", "443", "-j", "DROP"], check=False, stderr=subprocess.DEVNULL)
-            
-            if script_dir:
-                update_lock_state("doh_blocked", True)
-        
+        rules_v4 += [f"-N {IPT_CHAIN_IN}", f"-N {IPT_CHAIN_OUT}", f"-A INPUT -j {IPT_CHAIN_IN}", f"-A OUTPUT -j {IPT_CHAIN_OUT}"]
+        rules_v4 += vpn_rule_specs(phys_iface, server_ips, [tun_iface] if tun_iface else [])
+
+        def apply_documents(use_ipset):
+            doh_4, doh_6 = doh_rules(use_ipset)
+            return apply_ruleset("iptables-restore", policies + doh_4 + rules_v4) and apply_ruleset("ip6tables-restore", policies + doh_6)
+
         if script_dir:
-            update_lock_state("kill_switch_active", True)
+            # Antes de aplicar: si algo queda a medias, cleanup() sabe qué quitar
+            update_lock_state("firewall_backend", FIREWALL_IPTABLES)
             update_lock_state("firewall_iface", phys_iface)
+        applied = apply_documents(doh_ipset)
+        if not applied and doh_ipset:
+            # Una sola línea mala tumba toda la transacción (p. ej. sin el módulo xt_set): regla a regla
+            doh_ipset = False
+            applied = apply_documents(False)
+        if not applied:
+            safe_print(f"{RED}{T('ks_apply_fail')}{NC}")
+            return False
+
+        if script_dir:
+            if block_doh: update_lock_state("doh_blocked", True)
+            update_lock_state("doh_ipset", doh_ipset)
+            update_lock_state("kill_switch_active", True)
+            # Lo que depende del servidor, para que la reconexión rápida sepa qué cambiar
+            update_lock_state("ks_vpn_ip", vpn_ip)
+            update_lock_state("ks_tun", tun_iface)
+            update_lock_state("ks_staged_ips", server_ips if staged_ips else None)
+        return True
 
     elif action == "del":
         safe_print(f"{BLUE}{T('ks_off')}{NC}")
-        for cmd in [ipt, ip6t]:
-            subprocess.run(cmd + ["-P", "INPUT", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-P", "FORWARD", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-P", "OUTPUT", "ACCEPT"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-F"], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(cmd + ["-X"], check=False, stderr=subprocess.DEVNULL)
+        # Sin backend conocido (p. ej. reparación al arrancar) se limpian los dos
+        if backend != FIREWALL_IPTABLES and which("nft"):
+            priv_op("nft_delete_table")
+        if backend != FIREWALL_NFTABLES:
+            rules = [":INPUT ACCEPT [0:0]", ":FORWARD ACCEPT [0:0]", ":OUTPUT ACCEPT [0:0]", "-F", "-X"]
+            apply_ruleset("iptables-restore", rules)
+            apply_ruleset("ip6tables-restore", rules)
+            # Los ipset DoH ya no tienen reglas que los usen
+            if which("ipset"):
+                priv_op("ipset_destroy")
         
         # Restaurar UFW si estaba activo
         if restore_ufw:
             safe_print(f"{BLUE}Restaurando UFW (Firewall del sistema)...{NC}")
             # --force evita que pida confirmación "y/n"
-            subprocess.run(["sudo", "ufw", "--force", "enable"], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            priv_op("ufw", action="enable")
             
 def backup_original_dns(script_dir, dns_backup_path):
     backup_data = {"timestamp": datetime.now().isoformat(), "interfaces": {}}
@@ -839,42 +1861,19 @@ def backup_original_dns(script_dir, dns_backup_path):
         safe_print(f"{RED}DNS Backup Error: {e}{NC}")
 
 def extract_vpn_dns_from_log(script_dir):
-    log_path = os.path.join(script_dir, LOG_FILE)
-    dns_servers = []
-    if os.path.exists(log_path):
-        try:
-            with open(log_path, 'r', errors='ignore') as f:
-                content = f.read()
-                matches = re.findall(r"dhcp-option DNS ([\d\.]+)", content)
-                if matches: dns_servers.extend(matches)
-                matches_v4 = re.findall(r"net_dns_v4_add:\s+([\d\.]+)", content)
-                if matches_v4: dns_servers.extend(matches_v4)
-        except Exception:
-            pass
-    return list(dict.fromkeys(dns_servers))
+    return list(follow_openvpn_log(os.path.join(script_dir, LOG_FILE)).dns)
 
 def detect_tun_interface_from_log(script_dir):
-    log_path = os.path.join(script_dir, LOG_FILE)
-    if os.path.exists(log_path):
-        try:
-            with open(log_path, 'r', errors='ignore') as f:
-                content = f.read()
-                match = re.search(r"TUN/TAP device (tun\d+) opened", content)
-                if match: return match.group(1)
-        except Exception:
-            pass
-    return None
+    return follow_openvpn_log(os.path.join(script_dir, LOG_FILE)).tun
 
 def apply_dns_arch_native(tun_iface, dns_list, phys_iface, script_dir):
     safe_print(f"{BLUE}{T('arch_apply', tun_iface)}{NC}")
     final_dns = dns_list
     try:
-        subprocess.run(["sudo", "resolvectl", "dns", tun_iface] + final_dns, check=True)
-        subprocess.run(["sudo", "resolvectl", "domain", tun_iface, "~."], check=True)
-        subprocess.run(["sudo", "resolvectl", "default-route", tun_iface, "yes"], check=True)
+        priv_op("resolved_apply", iface=tun_iface, servers=final_dns, check=True)
         if phys_iface:
-             #202#subprocess.run(["sudo", "resolvectl", "dns", phys_iface, ""], check=False, stderr=subprocess.DEVNULL)
-             subprocess.run(["sudo", "resolvectl", "flush-caches"], check=False)
+             #202#sudo_run(["resolvectl", "dns", phys_iface, ""], check=False)
+             priv_op("resolved_flush")
         log_dns_action(script_dir, "ARCH_APPLY", f"Interface: {tun_iface}, DNS: {final_dns}")
         return True
     except Exception as e:
@@ -887,8 +1886,7 @@ def apply_dns_via_nm(tun_iface, dns_list, script_dir):
     dns_str = " ".join(final_dns)
     safe_print(f"{BLUE}Applying DNS to {tun_iface}: {dns_str}{NC}")
     try:
-        cmd = ["sudo", "nmcli", "device", "modify", tun_iface, "ipv4.dns", dns_str, "ipv4.ignore-auto-dns", "yes"]
-        subprocess.run(cmd, check=True, capture_output=True)
+        priv_op("nm_device_dns", iface=tun_iface, servers=final_dns, check=True)
         log_dns_action(script_dir, "APPLY_NM", f"Interface: {tun_iface}, DNS: {dns_str}")
         safe_print(f"{GREEN}{T('dns_apply_success', tun_iface, dns_str)}{NC}")
         return True
@@ -901,20 +1899,30 @@ def prompt_reload_nm(script_dir):
         choice = input(f"{YELLOW}{T('nm_reload_prompt')}{NC}")
         if choice.lower().startswith('s') or choice.lower().startswith('y'):
             safe_print(f"{BLUE}Reloading NetworkManager...{NC}")
-            subprocess.run(["sudo", "service", "NetworkManager", "restart"], check=True)
-            time.sleep(5)
+            priv_op("nm_restart", check=True)
+            wait_until(is_nm_running, NM_RESTART_TIMEOUT)
     except Exception:
         pass
 
 def restore_original_dns_from_backup(script_dir, dns_backup_path):
     if not os.path.exists(dns_backup_path): return
     try:
-        subprocess.run(["sudo", "rm", "-f", dns_backup_path], check=False, stderr=subprocess.DEVNULL)
+        priv_op("remove_file", path=dns_backup_path)
         safe_print(f"{GREEN}{T('dns_restore_ok')}{NC}")
     except Exception as e:
         safe_print(f"{RED}Restore Error: {e}{NC}")
 
 # --- FUNCIONES DE UTILIDAD ---
+def _atomic_write_json(path, data):
+    # Escritura atómica: un cierre a mitad no deja el JSON corrupto (a lo sumo se pierde esta escritura)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        pass
+
 def safe_print(message, dynamic=False):
     subprocess.run(["stty", "sane"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     if dynamic:
@@ -935,6 +1943,85 @@ def is_valid_ip(ip_string):
     if not ip_string: return False
     return re.match(r"^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$", ip_string) is not None
 
+def wait_until(predicate, timeout, interval=READY_POLL_INTERVAL):
+    """Espera a que predicate() se cumpla, como mucho 'timeout' segundos. Retorna si se cumplió."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if predicate(): return True
+        except Exception: pass
+        if time.time() >= deadline: return False
+        time.sleep(interval)
+
+def wait_for_enter(timeout):
+    """Pausa para leer un aviso: termina a los 'timeout' segundos o al pulsar Intro."""
+    try:
+        ready, _, _ = select.select([sys.stdin], [], [], timeout)
+        if ready: sys.stdin.readline()
+    except (OSError, ValueError):
+        time.sleep(timeout)
+
+def is_openvpn_running():
+    return subprocess.run(["pgrep", "-x", "openvpn"], capture_output=True).returncode == 0
+
+def is_openvpn_pid(pid):
+    # El PID podría haberse reutilizado: tiene que seguir siendo OpenVPN
+    try:
+        with open(f"/proc/{pid}/comm", "r") as f: return f.read().strip() == "openvpn"
+    except OSError: return False
+
+def is_primary_openvpn_alive():
+    """Con un túnel de reserva corriendo, 'pgrep openvpn' siempre acierta: se mira el PID del principal."""
+    if MGMT_CLIENT and MGMT_CLIENT.pid: return is_openvpn_pid(MGMT_CLIENT.pid)
+    return is_openvpn_running()
+
+def is_nm_running():
+    res = subprocess.run(["nmcli", "-t", "-f", "RUNNING", "general"], capture_output=True, text=True)
+    return res.returncode == 0 and res.stdout.strip() == "running"
+
+def is_nm_device_settled(iface):
+    # Estados de NM entre 40 (prepare) y 90 (secondaries): todavía está configurando el dispositivo
+    res = subprocess.run(["nmcli", "-g", "GENERAL.STATE", "device", "show", iface], capture_output=True, text=True)
+    match = re.match(r"(\d+)", res.stdout.strip())
+    return res.returncode == 0 and match is not None and not 40 <= int(match.group(1)) < 100
+
+def tunnel_passes_traffic():
+    # Primer paquete de ida y vuelta por el túnel
+    return bool(ping3.ping("8.8.8.8", timeout=1))
+
+def dns_server_answers(server, timeout=DNS_PROBE_TIMEOUT):
+    """
+    Consulta A por un nombre aleatorio directamente a 'server'. Cualquier respuesta (también NXDOMAIN)
+    ha tenido que ir y volver hasta el resolver de verdad, porque ninguna caché conoce ese nombre.
+    """
+    query_id = struct.unpack("!H", os.urandom(2))[0]
+    labels = [os.urandom(6).hex()] + DNS_PROBE_DOMAIN.split(".")
+    question = b"".join(bytes([len(label)]) + label.encode() for label in labels) + b"\0" + struct.pack("!HH", 1, 1)
+    packet = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + question
+    try:
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(packet, (server, 53))
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                data = sock.recv(512)
+                if len(data) >= 4 and struct.unpack("!H", data[:2])[0] == query_id and data[2] & 0x80: return True
+    except OSError:
+        pass
+    return False
+
+def resolver_answers():
+    # Primero los DNS que empuja la VPN; si no hay, los del sistema
+    servers = extract_vpn_dns_from_log(os.path.dirname(os.path.realpath(__file__)))
+    if not servers:
+        try:
+            with open("/etc/resolv.conf", "r") as f:
+                servers = re.findall(r"^nameserver\s+(\S+)", f.read(), re.MULTILINE)
+        except OSError:
+            servers = []
+    return any(dns_server_answers(server) for server in servers[:2])
+
 def get_current_default_route_details():
     try:
         ip_route_output = subprocess.run(["ip", "route", "show", "default"], capture_output=True, text=True).stdout
@@ -947,25 +2034,7 @@ def get_current_default_route_details():
 
 def get_vpn_internal_ip():
     script_dir = os.path.dirname(os.path.realpath(__file__))
-    log_path = os.path.join(script_dir, LOG_FILE)
-    if os.path.exists(log_path):
-        try:
-            with open(log_path, 'r', errors='ignore') as f:
-                content = f.read()
-                # 1. Patrón moderno (Linux/DCO)
-                match = re.search(r"net_addr_v4_add:\s+([0-9.]+)", content)
-                if match: return match.group(1)
-                
-                # 2. Patrón estándar PUSH_REPLY (ifconfig IP MASCARA)
-                match = re.search(r"ifconfig\s+([0-9.]+)\s+[0-9.]+", content)
-                if match: return match.group(1)
-                
-                # 3. Patrón legacy (ip addr add)
-                match = re.search(r"ip\s+addr\s+add\s+([0-9.]+)", content)
-                if match: return match.group(1)
-        except Exception:
-            pass
-    return None
+    return follow_openvpn_log(os.path.join(script_dir, LOG_FILE)).internal_ip()
 
 def get_forwarded_port(internal_ip):
     if not internal_ip: return None
@@ -992,6 +2061,87 @@ def get_forwarded_port(internal_ip):
             else: safe_print(f"{RED}API Error{NC}")
     return "No Disponible"
 
+# --- ORÁCULO DE IP PÚBLICA ---
+class IPv4OnlyAdapter(requests.adapters.HTTPAdapter):
+    """Origen 0.0.0.0: un socket IPv6 no puede enlazarse ahí, así que urllib3 pasa a la dirección IPv4 del servidor."""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = ("0.0.0.0", 0)
+        super().init_poolmanager(*args, **kwargs)
+
+class PublicIPOracle:
+    """
+    IP pública preguntando a varios proveedores a la vez desde una sesión HTTP con keep-alive.
+    Cada proveedor lleva su latencia (EWMA) y sus fallos seguidos: los lentos o caídos bajan
+    en el ranking y dejan de consultarse mientras los demás respondan.
+    """
+    def __init__(self, providers=IP_PROVIDERS, timeout=IP_ORACLE_TIMEOUT):
+        self.providers = list(providers)
+        self.timeout = timeout
+        self.stats = {url: {"latency": None, "failures": 0} for url in self.providers}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.providers))
+        self.session = self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers["User-Agent"] = "curl/8.0" # Algunos devuelven HTML a los navegadores
+        session.mount("https://", IPv4OnlyAdapter()) # Como 'curl -4': is_valid_ip solo acepta IPv4
+        return session
+
+    def reset(self):
+        """Cierra las conexiones keep-alive: tras cambiar la ruta por defecto ya no sirven."""
+        with self.lock:
+            old_session, self.session = self.session, self._new_session()
+        old_session.close()
+
+    def ranked(self):
+        """Primero los sanos, del más rápido al más lento (sin medir cuenta como rápido, para medirlo)."""
+        with self.lock:
+            return sorted(self.providers, key=lambda url: (self.stats[url]["failures"] >= IP_ORACLE_MAX_FAILURES,
+                                                           self.stats[url]["latency"] or 0))
+
+    def _record(self, url, elapsed, ok):
+        with self.lock:
+            stats = self.stats[url]
+            stats["failures"] = 0 if ok else stats["failures"] + 1
+            # Un fallo pesa como una respuesta al límite del timeout
+            sample = elapsed if ok else self.timeout
+            stats["latency"] = sample if stats["latency"] is None else \
+                IP_ORACLE_EWMA_ALPHA * sample + (1 - IP_ORACLE_EWMA_ALPHA) * stats["latency"]
+
+    def _query(self, url):
+        started = time.time()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            ip = response.text.strip() if response.ok else None
+        except requests.RequestException:
+            ip = None
+        ok = is_valid_ip(ip)
+        self._record(url, time.time() - started, ok)
+        return ip if ok else None
+
+    def lookup(self, accept=None, quorum=1):
+        """
+        Consulta a la vez los IP_ORACLE_FANOUT mejores proveedores y retorna la primera IP que cumpla
+        'accept' y la den 'quorum' de ellos, sin esperar a los lentos. Si ninguna lo cumple, la más
+        repetida (para poder informar de ella), o None si nadie ha respondido.
+        """
+        answers = {}
+        futures = [self.pool.submit(self._query, url) for url in self.ranked()[:IP_ORACLE_FANOUT]]
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=self.timeout + 1):
+                ip = future.result()
+                if not ip: continue
+                answers[ip] = answers.get(ip, 0) + 1
+                if answers[ip] >= quorum and (accept is None or accept(ip)): return ip
+        except concurrent.futures.TimeoutError: pass
+        return max(answers, key=answers.get) if answers else None
+
+def public_ip_oracle():
+    global IP_ORACLE
+    if IP_ORACLE is None: IP_ORACLE = PublicIPOracle()
+    return IP_ORACLE
+
 def parse_location_name(filename, config):
     base_name = filename.replace('.ovpn', '')
     if not config.get("display_configured"):
@@ -1013,21 +2163,395 @@ def parse_location_name(filename, config):
     else:
         return parsed_name
 
+def parse_location_country(filename, config):
+    """País del perfil según el formato configurado, o None si el nombre no lo incluye."""
+    if not config.get("display_configured"): return None
+    parts = filename.replace('.ovpn', '').split(config.get("separator", "-"))
+    country_idx = config.get("country_index")
+    return parts[country_idx] if country_idx is not None and 0 <= country_idx < len(parts) else None
+
 # --- FUNCIONES DE ESCANEO Y LATENCIA (NUEVO v207) ---
 
 def get_vpn_host(filepath):
     """Lee el archivo .ovpn y extrae el primer host de la línea 'remote'."""
+    remotes = parse_ovpn_profile(filepath)["remotes"]
+    return remotes[0][0] if remotes else None # Retorna el dominio o IP
+
+def normalize_proto(proto):
+    """'udp4', 'tcp-client', 'TCP6'... -> 'udp' o 'tcp'."""
+    return "tcp" if proto and proto.lower().startswith("tcp") else "udp"
+
+def _read_static_key(text):
+    """Extrae los 256 bytes de una clave 'OpenVPN Static key V1' (tls-auth)."""
+    hex_lines, inside = [], False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("-----BEGIN"): inside = True
+        elif line.startswith("-----END"): break
+        elif inside and line and not line.startswith("#"): hex_lines.append(line)
+    try:
+        key = bytes.fromhex("".join(hex_lines))
+        return key if len(key) == 256 else None
+    except ValueError:
+        return None
+
+def parse_ovpn_profile(filepath):
+    """
+    Lee un .ovpn y devuelve lo necesario para sondearlo:
+    remotes [(host, puerto, proto)], clave tls-auth, dirección, digest 'auth' y si usa tls-crypt.
+    """
+    profile = {"remotes": [], "tls_auth_key": None, "key_direction": None,
+               "auth": "SHA1", "tls_crypt": False, "remote_random": False}
+    default_port, default_proto = OVPN_DEFAULT_PORT, OVPN_DEFAULT_PROTO
+    raw_remotes = []
     try:
         with open(filepath, 'r', errors='ignore') as f:
-            for line in f:
-                parts = line.strip().split()
-                # Busca línea: remote <host> <puerto> <proto>
-                if len(parts) >= 2 and parts[0] == 'remote':
-                    return parts[1] # Retorna el dominio o IP
+            content = f.read()
     except Exception:
+        return profile
+
+    # Bloques en línea: <tls-auth> ... </tls-auth>
+    for tag, body in re.findall(r"<(tls-auth|tls-crypt|tls-crypt-v2)>(.*?)</\1>", content, re.DOTALL):
+        if tag == "tls-auth": profile["tls_auth_key"] = _read_static_key(body)
+        else: profile["tls_crypt"] = True
+    # Bloques <connection>: cada uno trae su 'remote' y puede fijar su propio proto/puerto
+    for block in re.findall(r"<connection>(.*?)</connection>", content, re.DOTALL):
+        block_port = block_proto = None
+        block_remotes = []
+        for line in block.splitlines():
+            parts = line.strip().split()
+            if not parts or parts[0].startswith(("#", ";")): continue
+            if parts[0] == "remote" and len(parts) > 1: block_remotes.append(parts[1:])
+            elif parts[0] == "port" and len(parts) > 1: block_port = parts[1]
+            elif parts[0] == "proto" and len(parts) > 1: block_proto = parts[1]
+        raw_remotes += [(args, block_port, block_proto) for args in block_remotes]
+    content = re.sub(r"<connection>.*?</connection>", "", content, flags=re.DOTALL)
+    # El resto de bloques en línea (claves y certificados) no tienen directivas que nos interesen
+    content = re.sub(r"<(ca|cert|key|extra-certs|pkcs12|dh|secret|crl-verify|tls-[\w-]+)>.*?</\1>", "", content, flags=re.DOTALL)
+
+    for line in content.splitlines():
+        parts = line.strip().split()
+        if not parts or parts[0].startswith(("#", ";")): continue
+        directive, args = parts[0], parts[1:]
+        if directive == "remote" and args:
+            raw_remotes.append((args, None, None))
+        elif directive == "port" and args: default_port = args[0]
+        elif directive == "proto" and args: default_proto = args[0]
+        elif directive == "remote-random": profile["remote_random"] = True
+        elif directive == "key-direction" and args: profile["key_direction"] = args[0]
+        elif directive == "auth" and args: profile["auth"] = args[0]
+        elif directive in ("tls-crypt", "tls-crypt-v2"): profile["tls_crypt"] = True
+        elif directive == "tls-auth" and args and args[0] != "[inline]":
+            key_path = os.path.join(os.path.dirname(filepath), args[0])
+            try:
+                with open(key_path, 'r') as kf: profile["tls_auth_key"] = _read_static_key(kf.read())
+            except Exception: pass
+            if len(args) > 1: profile["key_direction"] = args[1]
+        elif directive == "tls-auth" and len(args) > 1:
+            profile["key_direction"] = args[1]
+
+    for args, block_port, block_proto in raw_remotes:
+        port = args[1] if len(args) > 1 else (block_port or default_port)
+        proto = args[2] if len(args) > 2 else (block_proto or default_proto)
+        profile["remotes"].append((args[0], port, normalize_proto(proto)))
+    return profile
+
+def handshake_hmac_spec(profile):
+    """
+    (clave_hmac, digest) para firmar el HARD_RESET si el perfil usa tls-auth,
+    () si no hace falta firma, o None si no se puede sondear (tls-crypt cifra el canal).
+    """
+    if profile["tls_crypt"]: return None
+    key = profile["tls_auth_key"]
+    if not key: return ()
+    digest = profile["auth"].lower().replace("-", "")
+    try:
+        digest_size = hashlib.new(digest).digest_size
+    except ValueError:
+        return None
+    # Clave bidireccional: se usa la clave 0. key-direction 1 (cliente): enviamos con la clave 1.
+    key_index = 1 if profile["key_direction"] == "1" else 0
+    offset = key_index * 128 + 64
+    return (key[offset:offset + digest_size], digest)
+
+def build_hard_reset_packet(hmac_spec):
+    """Paquete P_CONTROL_HARD_RESET_CLIENT_V2 (key_id 0), firmado con tls-auth si hace falta."""
+    opcode = bytes([P_CONTROL_HARD_RESET_CLIENT_V2 << 3])
+    session_id = os.urandom(8)
+    ack_and_msg_id = b"\x00" + struct.pack("!I", 0) # Sin ACKs, message packet-id 0
+    if not hmac_spec:
+        return opcode + session_id + ack_and_msg_id
+    hmac_key, digest = hmac_spec
+    replay = struct.pack("!II", 1, int(time.time())) # packet-id + net_time (anti-replay)
+    # El HMAC se calcula con el orden 'replay, opcode, session_id, resto' (swap_hmac de OpenVPN)
+    signature = hmac.new(hmac_key, replay + opcode + session_id + ack_and_msg_id, digest).digest()
+    return opcode + session_id + signature + replay + ack_and_msg_id
+
+def resolve_host(host):
+    """Resuelve un host a su primera dirección IPv4 (None si falla)."""
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_DGRAM)
+        if infos: return infos[0][4][0]
+    except (socket.gaierror, UnicodeError, OSError):
         pass
     return None
 
+class ResolverCache:
+    """
+    Caché DNS con TTL compartida por los escaneos y establish_connection.
+    Los fallos también se guardan (con un TTL corto) para no repetir timeouts de resolución.
+    """
+    def __init__(self, ttl=RESOLVER_CACHE_TTL, negative_ttl=RESOLVER_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}  # host -> (ip o None, caduca_en)
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        """Retorna la IP cacheada (aunque haya caducado) o None."""
+        with self.lock:
+            entry = self.entries.get(host)
+        return entry[0] if entry else None
+
+    def _fresh(self, host):
+        with self.lock:
+            entry = self.entries.get(host)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def _store(self, host, ip):
+        ttl = self.ttl if ip else self.negative_ttl
+        with self.lock:
+            # Un fallo puntual no borra la última IP buena conocida
+            if not ip and host in self.entries and self.entries[host][0]:
+                ip = self.entries[host][0]
+            self.entries[host] = (ip, time.monotonic() + ttl)
+
+    def resolve(self, host):
+        if not host: return None
+        if is_valid_ip(host): return host
+        if not self._fresh(host):
+            self._store(host, resolve_host(host))
+        return self.get(host)
+
+    def resolve_many(self, hosts, workers=RESOLVE_WORKERS):
+        """Resuelve a la vez todos los hosts únicos que no estén en caché. Retorna {host: ip}."""
+        unique_hosts = {h for h in hosts if h}
+        missing = [h for h in unique_hosts if not is_valid_ip(h) and not self._fresh(h)]
+        if missing:
+            # La resolución DNS es bloqueante (getaddrinfo), así que la hacemos en paralelo
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+                future_to_host = {executor.submit(resolve_host, h): h for h in missing}
+                for future in concurrent.futures.as_completed(future_to_host):
+                    self._store(future_to_host[future], future.result())
+        return {h: self.resolve(h) for h in unique_hosts}
+
+RESOLVER_CACHE = ResolverCache()
+
+def _icmp_checksum(data):
+    if len(data) % 2: data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def _open_icmp_socket():
+    """
+    Abre UN socket ICMP no bloqueante para todo el escaneo.
+    Primero prueba el 'ping socket' sin privilegios (SOCK_DGRAM, net.ipv4.ping_group_range)
+    y si no está permitido, un socket RAW. Retorna (socket, es_raw) o (None, False).
+    """
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+            sock.setblocking(False)
+            return sock, sock_type == socket.SOCK_RAW
+        except OSError:
+            continue
+    return None, False
+
+def icmp_probe_many(addresses, count=1, interval=0.0, timeout=ICMP_SCAN_TIMEOUT, on_complete=None):
+    """
+    Motor de escaneo ICMP (v211): envía 'count' Echo Request a cada IP (separados 'interval' s)
+    desde un único socket y empareja las respuestas por id/secuencia en un bucle epoll.
+    El tiempo total es ~(count-1)*interval + timeout sin importar cuántos hosts haya.
+    on_complete(ip, muestras) se llama en cuanto una IP ha respondido a todas sus sondas.
+    Retorna un diccionario con las muestras recibidas: {'1.2.3.4': [45.2, 46.0], '5.6.7.8': []}
+    """
+    samples = {ip: [] for ip in addresses if ip}
+    if not samples: return samples
+
+    sock, is_raw = _open_icmp_socket()
+    if sock is None: return samples
+
+    # En sockets DGRAM el kernel reescribe el id con el 'puerto' del socket y filtra por él;
+    # en RAW lo ponemos nosotros y filtramos a mano.
+    ident = os.getpid() & 0xFFFF
+    start = time.monotonic()
+    # Cola de envíos planificados por rondas: (instante, ip)
+    send_queue = [(start + r * interval, ip) for r in range(count) for ip in samples]
+    pending = {}   # seq -> (ip, instante de envío)
+    seq = 0
+    deadline = start + (count - 1) * interval + timeout
+    ep = select.epoll()
+    registered = select.EPOLLIN | select.EPOLLOUT
+    try:
+        ep.register(sock.fileno(), registered)
+        while (send_queue or pending) and time.monotonic() < deadline:
+            now = time.monotonic()
+            due = bool(send_queue) and send_queue[0][0] <= now
+            # Solo pedimos EPOLLOUT cuando hay algo que enviar (si no, epoll volvería al instante)
+            wanted = select.EPOLLIN | (select.EPOLLOUT if due else 0)
+            if wanted != registered:
+                ep.modify(sock.fileno(), wanted)
+                registered = wanted
+            wait = deadline - now
+            if send_queue and not due: wait = min(wait, send_queue[0][0] - now)
+
+            for _, events in ep.poll(max(0.0, wait)):
+                # 1. Envío: todo lo que ya toca, mientras el buffer del socket lo permita
+                if events & select.EPOLLOUT:
+                    while send_queue and send_queue[0][0] <= time.monotonic():
+                        ip = send_queue[0][1]
+                        seq = (seq + 1) & 0xFFFF
+                        checksum = _icmp_checksum(struct.pack("!BBHHH", 8, 0, 0, ident, seq) + ICMP_PAYLOAD)
+                        packet = struct.pack("!BBHHH", 8, 0, checksum, ident, seq) + ICMP_PAYLOAD
+                        try:
+                            sock.sendto(packet, (ip, 0))
+                        except BlockingIOError:
+                            break
+                        except OSError:
+                            send_queue.pop(0) # Red inalcanzable, etc.: cuenta como pérdida
+                            continue
+                        send_queue.pop(0)
+                        pending[seq] = (ip, time.monotonic())
+                        # Cada envío garantiza su timeout completo aunque el buffer nos haya retrasado
+                        deadline = max(deadline, pending[seq][1] + timeout)
+
+                # 2. Recepción: leemos todas las respuestas disponibles
+                if events & select.EPOLLIN:
+                    while True:
+                        try:
+                            data, addr = sock.recvfrom(2048)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError:
+                            break
+                        received_at = time.monotonic()
+                        if is_raw: data = data[(data[0] & 0x0F) * 4:] # Quitamos la cabecera IP
+                        if len(data) < 8: continue
+                        icmp_type, _, _, r_id, r_seq = struct.unpack("!BBHHH", data[:8])
+                        if icmp_type != 0: continue # Solo Echo Reply
+                        if is_raw and r_id != ident: continue
+                        entry = pending.get(r_seq)
+                        if not entry or entry[0] != addr[0]: continue
+                        del pending[r_seq]
+                        samples[entry[0]].append((received_at - entry[1]) * 1000)
+                        if on_complete and len(samples[entry[0]]) == count:
+                            on_complete(entry[0], samples[entry[0]])
+    except OSError:
+        pass
+    finally:
+        ep.close()
+        sock.close()
+    return samples
+
+def icmp_ping_many(addresses, timeout=ICMP_SCAN_TIMEOUT):
+    """Un solo Echo Request por IP. Retorna {'1.2.3.4': 45.2, '5.6.7.8': None}"""
+    return {ip: (rtts[0] if rtts else None) for ip, rtts in icmp_probe_many(addresses, timeout=timeout).items()}
+
+def compute_latency_stats(rtts, sent):
+    """
+    Resume las muestras de un host: min/mediana/p95, jitter (media de la diferencia
+    entre muestras consecutivas), pérdida (0.0-1.0) y una puntuación combinada
+    (menor es mejor). Retorna None si no llegó ninguna respuesta.
+    """
+    if not rtts or sent <= 0: return None
+    ordered = sorted(rtts)
+    n = len(ordered)
+    mid = n // 2
+    p50 = (ordered[mid - 1] + ordered[mid]) / 2 if n % 2 == 0 else ordered[mid]
+    p95 = ordered[-(-95 * n // 100) - 1] # Rango más cercano: ceil(0.95 * n)
+    jitter = sum(abs(rtts[i] - rtts[i - 1]) for i in range(1, n)) / (n - 1) if n > 1 else 0.0
+    loss = max(0.0, 1 - n / sent)
+    score = p50 + SCORE_JITTER_WEIGHT * jitter + SCORE_LOSS_PENALTY * loss
+    return {"min": ordered[0], "p50": p50, "p95": p95, "jitter": jitter,
+            "loss": loss, "score": score, "sent": sent, "received": n}
+
+def openvpn_probe_many(targets, timeout=HANDSHAKE_TIMEOUT, on_result=None):
+    """
+    Sonda del servicio real: {clave: (ip, puerto, proto, hmac_spec)} -> {clave: ms o None}.
+    UDP: envía un HARD_RESET_CLIENT_V2 desde un único socket y mide hasta el HARD_RESET_SERVER_V2.
+    TCP: mide el connect(). Todo en un bucle epoll, ~timeout en total.
+    on_result(clave, ms) se llama con cada respuesta según llega.
+    """
+    results = {key: None for key in targets}
+    if not targets: return results
+    ep = select.epoll()
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setblocking(False)
+    ep.register(udp.fileno(), select.EPOLLIN)
+    udp_pending = {}  # (ip, puerto) -> ([claves], instante de envío)
+    tcp_pending = {}  # fd -> (clave, socket, instante de inicio)
+    try:
+        for key, (ip, port, proto, hmac_spec) in targets.items():
+            try: port = int(port)
+            except (TypeError, ValueError): continue
+            if proto == "tcp":
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                started = time.monotonic()
+                if sock.connect_ex((ip, port)) not in (0, errno.EINPROGRESS):
+                    sock.close()
+                    continue
+                ep.register(sock.fileno(), select.EPOLLOUT)
+                tcp_pending[sock.fileno()] = (key, sock, started)
+            else:
+                if (ip, port) in udp_pending: # Mismo servidor con otra clave: comparte respuesta
+                    udp_pending[(ip, port)][0].append(key)
+                    continue
+                packet = build_hard_reset_packet(hmac_spec)
+                for _ in range(2):
+                    try:
+                        udp.sendto(packet, (ip, port))
+                        udp_pending[(ip, port)] = ([key], time.monotonic())
+                        break
+                    except BlockingIOError:
+                        select.select([], [udp], [], 0.05) # Buffer lleno: esperamos un momento
+                    except OSError:
+                        break
+
+        deadline = time.monotonic() + timeout
+        while (udp_pending or tcp_pending) and time.monotonic() < deadline:
+            for fd, events in ep.poll(max(0.0, deadline - time.monotonic())):
+                if fd == udp.fileno():
+                    while True:
+                        try:
+                            data, addr = udp.recvfrom(2048)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError:
+                            break
+                        entry = udp_pending.get(addr[:2])
+                        if not entry or not data or (data[0] >> 3) != P_CONTROL_HARD_RESET_SERVER_V2: continue
+                        del udp_pending[addr[:2]]
+                        for key in entry[0]:
+                            results[key] = (time.monotonic() - entry[1]) * 1000
+                            if on_result: on_result(key, results[key])
+                elif fd in tcp_pending:
+                    key, sock, started = tcp_pending.pop(fd)
+                    ep.unregister(fd)
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0 and not events & select.EPOLLERR:
+                        results[key] = (time.monotonic() - started) * 1000
+                        if on_result: on_result(key, results[key])
+                    sock.close()
+    except OSError:
+        pass
+    finally:
+        for _, sock, _ in tcp_pending.values(): sock.close()
+        ep.close()
+        udp.close()
+    return results
+
 def measure_latency(file_path, script_dir):
     """Mide la latencia de un archivo .ovpn específico."""
     full_path = os.path.join(script_dir, file_path)
@@ -1035,46 +2559,400 @@ def measure_latency(file_path, script_dir):
     
     if not host:
         return file_path, None # No se encontró host
-        
-    try:
-        # Timeout corto (1.5s) para no frenar el proceso si un server está muerto
-        delay = ping3.ping(host, timeout=1.5, unit='ms')
-        return file_path, delay
-    except Exception:
+
+    ip = RESOLVER_CACHE.resolve(host)
+    if not ip:
         return file_path, None
+    return file_path, icmp_ping_many([ip]).get(ip)
+
+def _chunks(items, size):
+    items = list(items)
+    if not size or size <= 0: return [items]
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
-def scan_latencies_parallel(file_list, script_dir):
+def scan_latencies_parallel(file_list, script_dir, count=SCAN_SAMPLES, interval=SCAN_SAMPLE_INTERVAL, method=SCAN_METHOD_HANDSHAKE,
+                            on_result=None, timeout=None, concurrency=None, cancel=None):
     """
-    Ejecuta pings en paralelo a todos los archivos.
-    Retorna un diccionario: {'archivo.ovpn': 45.2, 'otro.ovpn': None}
+    Mide todos los archivos. Con method='handshake' se sondea el propio servicio OpenVPN
+    (puerto/proto de cada 'remote') y ICMP queda como respaldo para los perfiles que no se
+    pueden sondear o no contestan. ICMP usa el motor epoll, 'count' sondas por host.
+    Se sondean TODOS los 'remote' de cada perfil en paralelo; el perfil se queda con el mejor
+    y lo guarda en 'endpoint' (host, puerto, proto) para conectar primero a él.
+    Los perfiles que comparten servidor se agrupan: cada host se resuelve y se mide una sola vez
+    y el resultado se reparte a todos sus archivos.
+    on_result(archivo, stats) publica los resultados según llegan (puede repetirse si mejora).
+    timeout sustituye al de cada sonda; concurrency limita los servidores sondeados a la vez
+    (y los hilos de resolución). Sin límite, todo sale en una sola tanda.
+    cancel (threading.Event): una vez activado no se lanzan más rondas ni tandas.
+    Retorna un diccionario: {'archivo.ovpn': {'p50': 45.2, 'loss': 0.0, ...}, 'otro.ovpn': None}
     """
+    profiles = {f: parse_ovpn_profile(os.path.join(script_dir, f)) for f in file_list}
+    host_to_ip = RESOLVER_CACHE.resolve_many((host for p in profiles.values() for host, _, _ in p["remotes"]),
+                                             workers=concurrency or RESOLVE_WORKERS)
     results = {}
-    # Usamos 20 hilos simultáneos para ir muy rápido
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-        # Lanzamos todas las tareas
-        future_to_file = {
-            executor.submit(measure_latency, f, script_dir): f 
-            for f in file_list
-        }
-        
-        # Recogemos resultados conforme llegan
-        for future in concurrent.futures.as_completed(future_to_file):
-            f_name, delay = future.result()
-            results[f_name] = delay
-            
+
+    def publish(f, stats):
+        # Nos quedamos con el mejor endpoint visto hasta ahora
+        if f in results and results[f] and results[f]["score"] <= stats["score"]: return
+        results[f] = stats
+        if on_result: on_result(f, stats)
+
+    # 1. Handshake OpenVPN (mide lo que de verdad predice el tiempo de conexión)
+    if method == SCAN_METHOD_HANDSHAKE:
+        targets, target_files = {}, {}
+        for f, profile in profiles.items():
+            hmac_spec = handshake_hmac_spec(profile)
+            if hmac_spec is None: continue
+            for endpoint in profile["remotes"]:
+                ip = host_to_ip.get(endpoint[0])
+                if not ip: continue
+                target = (ip, endpoint[1], endpoint[2], hmac_spec)
+                targets[target] = target
+                target_files.setdefault(target, []).append((f, endpoint))
+
+        # 'count' rondas de handshakes separadas 'interval' s, cada una con su socket: como en ICMP,
+        # ~(count-1)*interval + timeout en total, y jitter/pérdida salen de muestras reales
+        handshake_rtts, lock = {}, threading.Lock()
+
+        def publish_handshake(target):
+            for f, endpoint in target_files[target]:
+                publish(f, dict(compute_latency_stats(handshake_rtts[target], count), method=SCAN_METHOD_HANDSHAKE, endpoint=list(endpoint)))
+
+        def on_handshake(target, rtt):
+            with lock:
+                handshake_rtts.setdefault(target, []).append(rtt)
+                if len(handshake_rtts[target]) == count: publish_handshake(target)
+
+        for batch in _chunks(targets, concurrency):
+            batch_targets = {t: targets[t] for t in batch}
+            rounds = []
+            for i in range(count):
+                if cancel and cancel.is_set(): break
+                if i: time.sleep(interval)
+                rounds.append(threading.Thread(target=openvpn_probe_many, args=(batch_targets,),
+                                               kwargs={"timeout": timeout or HANDSHAKE_TIMEOUT, "on_result": on_handshake}, daemon=True))
+                rounds[-1].start()
+            for thread in rounds: thread.join()
+        # Los que perdieron alguna ronda no llegan a 'completarse': se publican al terminar
+        with lock:
+            for target, rtts in handshake_rtts.items():
+                if len(rtts) < count: publish_handshake(target)
+
+    # 2. ICMP (respaldo, o método único)
+    icmp_files = [f for f in file_list if f not in results]
+    ip_files = {}
+    for f in icmp_files:
+        for endpoint in profiles[f]["remotes"]:
+            if host_to_ip.get(endpoint[0]):
+                ip_files.setdefault(host_to_ip[endpoint[0]], []).append((f, endpoint))
+
+    def on_icmp(ip, rtts):
+        for f, endpoint in ip_files[ip]:
+            publish(f, dict(compute_latency_stats(rtts, count), method=SCAN_METHOD_ICMP, endpoint=list(endpoint)))
+    samples = {}
+    for batch in _chunks(ip_files, concurrency):
+        if cancel and cancel.is_set(): break
+        samples.update(icmp_probe_many(batch, count=count, interval=interval,
+                                       timeout=timeout or ICMP_SCAN_TIMEOUT, on_complete=on_icmp))
+
+    # Los hosts con pérdidas no llegan a 'completarse': se publican al terminar
+    for ip, rtts in samples.items():
+        if rtts and len(rtts) < count:
+            on_icmp(ip, rtts)
+    for f in file_list:
+        results.setdefault(f, None)
     return results
 
+def select_fastest_endpoint(selected_file, script_dir, config_mgr):
+    """
+    Para perfiles con varios 'remote': el endpoint vivo más rápido (host, puerto, proto) según el
+    historial, si es reciente. No sondea: conectar no espera a un escaneo (de eso se encarga el menú).
+    """
+    profile = parse_ovpn_profile(os.path.join(script_dir, selected_file))
+    if len(profile["remotes"]) < 2: return None
+    stats = LatencyHistory(script_dir).fresh_stats(selected_file, config_mgr.get_history_ttl())
+    if stats and stats.get("endpoint"):
+        return tuple(stats["endpoint"])
+    return None
+
+def format_scan_stats(stats, with_p95=False):
+    """Texto corto de una medición: '45ms ±3 5%' (pérdida en rojo si la hay)."""
+    if not stats: return f"{RED}N/A{NC}"
+    loss_pct = int(round(stats["loss"] * 100))
+    loss_color = GREEN if loss_pct == 0 else (YELLOW if loss_pct < LOSS_WARN_PERCENT else RED)
+    text = f"{GREEN}{int(stats['p50'])}ms{NC}"
+    if with_p95: text += f" p95 {int(stats['p95'])}"
+    text += f" ±{int(round(stats['jitter']))} {loss_color}{loss_pct}%{NC}"
+    return text
+
+def rank_scan_results(ovpn_files, results, config):
+    """
+    Ordena los perfiles por puntuación combinada (latencia + jitter + pérdida).
+    Retorna (sorted_files, down_files, top_stats), el estado que pinta el menú:
+    down_files mapea cada archivo sin respuesta o con pérdidas a su resumen.
+    """
+    combined = []
+    down_files = {}
+    for f in ovpn_files:
+        stats = results.get(f)
+        if f not in results:
+            sort_val = 9998 # Sin medir todavía: tras los medidos, pero sin marcar como caído
+        elif stats is None:
+            sort_val = 9999 # Al final de la lista
+            down_files[f] = None
+        else:
+            sort_val = stats["score"]
+            if stats["loss"] > 0:
+                down_files[f] = stats
+        combined.append((sort_val, f, stats))
+
+    # Menor puntuación primero
+    combined.sort(key=lambda x: x[0])
+    sorted_files = [x[1] for x in combined]
+
+    # Top 3 (Diseño: Top 3 verde, Nombres blanco/amarillo, Ping verde sin paréntesis)
+    top_list_formatted = []
+    last_profile_chk = config.get("last_profile") # Para saber cuál pintar de amarillo
+    for _, f, stats in combined[:3]:
+        if stats is not None:
+            clean_name = parse_location_name(f, config)
+            c_name = YELLOW if f == last_profile_chk else NC
+            top_list_formatted.append(f"{c_name}{clean_name}{NC} {format_scan_stats(stats)}")
+
+    if top_list_formatted:
+        top_stats = f"{GREEN}Top 3:{NC} {' | '.join(top_list_formatted)}"
+    else:
+        top_stats = f"{GREEN}Top 3:{NC} {RED}{T('scan_no_reply')}{NC}"
+    return sorted_files, down_files, top_stats
+
+# --- HISTORIAL PERSISTENTE DE LATENCIAS (v211) ---
+class LatencyHistory:
+    """
+    Guarda los resultados de los escaneos junto a config.json con una puntuación
+    EWMA por servidor, para que el menú arranque ya ordenado.
+    """
+    def __init__(self, script_dir):
+        self.history_path = os.path.join(script_dir, HISTORY_FILE)
+        self.lock = threading.Lock()
+        self.servers = self.load_history()
+
+    def load_history(self):
+        if os.path.exists(self.history_path):
+            try:
+                with open(self.history_path, 'r') as f:
+                    return json.load(f).get("servers", {})
+            except Exception:
+                pass
+        return {}
+
+    def save_history(self):
+        _atomic_write_json(self.history_path, {"servers": self.servers})
+
+    def record(self, results):
+        """Incorpora un escaneo {'archivo.ovpn': stats o None} y guarda el historial."""
+        now = time.time()
+        with self.lock:
+            for f, stats in results.items():
+                observed = stats["score"] if stats else HISTORY_DOWN_SCORE
+                prev = self.servers.get(f)
+                if prev:
+                    ewma = HISTORY_EWMA_ALPHA * observed + (1 - HISTORY_EWMA_ALPHA) * prev["ewma"]
+                else:
+                    ewma = observed
+                self.servers[f] = {"ewma": ewma, "last": stats, "updated": now,
+                                   "count": (prev["count"] + 1) if prev else 1}
+            self.save_history()
+
+    def has_data(self):
+        with self.lock:
+            return bool(self.servers)
+
+    def results_for(self, files):
+        """Resultados listos para rank_scan_results, con la puntuación EWMA en lugar de la última."""
+        results = {}
+        with self.lock:
+            for f in files:
+                entry = self.servers.get(f)
+                if not entry: continue
+                # Si la última medición no respondió, se considera caído aunque su media sea buena
+                results[f] = dict(entry["last"], score=entry["ewma"]) if entry["last"] else None
+        return results
+
+    def fresh_stats(self, f, ttl):
+        """Última medición de un archivo si es más reciente que el TTL (None si no)."""
+        with self.lock:
+            entry = self.servers.get(f)
+        if entry and entry["last"] and time.time() - entry["updated"] <= ttl:
+            return entry["last"]
+        return None
+
+    def stale_files(self, files, ttl):
+        now = time.time()
+        with self.lock:
+            return [f for f in files if f not in self.servers or now - self.servers[f]["updated"] > ttl]
+
+class KnownGoodServers:
+    """
+    Último servidor (IP, puerto, proto) con el que conectó cada perfil: el 'last-known-good'.
+    Se guarda junto a config.json para arrancar OpenVPN sin depender del DNS.
+    """
+    def __init__(self, script_dir):
+        self.path = os.path.join(script_dir, KNOWN_GOOD_FILE)
+        self.servers = self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f).get("servers", {})
+            except Exception:
+                pass
+        return {}
+
+    def save(self):
+        _atomic_write_json(self.path, {"servers": self.servers})
+
+    def get(self, ovpn_file):
+        entry = self.servers.get(ovpn_file)
+        return (entry["ip"], entry["port"], entry["proto"]) if entry else None
+
+    def record(self, ovpn_file, ip, port, proto):
+        if not ip or not is_valid_ip(ip): return
+        self.servers[ovpn_file] = {"ip": ip, "port": port or OVPN_DEFAULT_PORT, "proto": proto or OVPN_DEFAULT_PROTO, "updated": time.time()}
+        self.save()
+
+def remember_known_good(script_dir, ovpn_file):
+    """Guarda el servidor con el que acaba de conectar el perfil (según el log)."""
+    KnownGoodServers(script_dir).record(ovpn_file, *extract_connection_details(script_dir))
+
+def preresolved_remotes(ovpn_file, script_dir, config_mgr, resolve=True):
+    """
+    Endpoints del perfil ya resueltos a IP, por prioridad: el último que conectó (last-known-good),
+    el más rápido según el historial y el resto de 'remote'. Con resolve=False solo se usa la caché
+    (Kill Switch puesto: no hay DNS fuera del túnel). Si el perfil lleva 'remote-random', se respeta
+    su orden: lo baraja OpenVPN.
+    """
+    profile = parse_ovpn_profile(os.path.join(script_dir, ovpn_file))
+    candidates, fastest = [], None
+    if not profile["remote_random"]:
+        known_good = KnownGoodServers(script_dir).get(ovpn_file)
+        if known_good: candidates.append(known_good)
+        fastest = select_fastest_endpoint(ovpn_file, script_dir, config_mgr)
+    for host, port, proto in ([fastest] if fastest else []) + profile["remotes"]:
+        ip = RESOLVER_CACHE.resolve(host) if resolve else (host if is_valid_ip(host) else RESOLVER_CACHE.get(host))
+        if ip: candidates.append((ip, port, proto))
+    return list(dict.fromkeys(candidates))
+
+def remote_override_args(endpoints):
+    """
+    '--remote IP puerto proto' por cada endpoint (van antes que los 'remote' del perfil, que quedan
+    como respaldo por nombre). Con server-poll-timeout corto, una IP muerta no se come todo el intento.
+    """
+    args = []
+    for ip, port, proto in endpoints[:PRERESOLVED_MAX_REMOTES]:
+        args += ["--remote", ip, port, proto]
+    if args: args += ["--server-poll-timeout", str(PRERESOLVED_POLL_TIMEOUT)]
+    return args
+
+class LiveScan:
+    """
+    Escaneo en segundo plano que va publicando resultados para que el menú
+    se redibuje según llegan. Al terminar los guarda en el historial.
+    """
+    def __init__(self, files, script_dir, method, history):
+        self.files = list(files)
+        self.script_dir = script_dir
+        self.method = method
+        self.history = history
+        self.results = {}
+        self.pending = set(self.files)
+        self.lock = threading.Lock()
+        self.changed = threading.Event()  # Hay resultados nuevos sin pintar
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.last_redraw = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _on_result(self, f, stats):
+        with self.lock:
+            if self.cancelled.is_set(): return
+            self.results[f] = stats
+            self.pending.discard(f)
+        self.changed.set()
+
+    def _run(self):
+        try:
+            final = scan_latencies_parallel(self.files, self.script_dir, method=self.method, on_result=self._on_result,
+                                            cancel=self.cancelled)
+            with self.lock:
+                # Cancelado: solo vale lo medido antes (lo de después pasó por el firewall de la conexión)
+                if not self.cancelled.is_set(): self.results = final
+                measured = dict(self.results)
+            self.history.record(measured)
+        finally:
+            with self.lock:
+                self.pending.clear()
+            self.done.set()
+            self.changed.set()
+
+    def cancel(self, timeout=LIVE_SCAN_CANCEL_TIMEOUT):
+        """Para el escaneo antes de tocar la red (p. ej. al conectar) y espera a las sondas en vuelo."""
+        with self.lock:
+            self.cancelled.set()
+        self.done.wait(timeout)
+
+    def is_running(self):
+        return not self.done.is_set() and not self.cancelled.is_set()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.results), set(self.pending)
+
+def build_failover_candidates(current_file, script_dir, config_mgr):
+    """
+    Servidores a probar al reconectar: primero el actual y después los mejores del historial
+    (el último escaneo también se guarda ahí), sin los caídos y, si se pide, del mismo país.
+    """
+    all_files = sorted(f for f in os.listdir(script_dir) if f.endswith(".ovpn"))
+    results = LatencyHistory(script_dir).results_for(all_files)
+    ranked, down_files, _ = rank_scan_results(all_files, results, config_mgr.config) if results else (all_files, {}, None)
+    country = parse_location_country(current_file, config_mgr.config) if config_mgr.get_failover_same_country() else None
+    candidates = [current_file]
+    for f in ranked:
+        if len(candidates) >= FAILOVER_MAX_SERVERS: break
+        if f == current_file or (f in down_files and down_files[f] is None): continue
+        if country and parse_location_country(f, config_mgr.config) != country: continue
+        candidates.append(f)
+    return candidates
+
+def refresh_history_async(history, files, script_dir, ttl, method=SCAN_METHOD_HANDSHAKE):
+    """Re-escanea en segundo plano solo los servidores con datos más viejos que el TTL."""
+    stale = history.stale_files(files, ttl)
+    if not stale: return None
+    return LiveScan(stale, script_dir, method, history).start()
+
 def cleanup(is_failure=False, state_override=None):
-    global ORIGINAL_DEFAULT_ROUTE_DETAILS
+    global ORIGINAL_DEFAULT_ROUTE_DETAILS, MGMT_CLIENT, STANDBY
+    # Dentro de una conexión fallida sus tramos van a esa misma línea de tiempo; si no, a una propia
+    own_timeline = None if TIMELINE and not TIMELINE.finished else start_timeline("cleanup")
+    timeline_phase("cleanup_openvpn")
     
     safe_print(f"\n{YELLOW}{T('clean_start')}{NC}")
-    subprocess.run(["sudo", "killall", "-q", "openvpn"], check=False, stderr=subprocess.DEVNULL) # <--- MATA EL PROCESO ZOMBIE
+    priv_op("openvpn_kill_all") # <--- MATA EL PROCESO ZOMBIE
+    if MGMT_CLIENT:
+        MGMT_CLIENT.close()
+        MGMT_CLIENT = None
+    STANDBY = None # 'killall' ya se ha llevado también la reserva
     script_dir = os.path.dirname(os.path.realpath(__file__))
 
     state_data = state_override if state_override is not None else get_lock_state()
     actions = state_data.get("actions", {}) if state_data else {}
 
     # 1. FIREWALL & KILL SWITCH
+    timeline_phase("cleanup_firewall")
     fw_iface = actions.get("firewall_iface")
     ufw_was_active = actions.get("ufw_was_active", False)
     doh_was_blocked = actions.get("doh_blocked", False)
@@ -1085,7 +2963,8 @@ def cleanup(is_failure=False, state_override=None):
     interfaces_to_clean = {fw_iface, cached_iface} - {None}
     
     # Comprobamos si realmente activamos el bloqueo antes de intentar limpiar nada
-    was_ks_active = actions.get("kill_switch_active", False)
+    # (firewall_iface se apunta antes de aplicar: cubre también una transacción que falló a medias)
+    was_ks_active = actions.get("kill_switch_active", False) or bool(actions.get("firewall_iface"))
 
     if was_ks_active or ufw_was_active:
         # Si hay que limpiar (KS activo) pero no hay interfaces detectadas, forzamos None para limpieza global
@@ -1093,28 +2972,30 @@ def cleanup(is_failure=False, state_override=None):
         
         # 1. Limpiamos reglas (IPTABLES FLUSH) sin tocar UFW todavía
         for iface in interfaces_to_clean:
-            manage_kill_switch(iface, None, action="del", restore_ufw=False)
+            manage_kill_switch(iface, None, action="del", restore_ufw=False, backend=actions.get("firewall_backend", FIREWALL_IPTABLES))
 
         # 2. Restauramos UFW una sola vez al final (si corresponde)
         if ufw_was_active:
             safe_print(f"{BLUE}{T('ufw_restore')}{NC}")
-            subprocess.run(["sudo", "ufw", "--force", "enable"], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            priv_op("ufw", action="enable")
         elif iptables_backed_up:
             safe_print(f"{BLUE}{T('ipt_restore')}{NC}")
             try:
-                v4_path = os.path.join(script_dir, IPT_V4_BACKUP)
-                v6_path = os.path.join(script_dir, IPT_V6_BACKUP)
-                if os.path.exists(v4_path):
-                    with open(v4_path, "r") as f: subprocess.run(["sudo", "iptables-restore"], stdin=f, check=False)
-                if os.path.exists(v6_path):
-                    with open(v6_path, "r") as f: subprocess.run(["sudo", "ip6tables-restore"], stdin=f, check=False)
+                if os.path.exists(os.path.join(script_dir, IPT_V4_BACKUP)): priv_op("ipt_restore_backup", family=4)
+                if os.path.exists(os.path.join(script_dir, IPT_V6_BACKUP)): priv_op("ipt_restore_backup", family=6)
             except Exception: pass
             
+    # 2. RUTA AL SERVIDOR (modo carrera, OpenVPN con --route-noexec)
+    timeline_phase("cleanup_routes")
+    for route_key in ("server_route", "standby_route"):
+        if actions.get(route_key):
+            priv_op("route", action="del", spec=route_selector(actions[route_key]))
+
     # 3. DNS & NETWORK
+    timeline_phase("cleanup_network")
     if actions.get("resolv_locked"):
         safe_print(f"{BLUE}  > Desbloqueando /etc/resolv.conf...{NC}")
-        subprocess.run(["sudo", "chattr", "-i", "/etc/resolv.conf"], check=False, stderr=subprocess.DEVNULL)
-        subprocess.run(["sudo", "mv", "/etc/resolv.conf.bak", "/etc/resolv.conf"], check=False, stderr=subprocess.DEVNULL)
+        priv_op("resolv_restore")
 
     nm_conn = actions.get("nm_connection")
     arch_dns = actions.get("arch_dns")
@@ -1127,8 +3008,8 @@ def cleanup(is_failure=False, state_override=None):
         if is_systemd_resolved_active():
             safe_print(f"{BLUE}{T('clean_dns_rev')}{NC}")
             if fw_iface:
-                subprocess.run(["sudo", "resolvectl", "revert", fw_iface], check=False, stderr=subprocess.DEVNULL)
-            subprocess.run(["sudo", "resolvectl", "flush-caches"], check=False, stderr=subprocess.DEVNULL)
+                priv_op("resolved_revert", iface=fw_iface)
+            priv_op("resolved_flush")
 
         # B. NetworkManager Restore
         if nm_conn:
@@ -1143,11 +3024,10 @@ def cleanup(is_failure=False, state_override=None):
                 val_v4_ignore = orig_state.get("ipv4.ignore-auto-routes", "no")
                 val_v6_method = orig_state.get("ipv6.method", "disabled")
 
-                subprocess.run(["sudo", "nmcli", "connection", "modify", nm_conn, "ipv4.never-default", val_v4_never], check=True, capture_output=True)
-                subprocess.run(["sudo", "nmcli", "connection", "modify", nm_conn, "ipv4.ignore-auto-routes", val_v4_ignore], check=True, capture_output=True)
-                subprocess.run(["sudo", "nmcli", "connection", "modify", nm_conn, "ipv6.method", val_v6_method], check=False, capture_output=True)
+                priv_op("nm_connection_routes", name=nm_conn, never_default=val_v4_never, ignore_auto_routes=val_v4_ignore,
+                        ipv6_method=val_v6_method, check=True)
                 
-                subprocess.run(["sudo", "nmcli", "connection", "up", nm_conn], check=True, capture_output=True)
+                priv_op("nm_connection_up", name=nm_conn, check=True)
                 safe_print(f"{GREEN}{T('nm_success')}{NC}")
             except Exception as e:
                 safe_print(f"{YELLOW}{T('nm_crit_error', e)}{NC}")
@@ -1159,46 +3039,52 @@ def cleanup(is_failure=False, state_override=None):
     if is_failure:
         if actions.get("vpn_started"): 
             safe_print(f"{RED}{T('kill_switch_active')}{NC}")
-            subprocess.run(["sudo", "nmcli", "networking", "off"], capture_output=True, text=True)
+            priv_op("nm_networking", state="off")
             send_critical_notification(T("notif_title_crit"), T("notif_msg_kill"))
         else:
             safe_print(f"{YELLOW}{T('clean_kill_skip')}{NC}")
 
     # 5. ARCHIVOS
+    timeline_phase("cleanup_files")
     safe_print(f"{BLUE}{T('clean_files')}{NC}")
-    for f in [LOG_FILE, PORT_FILE, RECONNECTION_LOG_FILE, DNS_LOG_FILE, DNS_BACKUP_FILE, LOCK_FILE, IPT_V4_BACKUP, IPT_V6_BACKUP]:
+    race_files = [f for f in os.listdir(script_dir) if f.startswith((RACE_FILE_PREFIX, STANDBY_FILE_PREFIX))]
+    for f in [LOG_FILE, PORT_FILE, RECONNECTION_LOG_FILE, DNS_LOG_FILE, DNS_BACKUP_FILE, LOCK_FILE, IPT_V4_BACKUP, IPT_V6_BACKUP, MGMT_SOCKET_FILE] + race_files:
         p = os.path.join(script_dir, f)
         if os.path.exists(p): 
             try: os.remove(p)
-            except: subprocess.run(["sudo", "rm", "-f", p], check=False, stderr=subprocess.DEVNULL)
+            except: priv_op("remove_file", path=p)
 
+    if own_timeline: own_timeline.finish(script_dir, True)
     safe_print(f"\n{GREEN}{T('clean_complete')}{NC}")
     if is_failure and actions.get("vpn_started"): 
         safe_print(f"{YELLOW}{T('net_disabled')}{NC}")
         safe_print(f"{T('kill_switch_recover')}")
 
 def keep_sudo_alive():
+    # Con el ayudante no se vuelve a pedir sudo, pero si se cae priv_op() tira de sudo directo:
+    # la marca de tiempo tiene que seguir viva para que eso no pida contraseña (ni falle en silencio)
     while True:
-        subprocess.run(["sudo", "-v"], capture_output=True)
+        subprocess.run(["sudo", "-n", "-v"], capture_output=True)
         time.sleep(60)
 
-def check_and_set_default_route():
+def check_and_set_default_route(tun_interface=None):
     safe_print(f"{BLUE}{T('route_check')}{NC}")
-    tun_interface = None
-    try:
-        interfaces_output = subprocess.run(["ip", "-o", "link", "show"], capture_output=True, text=True).stdout
-        match = re.search(r'\d+:\s*(tun\d+):', interfaces_output)
-        if match:
-            tun_interface = match.group(1)
-        else:
-            safe_print(f"{RED}{T('tun_error')}{NC}")
+    # Si no nos dicen qué túnel usar (p. ej. el ganador del modo carrera), cogemos el primero que haya
+    if not tun_interface:
+        try:
+            interfaces_output = subprocess.run(["ip", "-o", "link", "show"], capture_output=True, text=True).stdout
+            match = re.search(r'\d+:\s*(tun\d+):', interfaces_output)
+            if match:
+                tun_interface = match.group(1)
+            else:
+                safe_print(f"{RED}{T('tun_error')}{NC}")
+                return False
+        except Exception as e:
+            safe_print(f"{RED}  Error: {e}{NC}")
             return False
-    except Exception as e:
-        safe_print(f"{RED}  Error: {e}{NC}")
-        return False
 
     try:
-        subprocess.run(["sudo", "ip", "route", "add", "default", "dev", tun_interface], check=True, stderr=subprocess.DEVNULL)
+        priv_op("route", action="add", spec=["default", "dev", tun_interface], check=True)
         safe_print(f"{GREEN}{T('route_success', tun_interface)}{NC}")
     except subprocess.CalledProcessError:
         safe_print(f"{YELLOW}{T('route_exists', tun_interface)}{NC}")
@@ -1207,9 +3093,553 @@ def check_and_set_default_route():
         return False
     return True
 
-def establish_connection(selected_file, selected_location, initial_ip, is_reconnecting=False):
-    global ORIGINAL_DEFAULT_ROUTE_DETAILS, CONNECTION_START_TIME
+# --- LÍNEA DE TIEMPO DE LA CONEXIÓN ---
+class ConnectionTimeline:
+    """
+    Tramos con nombre de una conexión, del arranque o de una limpieza (nmcli, handshake, DNS,
+    firewall, ruta...). Los tramos seguidos se marcan con phase(); los que corren en otro hilo, con span().
+    """
+    def __init__(self, kind, profile=None):
+        self.kind = kind
+        self.profile = profile
+        self.start = time.time()
+        self.spans = []  # (nombre, inicio relativo, duración)
+        self.current = None
+        self.finished = False
+        self.total, self.ok = 0, None
+        self.lock = threading.Lock()
+
+    def _close_current(self, now):
+        if self.current:
+            name, started = self.current
+            self.spans.append((name, started - self.start, now - started))
+            self.current = None
+
+    def phase(self, name):
+        """Cierra el tramo en curso y abre el siguiente."""
+        now = time.time()
+        with self.lock:
+            self._close_current(now)
+            self.current = (name, now)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append((name, started - self.start, time.time() - started))
+
+    def durations(self):
+        """Segundos por nombre de tramo (sumados si se repite, p. ej. en varios intentos)."""
+        totals = {}
+        with self.lock:
+            for name, _, duration in self.spans:
+                totals[name] = totals.get(name, 0) + duration
+        return totals
+
+    def summary(self, top=TIMELINE_SUMMARY_SPANS):
+        total = self.total if self.finished else time.time() - self.start
+        slowest = sorted(self.durations().items(), key=lambda item: item[1], reverse=True)[:top]
+        parts = [f"{name} {duration:.1f}s" for name, duration in slowest]
+        return f"{total:.1f}s (" + ", ".join(parts) + ")" if parts else f"{total:.1f}s"
+
+    def finish(self, script_dir, ok):
+        """Cierra la línea de tiempo: la conexión se vuelca a TIMELINE_FILE y todas van al historial."""
+        if self.finished: return
+        now = time.time()
+        with self.lock:
+            self._close_current(now)
+            self.finished = True
+        self.total, self.ok = now - self.start, ok
+        if self.kind == "connect":
+            try:
+                with open(os.path.join(script_dir, TIMELINE_FILE), "w") as f:
+                    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start))
+                    f.write(f"{started}  {self.profile or '-'}  {'OK' if ok else 'FAIL'}  {self.total:.2f}s\n")
+                    for name, offset, duration in sorted(self.spans, key=lambda item: item[1]):
+                        f.write(f"  +{offset:7.2f}s  {duration:7.2f}s  {name}\n")
+            except Exception: pass
+        append_timeline_history(script_dir, {
+            "time": datetime.now().isoformat(timespec="seconds"), "kind": self.kind, "profile": self.profile,
+            "ok": ok, "total": round(self.total, 3),
+            "spans": {name: round(duration, 3) for name, duration in self.durations().items()},
+        })
+
+def append_timeline_history(script_dir, run):
+    history_path = os.path.join(script_dir, TIMELINE_HISTORY_FILE)
+    runs = []
+    try:
+        with open(history_path, "r") as f:
+            runs = json.load(f).get("runs", [])
+    except Exception: pass
+    _atomic_write_json(history_path, {"runs": (runs + [run])[-TIMELINE_HISTORY_MAX:]})
+
+def start_timeline(kind, profile=None):
+    global TIMELINE
+    TIMELINE = ConnectionTimeline(kind, profile)
+    return TIMELINE
+
+def timeline_phase(name):
+    if TIMELINE and not TIMELINE.finished: TIMELINE.phase(name)
+
+def timeline_span(name):
+    return TIMELINE.span(name) if TIMELINE and not TIMELINE.finished else contextlib.nullcontext()
+
+# --- LANZAMIENTO DE OPENVPN Y MODO CARRERA ---
+def launch_openvpn(script_dir, config_file, log_path, auth_data, extra_args=None, mgmt_path=None, nobind=False):
+    """
+    Arranca OpenVPN como root (ayudante privilegiado o sudo) con el perfil dado, volcando su salida en log_path. Las credenciales van por stdin.
+    Con mgmt_path abre además la interfaz de gestión en ese socket Unix (ver ManagementClient).
+    nobind: puerto local efímero, para que varias instancias a la vez no choquen en 'lport 1194' o 'bind'.
+    """
+    LOG_FOLLOWERS.pop(log_path, None) # Log nuevo: nada de lo leído del intento anterior sirve
+    if mgmt_path:
+        extra_args = (extra_args or []) + ["--management", mgmt_path, "unix"]
+        if os.path.exists(mgmt_path):
+            try: os.remove(mgmt_path)
+            except OSError: priv_op("remove_file", path=mgmt_path)
+    # Los argumentos extra ('--remote', '--dev'...) son opciones de OVPN_OPTIONS (ver openvpn_command)
+    pid = priv_start_openvpn(os.path.join(script_dir, config_file), log_path, auth_data, extra_args or [], nobind)
+    update_lock_state("vpn_started", True)
+    return pid
+
+def attach_management(racers):
+    """Conecta un ManagementClient a cada OpenVPN lanzado; todos avisan por el mismo evento."""
+    changed = threading.Event()
+    for racer in racers:
+        racer["mgmt"] = ManagementClient(racer["sock"], changed)
+        racer["mgmt"].connect()
+    return changed
+
+def is_tunnel_ready(racer):
+    # Preferimos lo que notifica la interfaz de gestión; si no conectó, lo sacamos del log
+    mgmt = racer.get("mgmt")
+    if mgmt and mgmt.connected: return mgmt.state == "CONNECTED"
+    return follow_openvpn_log(racer["log"]).state == "CONNECTED"
+
+def has_tunnel_failed(racer):
+    """OpenVPN ya ha terminado o el servidor rechazó las credenciales: no tiene sentido esperarlo."""
+    mgmt = racer.get("mgmt")
+    if mgmt and mgmt.connected: return mgmt.closed or mgmt.auth_failed
+    return follow_openvpn_log(racer["log"]).state in ("AUTH_FAILED", "EXITED")
+
+def find_free_tun_devices(count):
+    """Nombres tunN que no existen todavía, uno por cada perfil de la carrera."""
+    try:
+        interfaces_output = subprocess.run(["ip", "-o", "link", "show"], capture_output=True, text=True).stdout
+        used = set(re.findall(r'\d+:\s*(tun\d+)[:@]', interfaces_output))
+    except Exception:
+        used = set()
+    names, index = [], 0
+    while len(names) < count:
+        if f"tun{index}" not in used: names.append(f"tun{index}")
+        index += 1
+    return names
+
+def pick_race_candidates(selected_file, ranked_files, down_files, count):
+    """El perfil elegido y, detrás, los mejores del ranking que no estén caídos."""
+    candidates = [selected_file]
+    for f in ranked_files:
+        if len(candidates) >= count: break
+        if f != selected_file and not (f in down_files and down_files[f] is None):
+            candidates.append(f)
+    return candidates
+
+def start_race(race_files, race_endpoints, script_dir, auth_data):
+    """
+    Lanza un OpenVPN por perfil, cada uno con su log, su pidfile y su propio tunN.
+    Con --route-noexec ninguno toca la tabla de rutas mientras compiten; las pone el ganador.
+    """
+    racers = []
+    for index, (ovpn_file, tun_dev) in enumerate(zip(race_files, find_free_tun_devices(len(race_files)))):
+        remotes = parse_ovpn_profile(os.path.join(script_dir, ovpn_file))["remotes"]
+        endpoints = race_endpoints.get(ovpn_file, [])
+        racer = {
+            "file": ovpn_file,
+            "tun": tun_dev,
+            "host": endpoints[0][0] if endpoints else (remotes[0][0] if remotes else None),
+            "log": os.path.join(script_dir, f"{RACE_FILE_PREFIX}{index}.log"),
+            "pid": os.path.join(script_dir, f"{RACE_FILE_PREFIX}{index}.pid"),
+            "sock": os.path.join(script_dir, f"{RACE_FILE_PREFIX}{index}.sock"),
+        }
+        extra_args = remote_override_args(endpoints) + ["--dev", tun_dev, "--route-noexec", "--writepid", racer["pid"]]
+        launch_openvpn(script_dir, ovpn_file, racer["log"], auth_data, extra_args, racer["sock"], nobind=True)
+        racers.append(racer)
+    return racers
+
+def stop_openvpn_instance(racer):
+    """Mata solo esta instancia de OpenVPN (el resto de la carrera, o la reserva, siguen vivas)."""
+    mgmt = racer.get("mgmt")
+    if mgmt and mgmt.connected and not mgmt.closed and mgmt.send("signal SIGTERM"): return
+    pid_path = racer.get("pid")
     try:
+        with open(pid_path, "r") as f:
+            priv_op("openvpn_kill", pid=int(f.read().strip()))
+    except (OSError, TypeError, ValueError):
+        # Sin pidfile: la buscamos por su línea de comandos (el pidfile o el socket de gestión son únicos)
+        priv_op("openvpn_kill_instance", marker=pid_path or racer["sock"])
+
+def finish_race(winner, racers, script_dir):
+    """Cierra los perdedores y deja el log del ganador como LOG_FILE para el resto del flujo."""
+    for racer in racers:
+        if racer is not winner: stop_openvpn_instance(racer)
+    # OpenVPN sigue escribiendo en el mismo fichero aunque cambie de nombre
+    os.replace(winner["log"], os.path.join(script_dir, LOG_FILE))
+    LOG_FOLLOWERS.pop(os.path.join(script_dir, LOG_FILE), None)
+    for racer in racers:
+        if racer is not winner and os.path.exists(racer["log"]):
+            try: os.remove(racer["log"])
+            except OSError: pass
+
+def add_server_host_route(vpn_ip, journal_key="server_route"):
+    """Con --route-noexec OpenVPN no crea la ruta al servidor: la ponemos por la puerta de enlace original."""
+    gateway = re.search(r"\bvia\s+(\S+)", ORIGINAL_DEFAULT_ROUTE_DETAILS or "")
+    device = re.search(r"\bdev\s+(\S+)", ORIGINAL_DEFAULT_ROUTE_DETAILS or "")
+    if not gateway and not device: return False
+    spec = [f"{vpn_ip}/32"]
+    if gateway: spec += ["via", gateway.group(1)]
+    if device: spec += ["dev", device.group(1)]
+    safe_print(f"{BLUE}{T('race_route', vpn_ip)}{NC}")
+    if priv_op("route", action="replace", spec=spec).returncode != 0: return False
+    update_lock_state(journal_key, f"{vpn_ip}/32")
+    return True
+
+def verify_new_public_ip(initial_ip):
+    """IP pública vista desde fuera, solo si ya no es la original. Retorna la IP o None."""
+    oracle = public_ip_oracle()
+    oracle.reset() # Acabamos de cambiar de ruta: las conexiones abiertas salían por la red anterior
+    for attempt in range(1, IP_VERIFY_ATTEMPTS + 1):
+        safe_print(f"{YELLOW}{T('check_ip', attempt, IP_VERIFY_ATTEMPTS)}{NC}", dynamic=True)
+        current_ip = oracle.lookup(accept=lambda ip: ip != initial_ip)
+        if current_ip and current_ip != initial_ip: return current_ip
+        if attempt < IP_VERIFY_ATTEMPTS: time.sleep(IP_RETRY_DELAY)
+    return None
+
+def request_forwarded_port(script_dir):
+    safe_print(f"\n{BLUE}{T('get_port')}{NC}")
+    internal_ip = get_vpn_internal_ip()
+    forwarded_port = get_forwarded_port(internal_ip)
+
+    if forwarded_port and forwarded_port.isdigit():
+        try:
+            with open(os.path.join(script_dir, PORT_FILE), 'w') as f:
+                f.write(str(forwarded_port))
+            safe_print(f"{GREEN}{T('port_saved', forwarded_port, PORT_FILE)}{NC}")
+        except Exception: pass
+    return forwarded_port
+
+# --- RECONEXIÓN RÁPIDA (Kill Switch, NM y DNS se quedan puestos) ---
+def allow_vpn_server(vpn_ip, journal_key="ks_vpn_ip"):
+    """Abre en el Kill Switch el paso al (nuevo) servidor VPN antes del handshake; el anterior en esa clave se cierra."""
+    if (get_lock_state() or {}).get("actions", {}).get(journal_key) != vpn_ip:
+        safe_print(f"{BLUE}{T('ks_vpn', vpn_ip, 'ANY', 'ALL')}{NC}")
+    update_lock_state(journal_key, vpn_ip)
+    sync_kill_switch()
+
+def allow_tunnel_iface(tun_iface, journal_key="ks_tun"):
+    safe_print(f"{BLUE}{T('ks_tun', tun_iface)}{NC}")
+    update_lock_state(journal_key, tun_iface)
+    sync_kill_switch()
+
+def commit_kill_switch(tun_iface, vpn_ip):
+    """
+    Segunda fase del Kill Switch preparado durante el handshake: abre el tun y, de las IPs
+    de servidor permitidas, deja solo la del servidor con el que se ha conectado.
+    """
+    safe_print(f"{BLUE}{T('ks_tun', tun_iface)}{NC}")
+    update_lock_state("ks_vpn_ip", vpn_ip)
+    update_lock_state("ks_staged_ips", None)
+    update_lock_state("ks_tun", tun_iface)
+    return sync_kill_switch()
+
+def refresh_vpn_dns(tun_iface, vpn_dns, actions, phys_iface, script_dir):
+    """Aplica las DNS que empuja el nuevo servidor sin deshacer el blindaje (el .bak original no se toca)."""
+    if actions.get("resolv_locked"):
+        try:
+            with open("/etc/resolv.conf", "r") as f:
+                current_dns = re.findall(r"^nameserver\s+(\S+)", f.read(), re.MULTILINE)
+            if current_dns != vpn_dns:
+                priv_op("resolv_write", servers=vpn_dns, check=True)
+        except Exception as e:
+            safe_print(f"{RED}Error blindando DNS: {e}{NC}")
+    if is_systemd_resolved_active():
+        apply_dns_arch_native(tun_iface, vpn_dns, phys_iface, script_dir)
+    else:
+        apply_dns_via_nm(tun_iface, vpn_dns, script_dir)
+
+def fast_reconnect(selected_file, initial_ip, config_mgr):
+    """
+    Reconexión rápida: solo reinicia OpenVPN y actualiza lo que depende del servidor
+    (IP permitida en el Kill Switch, ruta al servidor, tun y DNS empujadas).
+    El Kill Switch, los cambios de NM, el resolv.conf blindado y el journal siguen puestos: no hay ventana de fuga.
+    Retorna (new_ip, dns_fallback, port) o None si hay que ir a la reconexión completa.
+    """
+    global MGMT_CLIENT, CONNECTION_START_TIME
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    actions = (get_lock_state() or {}).get("actions", {})
+    phys_iface = actions.get("firewall_iface")
+    if not actions.get("kill_switch_active") or not phys_iface or not ORIGINAL_DEFAULT_ROUTE_DETAILS: return None
+    vpn_user, vpn_pass = config_mgr.get_credentials()
+    if not vpn_user or not vpn_pass: return None
+
+    # Con el Kill Switch puesto no hay DNS fuera del túnel: el servidor va como IP (last-known-good o caché)
+    endpoints = preresolved_remotes(selected_file, script_dir, config_mgr, resolve=False)
+    if not endpoints: return None
+    vpn_ip, port, proto = endpoints[0]
+
+    safe_print(f"{YELLOW}{T('fast_reconn')}{NC}")
+    CONNECTION_START_TIME = time.time()
+    priv_op("openvpn_kill_all")
+    if MGMT_CLIENT:
+        MGMT_CLIENT.close()
+        MGMT_CLIENT = None
+    wait_until(lambda: not is_openvpn_running(), NETWORK_RESTORE_TIMEOUT)
+
+    allow_vpn_server(vpn_ip)
+    old_route = actions.get("server_route")
+    if old_route and old_route != f"{vpn_ip}/32":
+        priv_op("route", action="del", spec=route_selector(old_route))
+    # La ruta por defecto apuntaba al tun que ya no existe: sin esta ruta el handshake no saldría
+    if not add_server_host_route(vpn_ip): return None
+
+    racer = {"log": os.path.join(script_dir, LOG_FILE), "sock": os.path.join(script_dir, MGMT_SOCKET_FILE)}
+    auth_data = f"{vpn_user}\n{vpn_pass}".encode('utf-8')
+    launch_openvpn(script_dir, selected_file, racer["log"], auth_data, ["--remote", vpn_ip, port, proto], racer["sock"])
+    changed = attach_management([racer])
+    start_time = time.time()
+    while time.time() - start_time < CONNECTION_TIMEOUT:
+        if is_tunnel_ready(racer) or has_tunnel_failed(racer): break
+        changed.wait(1)
+        changed.clear()
+    if not is_tunnel_ready(racer): return None
+    MGMT_CLIENT = racer["mgmt"]
+    safe_print(f"{GREEN}{T('ovpn_started')}{NC}")
+    remember_known_good(script_dir, selected_file)
+
+    tun_iface = detect_tun_interface_from_log(script_dir)
+    if not tun_iface: return None
+    if tun_iface != actions.get("ks_tun"): allow_tunnel_iface(tun_iface)
+    vpn_dns = extract_vpn_dns_from_log(script_dir)
+    if vpn_dns: refresh_vpn_dns(tun_iface, vpn_dns, actions, phys_iface, script_dir)
+    if not check_and_set_default_route(tun_iface): return None
+
+    wait_until(tunnel_passes_traffic, TUNNEL_READY_TIMEOUT)
+    new_ip = verify_new_public_ip(initial_ip)
+    if not new_ip: return None
+    return new_ip, False, request_forwarded_port(script_dir)
+
+# --- TÚNEL DE RESERVA (HOT-STANDBY) ---
+def start_standby(primary_file, config_mgr):
+    """
+    Segundo OpenVPN ya conectado al siguiente mejor servidor, en su propio tun y sin ruta por defecto
+    (--route-noexec). Si el principal cae, switch_to_standby() solo cambia la ruta y las reglas.
+    """
+    global STANDBY
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    actions = (get_lock_state() or {}).get("actions", {})
+    candidates = [f for f in build_failover_candidates(primary_file, script_dir, config_mgr) if f != primary_file]
+    vpn_user, vpn_pass = config_mgr.get_credentials()
+    if not candidates or not ORIGINAL_DEFAULT_ROUTE_DETAILS or not vpn_user or not vpn_pass: return None
+
+    standby_file = candidates[0]
+    # Con el principal arriba el DNS va por el túnel, así que resolver aquí no fuga nada
+    endpoints = preresolved_remotes(standby_file, script_dir, config_mgr)
+    if not endpoints: return None
+    vpn_ip, port, proto = endpoints[0]
+
+    safe_print(f"{BLUE}{T('standby_start', parse_location_name(standby_file, config_mgr.config))}{NC}")
+    standby = {
+        "file": standby_file,
+        "ip": vpn_ip,
+        "tun": find_free_tun_devices(1)[0],
+        "log": os.path.join(script_dir, f"{STANDBY_FILE_PREFIX}.log"),
+        "pid": os.path.join(script_dir, f"{STANDBY_FILE_PREFIX}.pid"),
+        "sock": os.path.join(script_dir, f"{STANDBY_FILE_PREFIX}.sock"),
+    }
+    phys_iface = actions.get("firewall_iface")
+    if actions.get("kill_switch_active") and phys_iface:
+        allow_vpn_server(vpn_ip, journal_key="standby_vpn_ip")
+        allow_tunnel_iface(standby["tun"], journal_key="standby_tun")
+    if not add_server_host_route(vpn_ip, journal_key="standby_route"):
+        release_standby_allowances()
+        return None
+
+    auth_data = f"{vpn_user}\n{vpn_pass}".encode('utf-8')
+    launch_openvpn(script_dir, standby_file, standby["log"], auth_data,
+                   ["--remote", vpn_ip, port, proto, "--dev", standby["tun"], "--route-noexec", "--writepid", standby["pid"]], standby["sock"], nobind=True)
+    attach_management([standby])
+    STANDBY = standby
+    return standby
+
+def is_standby_alive():
+    return STANDBY is not None and not has_tunnel_failed(STANDBY)
+
+def stop_standby():
+    """Apaga la reserva y retira su regla del Kill Switch y su ruta al servidor."""
+    global STANDBY
+    standby, STANDBY = STANDBY, None
+    if not standby: return
+    stop_openvpn_instance(standby)
+    if standby.get("mgmt"): standby["mgmt"].close()
+    release_standby_allowances()
+
+def release_standby_allowances():
+    """Retira la ruta al servidor de reserva y sus entradas del journal (y con ellas sus reglas del Kill Switch)."""
+    actions = (get_lock_state() or {}).get("actions", {})
+    if actions.get("standby_route") and actions.get("standby_route") != actions.get("server_route"):
+        priv_op("route", action="del", spec=route_selector(actions["standby_route"]))
+    for key in ("standby_vpn_ip", "standby_tun", "standby_route"): update_lock_state(key, None)
+    sync_kill_switch() # Fuera su IP y su tun (si no los comparte con el principal)
+
+def maintain_standby(primary_file, config_mgr):
+    """
+    (Re)prepara la reserva si está activada y no hay una viva. Cada intento relanza OpenVPN y toca el
+    firewall, así que entre intentos fallidos seguidos la espera se duplica (STANDBY_RETRY_BASE..MAX).
+    """
+    global STANDBY_RETRY_DELAY, STANDBY_NEXT_RETRY
+    if not config_mgr.get_standby_enabled(): return
+    if is_standby_alive():
+        if is_tunnel_ready(STANDBY): STANDBY_RETRY_DELAY = 0 # Conectó: la próxima caída empieza desde el mínimo
+        return
+    if time.time() < STANDBY_NEXT_RETRY: return
+    stop_standby()
+    STANDBY_RETRY_DELAY = min(STANDBY_RETRY_MAX, STANDBY_RETRY_DELAY * 2 or STANDBY_RETRY_BASE)
+    STANDBY_NEXT_RETRY = time.time() + STANDBY_RETRY_DELAY
+    start_standby(primary_file, config_mgr)
+
+def switch_to_standby(initial_ip, config_mgr):
+    """
+    Conmutación al túnel de reserva: fuera el principal, ruta por defecto y reglas al tun de reserva,
+    DNS empujadas por su servidor. Sin handshake de por medio.
+    Retorna (archivo, new_ip, port) o None si la reserva no está lista.
+    """
+    global STANDBY, MGMT_CLIENT
+    standby = STANDBY
+    if not standby or not is_tunnel_ready(standby): return None
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    # El tun pedido con '--dev' es una suposición: el que cuenta es el que abrió OpenVPN (está en su log)
+    real_tun = follow_openvpn_log(standby["log"]).tun
+    if real_tun and real_tun != standby["tun"]:
+        standby["tun"] = real_tun
+        allow_tunnel_iface(real_tun, journal_key="standby_tun")
+    actions = (get_lock_state() or {}).get("actions", {})
+    phys_iface = actions.get("firewall_iface")
+    safe_print(f"{YELLOW}{T('standby_switch', parse_location_name(standby['file'], config_mgr.config))}{NC}")
+
+    # 1. Fuera SOLO el principal: la reserva sigue viva
+    primary_sock = os.path.join(script_dir, MGMT_SOCKET_FILE)
+    stop_openvpn_instance({"mgmt": MGMT_CLIENT, "sock": primary_sock})
+    if MGMT_CLIENT: wait_until(lambda: MGMT_CLIENT.closed, NETWORK_RESTORE_TIMEOUT)
+
+    # 2. Ruta por defecto por el tun de reserva
+    if priv_op("route", action="replace", spec=["default", "dev", standby["tun"]]).returncode != 0:
+        return None
+
+    # 3. La reserva pasa a ser el principal en el Kill Switch, las rutas y el journal
+    if actions.get("server_route") and actions.get("server_route") != actions.get("standby_route"):
+        priv_op("route", action="del", spec=route_selector(actions["server_route"]))
+    update_lock_state("ks_vpn_ip", standby["ip"])
+    update_lock_state("ks_tun", standby["tun"])
+    update_lock_state("server_route", actions.get("standby_route"))
+    for key in ("standby_vpn_ip", "standby_tun", "standby_route"): update_lock_state(key, None)
+    sync_kill_switch() # Solo cambia la IP del servidor y el tun: el resto del Kill Switch no se toca
+
+    # 4. Su log y su socket pasan a ser los del principal
+    os.replace(standby["log"], os.path.join(script_dir, LOG_FILE))
+    LOG_FOLLOWERS.pop(os.path.join(script_dir, LOG_FILE), None)
+    remember_known_good(script_dir, standby["file"])
+    MGMT_CLIENT, STANDBY = standby.get("mgmt"), None
+    try:
+        os.replace(standby["sock"], primary_sock)
+        if MGMT_CLIENT: MGMT_CLIENT.sock_path = primary_sock
+    except OSError: pass
+
+    # 5. DNS del nuevo servidor
+    vpn_dns = extract_vpn_dns_from_log(script_dir)
+    if vpn_dns: refresh_vpn_dns(standby["tun"], vpn_dns, actions, phys_iface, script_dir)
+
+    wait_until(tunnel_passes_traffic, TUNNEL_READY_TIMEOUT)
+    new_ip = verify_new_public_ip(initial_ip)
+    if not new_ip: return None
+    return standby["file"], new_ip, request_forwarded_port(script_dir)
+
+# --- RETOMAR EL TÚNEL TRAS UN CIERRE INCORRECTO ---
+def journal_session(profile, initial_ip, vpn_ip, forwarded_port):
+    """Lo necesario para retomar este túnel si el script muere sin limpiar (ver adopt_running_tunnel)."""
+    tun = re.search(r"\bdev\s+(tun\d+)", get_current_default_route_details() or "")
+    update_lock_state("session", {
+        "profile": profile,
+        "initial_ip": initial_ip,
+        "vpn_ip": vpn_ip,
+        "port": forwarded_port,
+        "tun": tun.group(1) if tun else None,
+        "pid": MGMT_CLIENT.pid if MGMT_CLIENT else None,
+        "mgmt": MGMT_CLIENT.sock_path if MGMT_CLIENT else None,
+        "orig_route": ORIGINAL_DEFAULT_ROUTE_DETAILS,
+        "started": CONNECTION_START_TIME,
+    })
+
+def is_kill_switch_intact(actions, tun_iface):
+    if actions.get("firewall_backend") == FIREWALL_NFTABLES:
+        table = priv_op("nft_list").stdout
+        vpn_ip = actions.get("ks_vpn_ip")
+        return "policy drop" in table and f'"{tun_iface}"' in table and (not vpn_ip or re.search(rf"\b{re.escape(vpn_ip)}\b", table) is not None)
+    rules = priv_op("ipt_list").stdout.splitlines()
+    if "-P OUTPUT DROP" not in rules or f"-A OUTPUT -j {IPT_CHAIN_OUT}" not in rules: return False
+    vpn_ip = actions.get("ks_vpn_ip")
+    return all(rule in rules for rule in vpn_rule_specs(actions.get("firewall_iface"), [vpn_ip] if vpn_ip else [], [tun_iface]))
+
+def adopt_running_tunnel(lock_data):
+    """
+    Tras un cierre sin limpieza (terminal cerrada, fallo del script): si el OpenVPN de la sesión anterior
+    sigue vivo y su tun, la ruta por defecto, el Kill Switch y la interfaz de gestión cuadran con el journal,
+    nos quedamos con él en vez de desmontarlo todo. Retorna la sesión adoptada o None.
+    """
+    global ORIGINAL_DEFAULT_ROUTE_DETAILS, CONNECTION_START_TIME, CONNECTED_PROFILE, MGMT_CLIENT, STANDBY
+    actions = (lock_data or {}).get("actions", {})
+    session = actions.get("session") or {}
+    if not all(session.get(key) for key in ("profile", "initial_ip", "tun", "pid", "mgmt")): return None
+
+    # 1. El proceso sigue siendo OpenVPN
+    if not is_openvpn_pid(session["pid"]): return None
+
+    # 2. Túnel, ruta por defecto y Kill Switch tal y como se dejaron
+    tun = session["tun"]
+    if not os.path.exists(f"/sys/class/net/{tun}"): return None
+    if f"dev {tun}" not in (get_current_default_route_details() or ""): return None
+    if actions.get("kill_switch_active") and not is_kill_switch_intact(actions, tun): return None
+
+    # 3. OpenVPN conectado según su interfaz de gestión y pasando tráfico
+    client = ManagementClient(session["mgmt"])
+    if not client.connect(timeout=1): return None
+    if not wait_until(lambda: client.state is not None, TUNNEL_READY_TIMEOUT) or client.state != "CONNECTED" or not tunnel_passes_traffic():
+        client.close()
+        return None
+
+    MGMT_CLIENT, CONNECTED_PROFILE = client, session["profile"]
+    ORIGINAL_DEFAULT_ROUTE_DETAILS = session.get("orig_route")
+    CONNECTION_START_TIME = session.get("started") or time.time()
+    # El lock pasa a este proceso con el mismo journal, así la limpieza final lo sigue deshaciendo todo
+    try:
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), LOCK_FILE), "w") as f:
+            json.dump({"pid": os.getpid(), "actions": actions}, f)
+    except OSError: return None
+    # Una reserva huérfana no se adopta: fuera, con su regla y su ruta (monitor_connection prepara otra)
+    if actions.get("standby_tun"):
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        STANDBY = {"pid": os.path.join(script_dir, f"{STANDBY_FILE_PREFIX}.pid"), "sock": os.path.join(script_dir, f"{STANDBY_FILE_PREFIX}.sock")}
+        stop_standby()
+    return session
+
+def establish_connection(selected_file, selected_location, initial_ip, is_reconnecting=False, race_files=None,
+                         attempts=CONNECTION_ATTEMPTS, final_attempt=True):
+    # final_attempt=False (failover con más candidatos detrás): si falla, limpiamos sin activar el Kill Switch
+    global ORIGINAL_DEFAULT_ROUTE_DETAILS, CONNECTION_START_TIME, CONNECTED_PROFILE, MGMT_CLIENT
+    timeline, connected = start_timeline("connect", selected_file), False
+    try:
+        timeline_phase("prepare")
         CONNECTION_START_TIME = time.time()
         start_time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(CONNECTION_START_TIME))
         script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -1232,6 +3662,24 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                 safe_print(f"{RED}Error: Route?{NC}")
                 return None, False, None
 
+        config_mgr = ConfigManager(script_dir)
+
+        # Resolvemos los servidores ahora, con la red original intacta (la caché la reutiliza el Kill Switch)
+        # y elegimos el 'remote' más rápido del perfil para que OpenVPN lo pruebe primero
+        timeline_phase("resolve")
+        race_mode = bool(race_files) and len(race_files) > 1
+        profile_remotes = parse_ovpn_profile(os.path.join(script_dir, selected_file))["remotes"]
+        race_hosts = [host for f in (race_files if race_mode else []) for host, _, _ in parse_ovpn_profile(os.path.join(script_dir, f))["remotes"]]
+        RESOLVER_CACHE.resolve_many([host for host, _, _ in profile_remotes] + race_hosts)
+        # OpenVPN arranca con las IPs ya resueltas (last-known-good primero); los nombres quedan de respaldo
+        endpoints = preresolved_remotes(selected_file, script_dir, config_mgr)
+        vpn_host = endpoints[0][0] if endpoints else (profile_remotes[0][0] if profile_remotes else None)
+        remote_override = remote_override_args(endpoints)
+        # Solo historial y caché, también en carrera: OpenVPN recorre los demás 'remote' por su cuenta
+        race_endpoints = {f: endpoints if f == selected_file else preresolved_remotes(f, script_dir, config_mgr)
+                          for f in (race_files if race_mode else [])}
+
+        timeline_phase("nmcli")
         safe_print(f"\n{BLUE}{T('prep_net')}{NC}")
         
         active_connection_name = None
@@ -1267,47 +3715,85 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                 update_lock_state("nm_connection", active_connection_name)
 
                 safe_print(f"{T('neutralize_route', active_connection_name)}")
-                subprocess.run(["sudo", "nmcli", "connection", "modify", active_connection_name, "ipv4.never-default", "yes"], check=True, capture_output=True)
-                subprocess.run(["sudo", "nmcli", "connection", "modify", active_connection_name, "ipv4.ignore-auto-routes", "yes"], check=True, capture_output=True)
-                subprocess.run(["sudo", "nmcli", "connection", "modify", active_connection_name, "ipv6.method", "ignore"], check=False, capture_output=True)
+                priv_op("nm_connection_routes", name=active_connection_name, never_default="yes", ignore_auto_routes="yes",
+                        ipv6_method="ignore", check=True)
                 
                 safe_print(f"{GREEN}{T('profile_mod', active_connection_name)}{NC}")
         except Exception as e:
             safe_print(f"{RED}Error: {e}{NC}")
 
-        config_mgr = ConfigManager(script_dir)
         vpn_user, vpn_pass = config_mgr.get_credentials()
         if not vpn_user or not vpn_pass:
             safe_print(f"{RED}{T('err_no_creds')}{NC}")
             return None, False, None
         auth_data = f"{vpn_user}\n{vpn_pass}".encode('utf-8')
 
-        for attempt in range(1, CONNECTION_ATTEMPTS + 1):
-            safe_print(f"{BLUE}{T('start_attempt', attempt, CONNECTION_ATTEMPTS)}{NC}", dynamic=True)
-            subprocess.run(["sudo", "killall", "-q", "openvpn"], capture_output=True)
+        # Kill Switch en dos fases: todo lo que no depende del túnel se prepara mientras OpenVPN negocia.
+        # Solo con IPs ya resueltas: con las políticas DROP puestas, los nombres de respaldo no resolverían.
+        do_block_doh = config_mgr.get_doh_blocking()
+        do_block_lan = config_mgr.get_lan_blocking()
+        fw_backend = resolve_firewall_backend(config_mgr)
+        all_endpoints = [ep for eps in race_endpoints.values() for ep in eps] if race_mode else endpoints
+        staged_ips = list(dict.fromkeys(ip for ip, _, _ in all_endpoints)) if physical_device else []
+        stage_thread = None
+        stage_result = []
+
+        def stage_firewall():
+            with timeline_span("firewall_stage"):
+                stage_result.append(manage_kill_switch(physical_device, None, action="add", vpn_ip=staged_ips[0], staged_ips=staged_ips[1:], script_dir=script_dir,
+                                   block_doh=do_block_doh, block_lan=do_block_lan, backend=fw_backend))
+
+        for attempt in range(1, attempts + 1):
+            timeline_phase("openvpn_launch")
+            safe_print(f"{BLUE}{T('start_attempt', attempt, attempts)}{NC}", dynamic=True)
+            priv_op("openvpn_kill_all")
             try:
-                with open(log_file_path, "wb") as log:
-                    config_path = os.path.join(script_dir, selected_file)
-                    cmd = ["sudo", "openvpn", "--block-ipv6", "--cd", script_dir, "--config", config_path, 
-                           "--auth-user-pass", "/dev/stdin", "--mssfix", "1450", "--mute-replay-warnings"]
-                    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log, stderr=log)
-                    update_lock_state("vpn_started", True)
-                    try:
-                        proc.stdin.write(auth_data)
-                        proc.stdin.close()
-                    except Exception: pass
+                if race_mode:
+                    # Modo carrera: todos los perfiles a la vez, nos quedamos con el primer túnel que suba
+                    safe_print(f"{BLUE}{T('race_start', len(race_files))}{NC}")
+                    racers = start_race(race_files, race_endpoints, script_dir, auth_data)
+                else:
+                    mgmt_path = os.path.join(script_dir, MGMT_SOCKET_FILE)
+                    launch_openvpn(script_dir, selected_file, log_file_path, auth_data, remote_override, mgmt_path)
+                    racers = [{"file": selected_file, "tun": None, "host": vpn_host, "log": log_file_path, "sock": mgmt_path}]
+                changed = attach_management(racers)
             except Exception as e:
                 safe_print(f"{RED}Error: {e}{NC}")
                 return None, False, None
+
+            if staged_ips and stage_thread is None:
+                stage_thread = threading.Thread(target=stage_firewall, daemon=True)
+                stage_thread.start()
             
-            start_time, success = time.time(), False
+            timeline_phase("handshake")
+            # OpenVPN nos avisa por la interfaz de gestión; el timeout de 1s solo cubre el caso sin ella
+            start_time, winner = time.time(), None
             while time.time() - start_time < CONNECTION_TIMEOUT:
-                if os.path.exists(log_file_path) and "Initialization Sequence Completed" in open(log_file_path, "r", errors='ignore').read():
-                    success = True
-                    break
-                time.sleep(1)
+                winner = next((r for r in racers if is_tunnel_ready(r)), None)
+                if winner or all(has_tunnel_failed(r) for r in racers): break
+                changed.wait(1)
+                changed.clear()
+            timeline_phase("firewall_stage_wait")
+            if stage_thread: stage_thread.join()
+            success = winner is not None
+            if success: MGMT_CLIENT = winner.get("mgmt")
+
+            if success and race_mode:
+                timeline_phase("race_finish")
+                selected_file, vpn_host = winner["file"], winner["host"]
+                safe_print(f"{GREEN}{T('race_won', parse_location_name(selected_file, config_mgr.config))}{NC}")
+                finish_race(winner, racers, script_dir)
+                # Con --route-noexec el ganador no crea la ruta al servidor: el túnel debe seguir saliendo por la red física
+                r_ip = extract_connection_details(script_dir)[0] or (vpn_host if is_valid_ip(vpn_host) else RESOLVER_CACHE.get(vpn_host))
+                if not r_ip or not add_server_host_route(r_ip):
+                    safe_print(f"{YELLOW}Fail route.{NC}")
+                    time.sleep(3)
+                    display_failure_banner(T("fail_msg_route"))
+                    cleanup(is_failure=final_attempt)
+                    return None, False, None
                 
             if success:
+                timeline_phase("dns")
                 safe_print(f"{GREEN}{T('ovpn_started')}{NC}")
                 
                 vpn_dns = extract_vpn_dns_from_log(script_dir)
@@ -1316,32 +3802,21 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                 if not vpn_dns:
                     safe_print(f"{RED}{T('dns_abort')}{NC}")
                     time.sleep(8) # 8 segundos para que te dé tiempo a leerlo
-                    cleanup(is_failure=True)
+                    cleanup(is_failure=final_attempt)
                     return None, False, None
                 # ---------------------------------
 
+                tun_iface = detect_tun_interface_from_log(script_dir)
+
                 if not is_systemd_resolved_active(): # Ya no hace falta comprobar "if vpn_dns"
-                    safe_print(f"{YELLOW}Esperando a NetworkManager (2s)...{NC}")
-                    time.sleep(2)
+                    # NM puede reescribir resolv.conf al ver el túnel: esperamos a que deje de configurarlo
+                    safe_print(f"{YELLOW}Esperando a NetworkManager...{NC}")
+                    if tun_iface: wait_until(lambda: is_nm_device_settled(tun_iface), NM_SETTLE_TIMEOUT)
                     
                     safe_print(f"{BLUE}  > Blindando /etc/resolv.conf (Inmutable)...{NC}")
                     try:
-                        # 1. Aseguramos que el archivo no esté bloqueado de antes
-                        subprocess.run(["sudo", "chattr", "-i", "/etc/resolv.conf"], check=False, stderr=subprocess.DEVNULL)
-                        
-                        # 2. Creamos el archivo temporal
-                        temp_resolv = os.path.join(script_dir, "resolv.conf.tmp")
-                        with open(temp_resolv, "w") as f:
-                            f.write("# Generated by ConVPN (Kill Switch Active)\n")
-                            for dns in vpn_dns:
-                                f.write(f"nameserver {dns}\n")
-                        
-                        # 3. Machacamos el original
-                        subprocess.run(["sudo", "mv", "/etc/resolv.conf", "/etc/resolv.conf.bak"], check=False, stderr=subprocess.DEVNULL)
-                        subprocess.run(["sudo", "mv", temp_resolv, "/etc/resolv.conf"], check=True)
-                        
-                        # 4. ECHAMOS EL CANDADO (Inmutable)
-                        subprocess.run(["sudo", "chattr", "+i", "/etc/resolv.conf"], check=True)
+                        # Desbloquear, guardar el original en .bak, escribir el nuevo y ECHAR EL CANDADO (Inmutable)
+                        priv_op("resolv_write", servers=vpn_dns, backup=True, check=True)
                         
                         update_lock_state("resolv_locked", True)
                         
@@ -1353,7 +3828,6 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                 if not vpn_dns:
                     safe_print(f"{YELLOW}{T('dns_extract_fail')}{NC}")
                 
-                tun_iface = detect_tun_interface_from_log(script_dir)
                 if tun_iface:
                     update_lock_state("dns_applied", True)
                     if is_systemd_resolved_active():
@@ -1366,15 +3840,18 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                 else:
                     safe_print(f"{YELLOW}Warning: TUN interface not detected for DNS.{NC}")
                 
+                timeline_phase("firewall")
                 if physical_device:
                     # --- NUEVO KILL SWITCH (Sobreseguridad) ---
                     r_ip, r_port, r_proto = extract_connection_details(script_dir)
+                    # Si el log no muestra la IP remota, usamos la que resolvimos antes de conectar
+                    if not r_ip: r_ip = vpn_host if is_valid_ip(vpn_host) else RESOLVER_CACHE.get(vpn_host)
                     
-                    if r_ip and r_port and tun_iface:
-                        # Leemos la configuración de DoH
-                        do_block_doh = config_mgr.get_doh_blocking()
-                        do_block_lan = config_mgr.get_lan_blocking()
-                        manage_kill_switch(physical_device, tun_iface, action="add", vpn_ip=r_ip, vpn_port=r_port, proto=r_proto, script_dir=script_dir, block_doh=do_block_doh, block_lan=do_block_lan)
+                    if r_ip and tun_iface and stage_thread:
+                        # Ya preparado durante el handshake: solo falta el tun
+                        ks_applied = bool(stage_result and stage_result[0]) and commit_kill_switch(tun_iface, r_ip)
+                    elif r_ip and tun_iface:
+                        ks_applied = manage_kill_switch(physical_device, tun_iface, action="add", vpn_ip=r_ip, vpn_port=r_port, proto=r_proto, script_dir=script_dir, block_doh=do_block_doh, block_lan=do_block_lan, backend=fw_backend)
                     else:
                         # NO FALLBACK - Abortar por seguridad
                         # NO FALLBACK - Abortar por seguridad
@@ -1388,36 +3865,53 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
                         time.sleep(5)
 
                         # Limpiamos usando la función centralizada y salimos
-                        cleanup(is_failure=True)
+                        cleanup(is_failure=final_attempt)
                         return None, False, None
 
+                    if not ks_applied:
+                        # Las reglas no entraron (la transacción es todo o nada): sin Kill Switch no seguimos
+                        safe_print(f"{RED}⚠️  {T('ks_apply_fail')} ⚠️{NC}")
+                        safe_print(f"{RED}{T('ks_abort_connection')}{NC}\n")
+                        time.sleep(5)
+                        cleanup(is_failure=final_attempt)
+                        return None, False, None
+
+                timeline_phase("route")
                 if ORIGINAL_DEFAULT_ROUTE_DETAILS:
                                        
                     safe_print(f"{BLUE}{T('del_orig_route')}{NC}")
-                    subprocess.run(["sudo", "ip", "route", "del", "default"], check=False, capture_output=True)
+                    priv_op("route", action="del", spec=["default"])
                 
-                if not check_and_set_default_route():
+                if not check_and_set_default_route(tun_iface):
                     safe_print(f"{YELLOW}Fail route.{NC}")
                     time.sleep(3)
                     display_failure_banner(T("fail_msg_route"))
-                    cleanup(is_failure=True)
+                    cleanup(is_failure=final_attempt)
                     return None, False, None
 
                 break
             
+            timeline_phase("retry_wait")
             safe_print(f"{RED}{T('attempt_fail', attempt)}{NC}")
-            if attempt < CONNECTION_ATTEMPTS: time.sleep(RETRY_DELAY)
+            if attempt < attempts: time.sleep(RETRY_DELAY)
 
         if not success:
             safe_print(f"{YELLOW}{T('fail_banner_wait')}{NC}")
             time.sleep(3)
-            display_failure_banner(T("fail_msg_attempts", CONNECTION_ATTEMPTS))
-            cleanup(is_failure=is_reconnecting)
+            display_failure_banner(T("fail_msg_attempts", attempts))
+            cleanup(is_failure=is_reconnecting and final_attempt)
             return None, False, None
 
+        # En modo carrera puede haber ganado otro perfil distinto del elegido
+        CONNECTED_PROFILE = timeline.profile = selected_file
+        remember_known_good(script_dir, selected_file)
+
+        timeline_phase("tunnel_ready")
         safe_print(f"\n{BLUE}{T('stabilizing')}{NC}")
-        time.sleep(3)
+        # En cuanto pasa el primer paquete por el túnel seguimos (la comprobación de abajo decide)
+        wait_until(tunnel_passes_traffic, TUNNEL_READY_TIMEOUT)
         
+        timeline_phase("ping_check")
         safe_print(f"{YELLOW}{T('check_ping')}{NC}", dynamic=True)
         try:
             ping3.ping("8.8.8.8", timeout=PING_TIMEOUT)
@@ -1427,51 +3921,34 @@ def establish_connection(selected_file, selected_location, initial_ip, is_reconn
             time.sleep(10)
             safe_print(f"{RED}{T('ping_fail')}{NC}")
             display_failure_banner(T("fail_msg_tunnel"))
-            cleanup(is_failure=is_reconnecting)
+            cleanup(is_failure=is_reconnecting and final_attempt)
             return None, False, None
 
-        new_ip, ip_verified = "N/A", False
-        for attempt in range(1, IP_VERIFY_ATTEMPTS + 1):
-            safe_print(f"{YELLOW}{T('check_ip', attempt, IP_VERIFY_ATTEMPTS)}{NC}", dynamic=True)
-            for service in ["ifconfig.me", "icanhazip.com", "ipinfo.io/ip"]:
-                try:
-                    res = subprocess.run(["curl", "-s", "--max-time", str(CURL_TIMEOUT), service], capture_output=True, text=True)
-                    if res.returncode == 0 and is_valid_ip(res.stdout.strip()):
-                        current_ip = res.stdout.strip()
-                        if current_ip != initial_ip:
-                            new_ip = current_ip
-                            ip_verified = True
-                            break
-                except Exception: pass
-            if ip_verified: break
-            if attempt < IP_VERIFY_ATTEMPTS: time.sleep(IP_RETRY_DELAY)
+        timeline_phase("public_ip")
+        new_ip = verify_new_public_ip(initial_ip)
 
-        if not ip_verified:
+        if not new_ip:
             safe_print(f"{YELLOW}{T('ip_fail_banner')}{NC}")
             time.sleep(3)
             display_failure_banner(T("fail_msg_ip"))
-            cleanup(is_failure=is_reconnecting)
+            cleanup(is_failure=is_reconnecting and final_attempt)
             return None, False, None
 
-        safe_print(f"\n{BLUE}{T('get_port')}{NC}")
-        internal_ip = get_vpn_internal_ip()
-        forwarded_port = get_forwarded_port(internal_ip)
-
-        if forwarded_port and forwarded_port.isdigit():
-            try:
-                with open(os.path.join(script_dir, PORT_FILE), 'w') as f:
-                    f.write(str(forwarded_port))
-                safe_print(f"{GREEN}{T('port_saved', forwarded_port, PORT_FILE)}{NC}")
-            except Exception: pass
-
+        timeline_phase("port_api")
+        forwarded_port = request_forwarded_port(script_dir)
+        connected = True
         return new_ip, False, forwarded_port
     except KeyboardInterrupt:
         cleanup(is_failure=False)
         safe_print(f"\n{YELLOW}{T('conn_cancel')}{NC}")
         return None, False, None
+    finally:
+        timeline.finish(os.path.dirname(os.path.realpath(__file__)), connected)
 
 def check_connection_status(expected_ip):
-    if subprocess.run(["pgrep", "-x", "openvpn"], capture_output=True).returncode != 0:
+    # Si la interfaz de gestión se ha cerrado, OpenVPN ya no está: no hace falta buscarlo
+    mgmt_closed = MGMT_CLIENT is not None and MGMT_CLIENT.connected and MGMT_CLIENT.closed
+    if mgmt_closed or not is_primary_openvpn_alive():
         safe_print(f"{RED}{T('status_disconnected')}{NC}")
         return True
     safe_print(f"{YELLOW}{T('check_conn')}{NC}", dynamic=True)
@@ -1484,15 +3961,10 @@ def check_connection_status(expected_ip):
             return True
     except Exception: return True
     current_ip = ""
-    for _ in range(3):
-        for service in ["ifconfig.me", "icanhazip.com", "ipinfo.io/ip"]:
-            try:
-                res = subprocess.run(["curl", "-s", "--max-time", str(CURL_TIMEOUT), service], capture_output=True, text=True)
-                if res.returncode == 0 and is_valid_ip(res.stdout.strip()):
-                    current_ip = res.stdout.strip()
-                    if current_ip == expected_ip: return False
-            except Exception: pass
-        time.sleep(IP_RETRY_DELAY)
+    for attempt in range(1, IP_VERIFY_ATTEMPTS + 1):
+        current_ip = public_ip_oracle().lookup(accept=lambda ip: ip == expected_ip) or current_ip
+        if current_ip == expected_ip: return False
+        if attempt < IP_VERIFY_ATTEMPTS: time.sleep(IP_RETRY_DELAY)
     safe_print(f"{RED}{T('status_ip_fail', current_ip or 'unknown')}{NC}")
     return True
 
@@ -1508,7 +3980,7 @@ def route_guardian():
                 if line.startswith('default') and 'dev tun' not in line:
                     offending_route = line.strip()
                     safe_print(f"\n{RED}{T('guardian_leak', offending_route)}{NC}")
-                    subprocess.run(f"sudo ip route del {offending_route}", shell=True, check=False, capture_output=True)
+                    priv_op("route", action="del", spec=route_selector(offending_route))
                     ROUTE_CORRECTION_COUNT += 1
                     LAST_RECONNECTION_TIME = time.time()
                     try:
@@ -1536,6 +4008,8 @@ def monitor_connection(config_mgr, selected_file, selected_location, initial_ip,
 
     try:
         while True:
+            refresh_doh_blocklist(os.path.dirname(os.path.realpath(__file__)))
+            maintain_standby(selected_file, config_mgr)
             clear_screen()
             safe_print(f"{BLUE}{T('mon_header')}{NC}")
             doh_s = config_mgr.get_doh_blocking()
@@ -1559,6 +4033,11 @@ def monitor_connection(config_mgr, selected_file, selected_location, initial_ip,
             safe_print(f"  {T('lbl_port')} {port_color}{port_display}{NC}")
             reconnection_color = RED if reconnection_count > 0 else NC
             safe_print(f"  {T('lbl_reconn')} {reconnection_color}{reconnection_count}{NC}")
+            if MGMT_CLIENT and MGMT_CLIENT.connected:
+                safe_print(f"  {T('lbl_traffic')} {GREEN}{format_bytes(MGMT_CLIENT.bytes_in)}{NC} / {GREEN}{format_bytes(MGMT_CLIENT.bytes_out)}{NC}")
+            if STANDBY:
+                standby_color = GREEN if is_tunnel_ready(STANDBY) else YELLOW
+                safe_print(f"  {T('lbl_standby')} {standby_color}{parse_location_name(STANDBY['file'], config_mgr.config)} ({STANDBY['tun']}){NC}")
 
             guardian_interval = 2
             if LAST_RECONNECTION_TIME is not None and (time.time() - LAST_RECONNECTION_TIME) < 900:
@@ -1674,26 +4153,58 @@ def monitor_connection(config_mgr, selected_file, selected_location, initial_ip,
                 guardian_thread.join(timeout=2)
                 
                 script_dir = os.path.dirname(os.path.realpath(__file__))
-                cached_iface = get_cached_physical_interface(script_dir)
+                # Primero el túnel de reserva, luego la vía rápida; si no sale, reconexión completa con failover
+                new_ip, new_dns_fallback, new_port = None, False, None
+                reconnect_timeline = start_timeline("reconnect", selected_file)
+                timeline_phase("standby_switch")
+                switched = switch_to_standby(initial_ip, config_mgr)
+                if switched:
+                    selected_file, new_ip, new_port = switched
+                    selected_location = parse_location_name(selected_file, config_mgr.config)
+                else:
+                    stop_standby()
+                    timeline_phase("fast_reconnect")
+                    new_ip, new_dns_fallback, new_port = fast_reconnect(selected_file, initial_ip, config_mgr) or (None, False, None)
+                reconnect_timeline.profile = selected_file
+                reconnect_timeline.finish(script_dir, bool(new_ip))
+                if not new_ip:
+                    safe_print(f"{YELLOW}{T('fast_reconn_fail')}{NC}")
+                    cached_iface = get_cached_physical_interface(script_dir)
                 
-                if cached_iface:
-                    manage_kill_switch(cached_iface, None, action="del")
-
-                cleanup(is_failure=False)
-                create_lock_file()
-                time.sleep(3)
-                new_ip, new_dns_fallback, new_port = establish_connection(selected_file, selected_location, initial_ip, is_reconnecting=True)
+                    if cached_iface:
+                        manage_kill_switch(cached_iface, None, action="del", backend=journaled_firewall_backend())
+
+                    cleanup(is_failure=False)
+                    create_lock_file()
+                    # Antes de reconectar: OpenVPN fuera y la ruta original de vuelta
+                    wait_until(lambda: not is_openvpn_running() and get_current_default_route_details(), NETWORK_RESTORE_TIMEOUT)
+                    # Failover: cada candidato tiene sus propios intentos; el Kill Switch solo salta si cae el último
+                    candidates = build_failover_candidates(selected_file, script_dir, config_mgr)
+                    attempts = FAILOVER_ATTEMPTS_PER_SERVER if len(candidates) > 1 else CONNECTION_ATTEMPTS
+                    for index, candidate in enumerate(candidates):
+                        candidate_location = parse_location_name(candidate, config_mgr.config)
+                        if index > 0:
+                            safe_print(f"\n{YELLOW}{T('failover_next', index + 1, len(candidates), candidate_location)}{NC}")
+                            create_lock_file()
+                            wait_until(lambda: not is_openvpn_running() and get_current_default_route_details(), NETWORK_RESTORE_TIMEOUT)
+                        new_ip, new_dns_fallback, new_port = establish_connection(candidate, candidate_location, initial_ip, is_reconnecting=True,
+                                                                                  attempts=attempts, final_attempt=(index == len(candidates) - 1))
+                        if new_ip:
+                            selected_file, selected_location = candidate, candidate_location
+                            break
                 if not new_ip:
                     safe_print(f"\n{RED}{T('reconn_fail_kill')}{NC}")
                     time.sleep(5)
                     return
                 vpn_ip, forwarded_port = new_ip, new_port
+                journal_session(selected_file, initial_ip, vpn_ip, forwarded_port)
                 ROUTE_CORRECTION_COUNT = 0
                 LAST_RECONNECTION_TIME = None
                 last_analysis_time = 0
                 analysis_result_block = None
                 send_critical_notification(T("notif_reconn_title"), T("notif_reconn_msg", forwarded_port))
-                display_success_banner(selected_location, initial_ip, vpn_ip, True, reconnection_count)
+                display_success_banner(selected_location, initial_ip, vpn_ip, True, reconnection_count,
+                                       timeline=TIMELINE if config_mgr.get_timeline_summary() else None)
                 #### Ejecutar script post-conexión tras reconexión
                 script_dir = os.path.dirname(os.path.realpath(__file__))
                 run_post_script(ConfigManager(script_dir))
@@ -1701,11 +4212,12 @@ def monitor_connection(config_mgr, selected_file, selected_location, initial_ip,
                 GUARDIAN_STOP_EVENT.clear()
                 guardian_thread = threading.Thread(target=route_guardian, daemon=True)
                 guardian_thread.start()
-                time.sleep(4)
+                wait_for_enter(BANNER_PAUSE)
                 continue
             
             safe_print(f"{RED}{T('ctrl_c_exit')}{NC}", dynamic=True)
-            time.sleep(MONITOR_INTERVAL)
+            # Si OpenVPN avisa de una caída, comprobamos ya en vez de esperar al siguiente ciclo
+            wait_for_tunnel_drop(MONITOR_INTERVAL)
     except KeyboardInterrupt:
         safe_print(f"\n{YELLOW}Stop signal.{NC}")
         GUARDIAN_STOP_EVENT.set()
@@ -1720,7 +4232,7 @@ def display_failure_banner(reason):
     safe_print(f"{RED}{'-'*60}{NC}")
     safe_print(f"\n  {reason}")
 
-def display_success_banner(location, initial_ip, new_ip, is_reconnecting=False, count=0):
+def display_success_banner(location, initial_ip, new_ip, is_reconnecting=False, count=0, timeline=None):
     w = 16
     clear_screen()
     safe_print(f"{GREEN}       {T('succ_title')}")
@@ -1733,13 +4245,58 @@ def display_success_banner(location, initial_ip, new_ip, is_reconnecting=False,
     # CAMBIO: IP Original en PINK
     safe_print(f"  {T('succ_orig_ip').strip().ljust(w)} {PINK}{initial_ip}{NC}")
     
-    safe_print(f"  {T('succ_vpn_ip').strip().ljust(w)} {GREEN}{new_ip}{NC}\n")
+    safe_print(f"  {T('succ_vpn_ip').strip().ljust(w)} {GREEN}{new_ip}{NC}")
+    if timeline: safe_print(f"  {T('lbl_timeline').strip().ljust(w)} {BLUE}{timeline.summary()}{NC}")
+    safe_print("")
     safe_print(f"  {BLUE}{T('legend_title')}{NC}")
     safe_print(f"  {GREEN}{T('legend_1')}{NC}")
     safe_print(f"  {YELLOW}{T('legend_2')}{NC}")
     safe_print(f"  {RED}{T('legend_3')}{NC}")
 
-def get_user_choice(locations, last_choice=None, top_stats=None):
+def read_choice_line(prompt, live_scan=None):
+    """
+    input() que, mientras hay un escaneo en curso, vuelve con None cuando llegan
+    resultados nuevos (como mucho cada LIVE_REDRAW_INTERVAL s) para redibujar el menú.
+    Con la primera tecla deja de redibujar: el número que se teclea es el de las filas que hay en pantalla.
+    """
+    if not live_scan or (not live_scan.is_running() and not live_scan.changed.is_set()) or not sys.stdin.isatty():
+        return input(prompt)
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    # Tecla a tecla y con eco propio: en modo línea no se ve que el usuario ha empezado a escribir
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
+    mode = termios.tcgetattr(fd)
+    mode[3] &= ~(termios.ICANON | termios.ECHO)
+    mode[6][termios.VMIN], mode[6][termios.VTIME] = 1, 0
+    termios.tcsetattr(fd, termios.TCSANOW, mode)
+    line = ""
+    try:
+        while True:
+            if not line:
+                ready, _, _ = select.select([fd], [], [], 0.25)
+                if not ready:
+                    if live_scan.changed.is_set() and time.monotonic() - live_scan.last_redraw >= LIVE_REDRAW_INTERVAL:
+                        live_scan.changed.clear()
+                        live_scan.last_redraw = time.monotonic()
+                        return None
+                    continue
+            char = os.read(fd, 1).decode(errors="ignore")
+            if char in ("\n", "\r"):
+                sys.stdout.write("\n")
+                return line
+            if char == "\x04" and not line: raise EOFError # Ctrl+D
+            if char in ("\x7f", "\b"):
+                if line: sys.stdout.write("\b \b")
+                line = line[:-1]
+            elif char.isprintable():
+                line += char
+                sys.stdout.write(char)
+            sys.stdout.flush()
+    finally:
+        termios.tcsetattr(fd, termios.TCSANOW, saved)
+
+def get_user_choice(locations, last_choice=None, top_stats=None, live_scan=None):
     safe_print(f"\n{BLUE}{T('menu_avail')}{NC}")
     
     # (Aquí ya NO imprimimos top_stats)
@@ -1793,7 +4350,8 @@ def get_user_choice(locations, last_choice=None, top_stats=None):
     
     while True:
         try:
-            choice_str = input(prompt)
+            choice_str = read_choice_line(prompt, live_scan)
+            if choice_str is None: return 'REDRAW'
             if choice_str.lower() == 'm': return 'MENU'
             if choice_str.lower() == 'p': return 'PING'
             
@@ -1984,6 +4542,56 @@ def configure_locks_screen(config_mgr):
         elif sel == "2":
             config_mgr.set_lan_blocking(not lan_state)
 
+def configure_advanced_screen(config_mgr):
+    while True:
+        clear_screen()
+        safe_print(f"{BLUE}    {T('menu_opt_advanced')}")
+        safe_print(f"{BLUE}{'-'*60}{NC}")
+
+        ttl_min = config_mgr.get_history_ttl() // 60
+        safe_print(f"  1) {T('adv_history_ttl')} {GREEN}{ttl_min} min{NC}")
+        method_txt = T('adv_method_handshake') if config_mgr.get_scan_method() == SCAN_METHOD_HANDSHAKE else T('adv_method_icmp')
+        safe_print(f"  2) {T('adv_scan_method')} {GREEN}{method_txt}{NC}")
+        race_count = config_mgr.get_race_count()
+        race_txt = f"{GREEN}{race_count}{NC}" if race_count > 1 else f"{RED}{T('adv_race_off')}{NC}"
+        safe_print(f"  3) {T('adv_race')} {race_txt}")
+        failover_txt = T('adv_failover_country') if config_mgr.get_failover_same_country() else T('adv_failover_any')
+        safe_print(f"  4) {T('adv_failover')} {GREEN}{failover_txt}{NC}")
+        standby_txt = f"{GREEN}{T('adv_on')}{NC}" if config_mgr.get_standby_enabled() else f"{RED}{T('adv_off')}{NC}"
+        safe_print(f"  5) {T('adv_standby')} {standby_txt}")
+        timeline_txt = f"{GREEN}{T('adv_on')}{NC}" if config_mgr.get_timeline_summary() else f"{RED}{T('adv_off')}{NC}"
+        safe_print(f"  6) {T('adv_timeline')} {timeline_txt}")
+        backend = config_mgr.get_firewall_backend()
+        backend_txt = f"{T('adv_fw_auto')} ({resolve_firewall_backend(config_mgr)})" if backend == FIREWALL_AUTO else backend
+        safe_print(f"  7) {T('adv_fw_backend')} {GREEN}{backend_txt}{NC}")
+
+        sel = input(f"\n{T('adv_prompt')}")
+
+        if not sel: break
+
+        if sel == "1":
+            try:
+                minutes = int(input(T('adv_history_ttl_q')))
+                if minutes >= 0: config_mgr.set_history_ttl(minutes * 60)
+            except ValueError: pass
+        elif sel == "2":
+            is_handshake = config_mgr.get_scan_method() == SCAN_METHOD_HANDSHAKE
+            config_mgr.set_scan_method(SCAN_METHOD_ICMP if is_handshake else SCAN_METHOD_HANDSHAKE)
+        elif sel == "3":
+            try:
+                count = int(input(T('adv_race_q', RACE_MAX_PROFILES)))
+                if 1 <= count <= RACE_MAX_PROFILES: config_mgr.set_race_count(count)
+            except ValueError: pass
+        elif sel == "4":
+            config_mgr.set_failover_same_country(not config_mgr.get_failover_same_country())
+        elif sel == "5":
+            config_mgr.set_standby_enabled(not config_mgr.get_standby_enabled())
+        elif sel == "6":
+            config_mgr.set_timeline_summary(not config_mgr.get_timeline_summary())
+        elif sel == "7":
+            backends = [FIREWALL_AUTO, FIREWALL_NFTABLES, FIREWALL_IPTABLES]
+            config_mgr.set_firewall_backend(backends[(backends.index(config_mgr.get_firewall_backend()) + 1) % len(backends)])
+
 def select_language_screen(config_mgr):
     global CURRENT_LANG
     clear_screen()
@@ -2016,7 +4624,8 @@ def main_menu_screen(config_mgr, script_dir):
         safe_print(f"  4) {T('menu_opt_post')}")
         safe_print(f"  5) {T('menu_opt_launcher')}")
         safe_print(f"  6) {T('menu_opt_locks')}")
-        safe_print(f"  7) {T('menu_opt_back')}")
+        safe_print(f"  7) {T('menu_opt_advanced')}")
+        safe_print(f"  8) {T('menu_opt_back')}")
         try:
             sel = input("\n> ")
             if not sel: break
@@ -2026,7 +4635,8 @@ def main_menu_screen(config_mgr, script_dir):
             elif sel == "4": configure_post_script_screen(config_mgr)
             elif sel == "5": create_desktop_launcher()
             elif sel == "6": configure_locks_screen(config_mgr)
-            elif sel == "7": break    
+            elif sel == "7": configure_advanced_screen(config_mgr)
+            elif sel == "8": break    
         except KeyboardInterrupt: break
         
 def run_post_script(config_mgr):
@@ -2055,6 +4665,9 @@ def run_post_script(config_mgr):
 def main():
     global CURRENT_LANG
     script_dir = os.path.dirname(os.path.realpath(__file__))
+    startup_timeline = start_timeline("startup")
+    timeline_phase("lock_check")
+    resumed = None
     
     # --- CONTROL DE INSTANCIA ÚNICA (LOCKFILE INTELIGENTE) ---
     lock_path = os.path.join(script_dir, LOCK_FILE)
@@ -2081,21 +4694,25 @@ def main():
                 time.sleep(3)
                 sys.exit(1)
             else:
-                safe_print(f"{YELLOW}Detectado cierre incorrecto previo (PID {old_pid}). Limpiando sistema...{NC}")
-                cleanup(is_failure=False, state_override=lock_data)
+                safe_print(f"{YELLOW}Detectado cierre incorrecto previo (PID {old_pid}). Comprobando el túnel anterior...{NC}")
+                resumed = adopt_running_tunnel(lock_data)
+                if not resumed:
+                    safe_print(f"{YELLOW}Limpiando sistema...{NC}")
+                    cleanup(is_failure=False, state_override=lock_data)
 
         except (json.JSONDecodeError, ValueError):
             pass
 
-    create_lock_file()
+    if not resumed: create_lock_file()
 
+    timeline_phase("config")
     config_mgr = ConfigManager(script_dir)
     saved_lang = config_mgr.get_language()
     if saved_lang: CURRENT_LANG = saved_lang
     else: select_language_screen(config_mgr)
 
-    if not all(which(cmd) for cmd in ["openvpn", "curl", "sudo", "stty", "nmcli", "ip", "iptables"]):
-        safe_print(f"{RED}{T('error_lib', 'openvpn/curl/sudo/stty/nmcli/ip/iptables')}{NC}")
+    if not all(which(cmd) for cmd in ["openvpn", "sudo", "stty", "nmcli", "ip"]) or not (which("iptables") or which("nft")):
+        safe_print(f"{RED}{T('error_lib', 'openvpn/sudo/stty/nmcli/ip/iptables|nft')}{NC}")
         sys.exit(1)
 
     clear_screen()
@@ -2109,61 +4726,60 @@ def main():
     safe_print(f"\n{RED}{'-'*60}{NC}")
     safe_print(f"{RED}{T('sudo_simple')}{NC}")
     safe_print(f"{RED}{'-'*60}{NC}\n")
+    timeline_phase("sudo")
     if subprocess.run(["sudo", "-v"], capture_output=True).returncode != 0:
         safe_print(f"{RED}{T('sudo_error')}{NC}")
         sys.exit(1)
     
+    timeline_phase("priv_helper")
+    start_priv_helper()
     threading.Thread(target=keep_sudo_alive, daemon=True).start()
 
-    backup_original_dns(script_dir, os.path.join(script_dir, DNS_BACKUP_FILE))
+    if resumed:
+        # Túnel adoptado: la IP original y el backup de DNS siguen siendo los de la sesión anterior
+        initial_ip, conn_success = resumed["initial_ip"], True
+    else:
+        timeline_phase("dns_backup")
+        backup_original_dns(script_dir, os.path.join(script_dir, DNS_BACKUP_FILE))
 
-    safe_print(f"{BLUE}{T('check_conn')}{NC}")
-    initial_ip = None
-    
-    conn_success = False
-    providers = ["ifconfig.me", "icanhazip.com", "ipinfo.io/ip"]
-    for provider in providers:
-        try:
-            res = subprocess.run(["curl", "-4", "-s", "--max-time", str(CURL_TIMEOUT), provider], capture_output=True, text=True, check=True)
-            if is_valid_ip(res.stdout.strip()):
-                initial_ip = res.stdout.strip()
-                conn_success = True
-                safe_print(f"{GREEN}{T('conn_confirmed')}{NC}")
-                break
-        except Exception:
-            continue
+        timeline_phase("public_ip")
+        safe_print(f"{BLUE}{T('check_conn')}{NC}")
+        # La IP original es la referencia para todo lo demás: que la confirmen dos proveedores si es posible
+        initial_ip = public_ip_oracle().lookup(quorum=IP_ORACLE_QUORUM)
+        conn_success = initial_ip is not None
+        if conn_success: safe_print(f"{GREEN}{T('conn_confirmed')}{NC}")
 
     if not conn_success:
+        timeline_phase("network_repair")
         safe_print(f"{YELLOW}{T('repair_attempt')}{NC}")
         
         iface = get_cached_physical_interface(script_dir)
         if iface:
             manage_kill_switch(iface, None, action="del")
             if is_systemd_resolved_active():
-                subprocess.run(["sudo", "resolvectl", "revert", iface], check=False, stderr=subprocess.DEVNULL)
+                priv_op("resolved_revert", iface=iface)
         try:
             safe_print(T('repair_restoring'))
             if is_systemd_resolved_active():
-                 subprocess.run(["sudo", "resolvectl", "flush-caches"], check=False, stderr=subprocess.DEVNULL)
+                 priv_op("resolved_flush")
             
             nmcli_output = subprocess.run(["nmcli", "-t", "-f", "NAME,DEVICE", "connection", "show", "--active"], capture_output=True, text=True).stdout
             for line in nmcli_output.strip().split('\n'):
                 parts = line.split(':')
                 if len(parts) > 1 and parts[1].lower() != 'lo' and not parts[1].lower().startswith('tun'):
-                    subprocess.run(["sudo", "nmcli", "connection", "modify", parts[0], "ipv4.never-default", "no"], check=True, capture_output=True)
-                    subprocess.run(["sudo", "nmcli", "connection", "modify", parts[0], "ipv4.ignore-auto-routes", "no"], check=True, capture_output=True)
-                    subprocess.run(["sudo", "nmcli", "connection", "modify", parts[0], "ipv6.method", "disabled"], check=True, capture_output=True)
+                    priv_op("nm_connection_routes", name=parts[0], never_default="no", ignore_auto_routes="no",
+                            ipv6_method="disabled", strict=True, check=True)
             
             safe_print(T('repair_reset'))
-            subprocess.run(["sudo", "nmcli", "networking", "off"], check=True, capture_output=True)
+            priv_op("nm_networking", state="off", check=True)
             time.sleep(10)
-            subprocess.run(["sudo", "nmcli", "networking", "on"], check=True, capture_output=True)
+            priv_op("nm_networking", state="on", check=True)
             time.sleep(20) 
             
             safe_print(T('repair_verify'))
-            res = subprocess.run(["curl", "-s", "--max-time", str(CURL_TIMEOUT), "ifconfig.me"], capture_output=True, text=True, check=True)
-            if not is_valid_ip(res.stdout.strip()): raise ValueError("Invalid IP")
-            initial_ip = res.stdout.strip()
+            public_ip_oracle().reset()
+            initial_ip = public_ip_oracle().lookup()
+            if not initial_ip: raise ValueError("Invalid IP")
             safe_print(f"{GREEN}{T('repair_success')}{NC}")
             time.sleep(4)
         except Exception as e:
@@ -2174,6 +4790,8 @@ def main():
             time.sleep(15)
             sys.exit(1)
 
+    startup_timeline.finish(script_dir, True)
+
     vpn_user, vpn_pass = config_mgr.get_credentials()
     if not vpn_user or not vpn_pass:
         safe_print(f"\n{YELLOW}No se detectaron credenciales guardadas.{NC}")
@@ -2181,18 +4799,40 @@ def main():
 
     # --- VARIABLES DE ESTADO PARA EL MENÚ (v207) ---
     sorted_files = None      # Lista ordenada por ping (si existe)
-    down_files = set()       # Conjunto de archivos que dieron error (para pintar en gris)
+    down_files = {}          # Archivos caídos (None, en gris) o con pérdidas (resumen de pérdida/jitter)
     top_stats = None         # Texto con el Top 3
+
+    # --- HISTORIAL (v211): el menú arranca ordenado y se refresca lo caducado en segundo plano ---
+    history = LatencyHistory(script_dir)
+
+    if resumed:
+        resumed_location = parse_location_name(resumed["profile"], config_mgr.config)
+        safe_print(f"{GREEN}{T('resume_adopted', resumed_location)}{NC}")
+        wait_for_enter(BANNER_PAUSE)
+        monitor_connection(config_mgr, resumed["profile"], resumed_location, initial_ip, resumed["vpn_ip"], False, resumed["port"])
+
+    # Después del túnel retomado: con él (y su Kill Switch) puesto las medidas no valdrían
+    live_scan = refresh_history_async(history, sorted([f for f in os.listdir(script_dir) if f.endswith(".ovpn")]),
+                                      script_dir, config_mgr.get_history_ttl(), config_mgr.get_scan_method())
     
     while True:
         create_lock_file()
         try:
             # 1. CARGA DE ARCHIVOS
-            # Si ya tenemos una lista ordenada por Ping, la usamos. Si no, carga alfabética normal.
-            if sorted_files:
-                ovpn_files = sorted_files
-            else:
-                ovpn_files = sorted([f for f in os.listdir(script_dir) if f.endswith(".ovpn")])
+            # Si hay historial de latencias, ordenamos con él. Si no, carga alfabética normal.
+            # Durante un escaneo, los resultados que van llegando sustituyen a los del historial.
+            all_files = sorted([f for f in os.listdir(script_dir) if f.endswith(".ovpn")])
+            scan_pending = set()
+            results = history.results_for(all_files)
+            if live_scan and live_scan.is_running():
+                live_results, scan_pending = live_scan.snapshot()
+                results.update(live_results)
+            if results:
+                sorted_files, down_files, top_stats = rank_scan_results(all_files, results, config_mgr.config)
+            if scan_pending:
+                progress = T('scan_progress', len(live_scan.files) - len(scan_pending), len(live_scan.files))
+                top_stats = f"{top_stats}\n{YELLOW}{progress}{NC}" if top_stats else f"{YELLOW}{progress}{NC}"
+            ovpn_files = sorted_files if sorted_files else all_files
             
             if not ovpn_files: raise FileNotFoundError(T("err_no_ovpn"))
             
@@ -2200,9 +4840,16 @@ def main():
             locations = []
             for f in ovpn_files:
                 name = parse_location_name(f, config_mgr.config)
-                # Si el archivo está en la lista de caídos, lo pintamos de gris oscuro
+                # Si el archivo está en la lista de caídos, lo pintamos de gris oscuro;
+                # si solo pierde paquetes, mostramos pérdida y jitter junto al nombre
                 if f in down_files:
-                    name = f"\033[38;5;244m{name}{NC}"
+                    if down_files[f] is None:
+                        name = f"\033[38;5;244m{name}{NC}"
+                    else:
+                        name = f"{name} {format_scan_stats(down_files[f])}"
+                # Aún sin medir en el escaneo en curso
+                if f in scan_pending:
+                    name = f"{name} {YELLOW}…{NC}"
                 locations.append(name)
                 
         except Exception as e:
@@ -2235,89 +4882,187 @@ def main():
         if last_choice and (last_choice < 1 or last_choice > len(locations)): 
             last_choice = None
             
-        # Pasamos 'top_stats' al menú
-        choice = get_user_choice(locations, last_choice, top_stats)
+        # Pasamos 'top_stats' al menú (y el escaneo en curso, para redibujar según llegan resultados)
+        choice = get_user_choice(locations, last_choice, top_stats, live_scan)
         
+        if choice == 'REDRAW':
+            continue
+
         if choice == 'MENU':
             main_menu_screen(config_mgr, script_dir)
             continue
             
         # --- BLOQUE DE PING (NUEVO v207) ---
         if choice == 'PING':
-            safe_print(f"\n{YELLOW}Analizando latencias... (Esto tomará unos segundos){NC}")
-            
-            # 1. Escanear
-            results = scan_latencies_parallel(ovpn_files, script_dir)
-            
-            # 2. Procesar resultados
-            combined = []
-            new_down_files = set()
-            
-            for f in ovpn_files:
-                lat = results.get(f)
-                if lat is None:
-                    sort_val = 9999 # Al final de la lista
-                    new_down_files.add(f)
-                else:
-                    sort_val = lat
-                combined.append((sort_val, f, lat))
-            
-            # 3. Ordenar (Menor latencia primero)
-            combined.sort(key=lambda x: x[0])
-            
-            # 4. Actualizar estado
-            sorted_files = [x[1] for x in combined]
-            down_files = new_down_files
-            
-            # 5. Generar Top 3 (Diseño: Top 3 verde, Nombres blanco/amarillo, Ping verde sin paréntesis)
-            top_list_formatted = []
-            last_profile_chk = config_mgr.get_last_profile() # Para saber cuál pintar de amarillo
-
-            for item in combined[:3]: # Solo procesamos los 3 primeros
-                if item[2] is not None:
-                    clean_name = parse_location_name(item[1], config_mgr.config)
-                    ping_val = int(item[2])
-
-                    # Color del nombre: Amarillo si es el seleccionado, Blanco (NC) si no
-                    if item[1] == last_profile_chk:
-                        c_name = YELLOW
-                    else:
-                        c_name = NC # Blanco/Default
-
-                    # Formato: Nombre COLOR_PINGms (sin paréntesis)
-                    entry = f"{c_name}{clean_name}{NC} {GREEN}{ping_val}ms{NC}"
-                    top_list_formatted.append(entry)
-            
-            if top_list_formatted:
-                # Etiqueta "Top 3:" en VERDE, sin >> <<
-                top_stats = f"{GREEN}Top 3:{NC} {' | '.join(top_list_formatted)}"
-            else:
-                top_stats = f"{GREEN}Top 3:{NC} {RED}Sin respuesta{NC}"
+            # Escaneo en segundo plano: el menú se reordena en vivo según llegan los resultados
+            # y se puede elegir servidor sin esperar al más lento. Al acabar queda en el historial.
+            if not (live_scan and live_scan.is_running()):
+                live_scan = LiveScan(ovpn_files, script_dir, config_mgr.get_scan_method(), history).start()
             continue
 
-        selected_file, selected_location = ovpn_files[choice - 1], locations[choice - 1]
+        selected_file = ovpn_files[choice - 1]
+        selected_location = parse_location_name(selected_file, config_mgr.config)
         
         # Guardamos TANTO el número (para backup) COMO el nombre (para el futuro ordenamiento)
         config_mgr.set_last_choice(choice)
         config_mgr.set_last_profile(selected_file)
 
-        new_ip, dns_fallback_used, forwarded_port = establish_connection(selected_file, selected_location, initial_ip)
+        race_files = None
+        if config_mgr.get_race_count() > 1:
+            race_files = pick_race_candidates(selected_file, ovpn_files, down_files, config_mgr.get_race_count())
+
+        # Ni una sonda más a partir de aquí: el Kill Switch las cortaría y el historial las daría por caídas
+        if live_scan: live_scan.cancel()
+        new_ip, dns_fallback_used, forwarded_port = establish_connection(selected_file, selected_location, initial_ip, race_files=race_files)
         
         if new_ip:
-            safe_print(f"{GREEN}OK. 7s...{NC}")
-            time.sleep(7)
-            display_success_banner(selected_location, initial_ip, new_ip)
+            if CONNECTED_PROFILE and CONNECTED_PROFILE != selected_file:
+                selected_file = CONNECTED_PROFILE
+                selected_location = parse_location_name(selected_file, config_mgr.config)
+            # Listo cuando el DNS ya resuelve por el túnel (como mucho RESOLVER_READY_TIMEOUT)
+            safe_print(f"{GREEN}OK...{NC}")
+            wait_until(resolver_answers, RESOLVER_READY_TIMEOUT)
+            journal_session(selected_file, initial_ip, new_ip, forwarded_port)
+            display_success_banner(selected_location, initial_ip, new_ip, timeline=TIMELINE if config_mgr.get_timeline_summary() else None)
             
             run_post_script(config_mgr)
 
-            time.sleep(5)
+            wait_for_enter(BANNER_PAUSE)
             
             monitor_connection(config_mgr, selected_file, selected_location, initial_ip, new_ip, dns_fallback_used, forwarded_port)
         else:
             safe_print(f"\n{YELLOW}Menu 5s...{NC}")
             time.sleep(5)
 
+# --- ESCANEO SIN INTERFAZ (--scan) ---
+SCAN_OUTPUT_FIELDS = ["time", "file", "host", "port", "proto", "method", "status",
+                      "min", "p50", "p95", "jitter", "loss", "score"]
+
+def scan_result_row(f, stats):
+    """Fila plana (JSON/CSV) con el resultado de un perfil."""
+    row = {"time": datetime.now().isoformat(timespec="seconds"), "file": f,
+           "host": None, "port": None, "proto": None, "method": None, "status": "down",
+           "min": None, "p50": None, "p95": None, "jitter": None, "loss": None, "score": None}
+    if stats:
+        row["host"], row["port"], row["proto"] = (stats.get("endpoint") or [None, None, None])
+        row["method"], row["status"] = stats.get("method"), "up"
+        for key in ("min", "p50", "p95", "jitter", "loss", "score"):
+            row[key] = round(stats[key], 3)
+    return row
+
+def run_headless_scan(argv):
+    """
+    Modo no interactivo para cron/scripts: escanea un directorio de .ovpn con el motor paralelo
+    y emite los resultados según llegan, en JSON lines o CSV, sin terminal ni sudo.
+    """
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__), description="Headless VPN server scan")
+    parser.add_argument("--scan", metavar="DIR", required=True, help="directory with .ovpn files")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("--method", choices=[SCAN_METHOD_HANDSHAKE, SCAN_METHOD_ICMP], default=SCAN_METHOD_HANDSHAKE)
+    parser.add_argument("--count", type=int, default=SCAN_SAMPLES,
+                        help="probes per server (handshake rounds or ICMP pings); profiles sharing a host probe it once (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=None, help="per-probe timeout in seconds")
+    parser.add_argument("--concurrency", type=int, default=None, help="max servers probed at once")
+    args = parser.parse_args(argv)
+
+    scan_dir = os.path.realpath(args.scan)
+    try:
+        ovpn_files = sorted(f for f in os.listdir(scan_dir) if f.endswith(".ovpn"))
+    except OSError as e:
+        sys.stderr.write(f"Error: {e}\n")
+        return 1
+    if not ovpn_files:
+        sys.stderr.write(f"{T('err_no_ovpn')}: {scan_dir}\n")
+        return 1
+
+    if args.format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=SCAN_OUTPUT_FIELDS)
+        writer.writeheader()
+        emit = writer.writerow
+    else:
+        emit = lambda row: sys.stdout.write(json.dumps(row) + "\n")
+
+    # Los perfiles con un solo 'remote' ya son definitivos al primer resultado: salen al momento.
+    # Los de varios 'remote' (pueden mejorar) y los caídos salen al terminar.
+    single_remote = {f for f in ovpn_files if len(parse_ovpn_profile(os.path.join(scan_dir, f))["remotes"]) == 1}
+    emitted = set()
+    emit_lock = threading.Lock()
+
+    def on_result(f, stats):
+        if f not in single_remote: return
+        with emit_lock:
+            if f in emitted: return
+            emitted.add(f)
+            emit(scan_result_row(f, stats))
+            sys.stdout.flush()
+
+    results = scan_latencies_parallel(ovpn_files, scan_dir, count=max(1, args.count), method=args.method,
+                                      on_result=on_result, timeout=args.timeout, concurrency=args.concurrency)
+    for f in ovpn_files:
+        if f not in emitted:
+            emit(scan_result_row(f, results.get(f)))
+    sys.stdout.flush()
+
+    # Si se escanea la carpeta del script, el resultado alimenta también el historial del menú
+    if scan_dir == os.path.dirname(os.path.realpath(__file__)):
+        LatencyHistory(scan_dir).record(results)
+    return 0
+
+# --- INFORME DE TIEMPOS (--timeline) ---
+def median_of(values):
+    return statistics.median(values) if values else None
+
+def span_values(runs, name):
+    """Duraciones de un tramo ('total' para la conexión entera) en las ejecuciones que lo tienen."""
+    if name == "total": return [r["total"] for r in runs]
+    return [r["spans"][name] for r in runs if name in r["spans"]]
+
+def run_timeline_report(argv):
+    """
+    Resumen del historial de líneas de tiempo: mediana de cada tramo en las últimas conexiones
+    frente a las anteriores (regresiones) y duración por servidor (servidores lentos).
+    """
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__), description="Connection timeline report")
+    parser.add_argument("--timeline", action="store_true", required=True)
+    parser.add_argument("--last", type=int, default=20, help="connections in the recent window")
+    args = parser.parse_args(argv)
+
+    history_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), TIMELINE_HISTORY_FILE)
+    try:
+        with open(history_path, "r") as f:
+            runs = json.load(f).get("runs", [])
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: {e}\n")
+        return 1
+
+    last = max(1, args.last)
+    connects = [r for r in runs if r.get("kind") == "connect"]
+    recent, previous = connects[-last:], connects[-2 * last:-last]
+    fmt = lambda value: f"{value:8.2f}" if value is not None else "       -"
+
+    print(f"{'span':<22}{'recent':>8}{'before':>8}{'delta':>8}")
+    names = sorted({name for r in recent for name in r["spans"]}, key=lambda n: -median_of(span_values(recent, n)))
+    for name in ["total"] + names:
+        now, before = median_of(span_values(recent, name)), median_of(span_values(previous, name))
+        delta = now - before if now is not None and before is not None else None
+        print(f"{name:<22}{fmt(now)}{fmt(before)}{fmt(delta)}")
+
+    print(f"\n{'profile':<40}{'runs':>6}{'fail':>6}{'median':>8}")
+    profiles = {}
+    for r in connects:
+        profiles.setdefault(r.get("profile") or "-", []).append(r)
+    for profile, profile_runs in sorted(profiles.items(), key=lambda item: -(median_of([r["total"] for r in item[1] if r["ok"]]) or 0)):
+        failures = sum(1 for r in profile_runs if not r["ok"])
+        print(f"{profile:<40}{len(profile_runs):>6}{failures:>6}{fmt(median_of([r['total'] for r in profile_runs if r['ok']]))}")
+    return 0
+
 if __name__ == "__main__":
+    if "--priv-helper" in sys.argv:
+        sys.exit(run_priv_helper())
+    if "--scan" in sys.argv:
+        sys.exit(run_headless_scan(sys.argv[1:]))
+    if "--timeline" in sys.argv:
+        sys.exit(run_timeline_report(sys.argv[1:]))
     if "--run-in-terminal" not in sys.argv:
         script_path = os.path.realpath(__file__)
         terminals = {
@@ -56,79 +56,80 @@ fi
 echo "Analizando archivos .ovpn en: $(realpath "$OVPN_DIR")"
 echo "------------------------------------------------------------------"
 
-# --- 1. Extraer Hosts y Ciudades ---
-declare -A host_to_city
-for file in "$OVPN_DIR"/*.ovpn; do
-    # Intenta extraer la ciudad del nombre del archivo, usando '-' como delimitador.
-    city=$(basename "$file" .ovpn | cut -d'-' -f3)
-    [ -z "$city" ] && city="Desconocida"
-
-    file_hosts=$(grep -E '^remote\s' "$file" | awk '{print $2}')
-    for host in $file_hosts; do
-        if [[ -z "${host_to_city[$host]}" ]]; then
-            host_to_city["$host"]=$city
-        fi
-    done
-done
-
-HOSTS="${!host_to_city[@]}"
+# --- 1. Escaneo en paralelo (motor de convpn) ---
+# El ping en serie (ping -c 2 -W 1.5 host a host) tardaba minutos con un directorio completo.
+# Ahora delegamos en 'convpn210.py --scan', que sondea todos los servidores a la vez
+# (handshake OpenVPN con ICMP de respaldo) y devuelve una línea JSON por perfil.
+CONVPN_SCRIPT="$(dirname "$(readlink -f "$0")")/convpn210.py"
+if [ ! -f "$CONVPN_SCRIPT" ]; then
+    echo "Error: No se encontró '$CONVPN_SCRIPT'."
+    exit 1
+fi
 
-if [ -z "$HOSTS" ]; then
-    echo "No se encontraron hosts en los archivos .ovpn."
+SCAN_JSON=$(python3 "$CONVPN_SCRIPT" --scan "$OVPN_DIR" --format json)
+if [ $? -ne 0 ] || [ -z "$SCAN_JSON" ]; then
+    echo "Error: El escaneo falló."
     exit 1
 fi
 
-echo "Se encontraron ${#host_to_city[@]} servidores únicos. Realizando ping..."
+# JSON y no CSV: un nombre de archivo con comas no descoloca los campos.
+# Una fila por servidor, no por perfil: los .ovpn que comparten host salen una sola vez
+# (con la ciudad del primero, y como disponible si responde por alguno de ellos).
+# Salida separada por tabuladores: estado, p50, ciudad, servidor, % de pérdida.
+# La ciudad se extrae del nombre del archivo, usando '-' como delimitador (campo 3).
+SCAN_ROWS=$(echo "$SCAN_JSON" | python3 -c '
+import sys, json, os
+
+def first_remote(name):
+    # Los caídos no traen endpoint: su servidor es el primer "remote" del perfil
+    try:
+        with open(os.path.join(sys.argv[1], name)) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) > 1 and parts[0] == "remote": return parts[1]
+    except OSError: pass
+    return name
+
+rows = sorted((json.loads(line) for line in sys.stdin if line.strip()), key=lambda row: (row["status"] != "up", row["file"]))
+seen = set()
+for row in rows:
+    host = row.get("host") or first_remote(row["file"])
+    if host in seen: continue
+    seen.add(host)
+    parts = row["file"][:-5].split("-") if row["file"].endswith(".ovpn") else row["file"].split("-")
+    city = parts[2] if len(parts) >= 3 and parts[2] else "Desconocida"
+    fields = [row["status"], row.get("p50") or 0, city, host, int((row.get("loss") or 0) * 100 + 0.5)]
+    print("\t".join(str(f).replace("\t", " ") for f in fields))
+' "$OVPN_DIR")
+
+echo "Se analizaron $(echo "$SCAN_ROWS" | wc -l) servidores únicos."
 echo ""
 
-# --- 2. Realizar Ping ---
-declare -A responsive_hosts
-unresponsive_hosts=()
-
-for host in $HOSTS; do
-    # Ping con 2 paquetes (-c 2) y tiempo de espera de 1.5 segundos (-W 1.5)
-    ping_result=$(ping -c 2 -W 1.5 "$host" 2>/dev/null)
-    if [ $? -eq 0 ]; then
-        # Extrae la latencia media (awk -F '/' '{print $5}')
-        latency=$(echo "$ping_result" | tail -n 1 | awk -F '/' '{print $5}')
-        responsive_hosts["$host"]=$latency
-    else
-        unresponsive_hosts+=("$host")
-    fi
-done
-
-# --- 3. Mostrar Resultados ---
+# --- 2. Mostrar Resultados ---
 echo "✅ Servidores Disponibles (ordenados del más rápido al más lento):"
-printf "  %-15s | %-25s | %s\n" "CIUDAD" "SERVIDOR" "LATENCIA"
-printf "  %-15s | %-25s | %s\n" "---------------" "-------------------------" "----------"
-
-if [ ${#responsive_hosts[@]} -gt 0 ]; then
-    # Genera los resultados, los ordena numéricamente y los formatea.
-    (for host in "${!responsive_hosts[@]}"; do
-        printf "%.3f %s\n" "${responsive_hosts[$host]}" "$host"
-    done) | sort -n | while read -r latency host; do
-        city=${host_to_city[$host]:-Desconocida}
-        formatted_latency=$(printf "%.2f" "$latency")
-        printf "  %-15s | %-25s | %s ms\n" "$city" "$host" "$formatted_latency"
+printf "  %-15s | %-25s | %-10s | %s\n" "CIUDAD" "SERVIDOR" "LATENCIA" "PÉRDIDA"
+printf "  %-15s | %-25s | %-10s | %s\n" "---------------" "-------------------------" "----------" "-------"
+
+UP_ROWS=$(echo "$SCAN_ROWS" | grep $'^up\t')
+if [ -n "$UP_ROWS" ]; then
+    echo "$UP_ROWS" | sort -t$'\t' -k2 -g | while IFS=$'\t' read -r status latency city host loss_pct; do
+        printf "  %-15s | %-25s | %-10s | %s%%\n" "$city" "$host" "$(printf "%.2f" "$latency") ms" "$loss_pct"
     done
 else
-    echo "  Ningún servidor respondió al ping."
+    echo "  Ningún servidor respondió."
 fi
 
 echo ""
 echo "❌ Servidores Caídos o No Encontrados:"
-printf "  %-15s | %s\n" "CIUDAD" "SERVIDOR"
-printf "  %-15s | %s\n" "---------------" "-------------------------"
-if [ ${#unresponsive_hosts[@]} -gt 0 ]; then
-    IFS=$'\n' sorted_unresponsive=($(sort <<<"${unresponsive_hosts[*]}"))
-    unset IFS
-
-    for host in "${sorted_unresponsive[@]}"; do
-        city=${host_to_city[$host]:-Desconocida}
-        printf "  %-15s | %s\n" "$city" "$host"
+printf "  %-15s | %s\n" "CIUDAD" "SERVIDOR"
+printf "  %-15s | %s\n" "---------------" "-------------------------"
+DOWN_ROWS=$(echo "$SCAN_ROWS" | grep $'^down\t')
+if [ -n "$DOWN_ROWS" ]; then
+    echo "$DOWN_ROWS" | sort -t$'\t' -k4 | while IFS=$'\t' read -r status latency city host loss_pct; do
+        printf "  %-15s | %s\n" "$city" "$host"
     done
 else
-    echo "  ¡Todos los servidores respondieron!"
+    echo "  ¡Todos los servidores respondieron!"
 fi
 echo "------------------------------------------------------------------"
 